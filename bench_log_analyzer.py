@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import concurrent.futures
+import itertools
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import logging
+import random
+import shutil
+import gzip
+import json
+import time
+import sys
+import os
+import re
+
+import log_analyzer
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+LINE_FORMAT = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "{method} {url} HTTP/1.1" 200 927 "-" '
+               '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+               '"1498697422-2190034393-4708-9752759" "dc7161be3" {request_time:.3f}\n')
+BAD_LINE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "-" 200 927 "-" '
+            '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+            '"1498697422-2190034393-4708-9752759" "dc7161be3" -\n').encode("utf-8")
+BATCH_SIZE = 100000
+
+
+def iter_log_lines(number_of_lines, urls=1000, zipf=0.0, bad_ratio=0.0, seed=0):
+    '''
+    Детерминированный генератор строк лога в формате ui_short (bytes):
+        urls - колво разных url
+        zipf - показатель распределения Ципфа для популярности url (0 - равномерно)
+        bad_ratio - доля строк, которые не распарсятся
+    '''
+
+    rnd = random.Random(seed)
+    url_lst = ["/api/v2/banner/{}".format(i) for i in range(urls)]
+    cum_weights = list(itertools.accumulate(1 / (rank ** zipf) for rank in range(1, urls + 1)))
+
+    for batch_start in range(0, number_of_lines, BATCH_SIZE):
+        batch = min(BATCH_SIZE, number_of_lines - batch_start)
+        for url in rnd.choices(url_lst, cum_weights=cum_weights, k=batch):
+            if bad_ratio and rnd.random() < bad_ratio:
+                yield BAD_LINE
+                continue
+            yield LINE_FORMAT.format(method="GET" if rnd.random() < 0.8 else "POST", url=url,
+                                     request_time=rnd.expovariate(3)).encode("utf-8")
+
+
+def generate_log_lines(number_of_lines, urls=1000, seed=0, zipf=0.0, bad_ratio=0.0):
+    return list(iter_log_lines(number_of_lines, urls, zipf, bad_ratio, seed))
+
+
+def generate_log_file(log_path, number_of_lines, urls=1000, zipf=0.0, bad_ratio=0.0, compress=False, seed=0):
+    '''
+    Пишет сгенерированный лог на диск построчно (в память целиком не грузится), .gz если compress.
+    '''
+
+    with (gzip.open(log_path, 'wb', compresslevel=6) if compress else open(log_path, 'wb')) as log_file:
+        log_file.writelines(iter_log_lines(number_of_lines, urls, zipf, bad_ratio, seed))
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1 << 20) if sys.platform == "darwin" else maxrss / 1024
+
+
+def get_stage_result(number_of_lines, seconds, **extra):
+    return {"lines": number_of_lines, "seconds": seconds, "lines_per_sec": number_of_lines / max(seconds, 1e-9),
+            **extra}
+
+
+def bench_parsers(log_lines, repeat=3):
+    '''
+    Прогоняет строки через каждый парсер из LOG_PARSERS, возвращает {parser: строк в секунду} (лучший прогон).
+    '''
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+    result = {}
+
+    for name, parse in log_analyzer.LOG_PARSERS.items():
+        best = None
+        for _ in range(repeat):
+            aggregate = log_analyzer.LogsAggregate()
+            start = time.perf_counter()
+            parse(log_lines, aggregate, logger)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result[name] = len(log_lines) / best
+
+    return result
+
+
+def bench_aggregate(log_lines):
+    '''
+    Замер LogsAggregate на разобранных строках: время add, время finalize и пик памяти (tracemalloc).
+    '''
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+    parsed = log_analyzer.LogsAggregate()
+    log_analyzer.aggregate_log_lines_fast(log_lines, parsed, logger)
+    samples = [(row["url"], row["time_max"]) for row in parsed.finalize()]
+    samples = [samples[i % len(samples)] for i in range(len(log_lines))]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    aggregate = log_analyzer.LogsAggregate()
+    for url, request_time in samples:
+        aggregate.add(url, request_time)
+    aggregate.number_of_logs = len(samples)
+    add_time = time.perf_counter() - start
+    aggregate_size = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    aggregate.finalize()
+    finalize_time = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"add_time": add_time, "finalize_time": finalize_time,
+            "aggregate_mb": aggregate_size / (1 << 20), "peak_mb": peak / (1 << 20)}
+
+
+def bench_readers(log_path, parsers=("fast", "format"), repeat=3):
+    '''
+    Сравнение чтения несжатого лога: построчный open(log_path, 'rb') и mmap с разбором по смещениям
+    (aggregate_plain_log). Для каждого парсера и способа - строк/с, МБ/с (лучший прогон)
+    и пик памяти tracemalloc (отдельным прогоном, трассировка сама замедляет парсинг).
+    '''
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+    size = os.path.getsize(log_path)
+    result = {}
+
+    for parser in parsers:
+        for reader, use_mmap in (("file", False), ("mmap", True)):
+            best = None
+            for _ in range(repeat):
+                aggregate = log_analyzer.LogsAggregate()
+                start = time.perf_counter()
+                log_analyzer.aggregate_plain_log(log_path, parser, aggregate, logger, use_mmap=use_mmap)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            tracemalloc.start()
+            log_analyzer.aggregate_plain_log(log_path, parser, log_analyzer.LogsAggregate(), logger,
+                                             use_mmap=use_mmap)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            result["{}/{}".format(parser, reader)] = get_stage_result(
+                aggregate.number_of_logs, best, mb_per_sec=size / (1 << 20) / best, peak_mb=peak / (1 << 20))
+
+    return result
+
+
+def bench_get_parsed_line(log_path, compress, sample_lines=1000000):
+    '''
+    Замер get_parsed_line (эталонный регулярный парсер) на первых sample_lines строках лога.
+    '''
+
+    regex = re.compile(r'(?:GET|POST|HEAD|PUT|OPTIONS|DELETE).(.*).HTTP/.* (\d{1,6}[.]\d+)')
+
+    with (gzip.open(log_path, 'rb') if compress else open(log_path, 'rb')) as log_file:
+        log_lines = list(itertools.islice(log_file, sample_lines))
+
+    start = time.perf_counter()
+    for line in log_lines:
+        log_analyzer.get_parsed_line(regex, line)
+    return get_stage_result(len(log_lines), time.perf_counter() - start)
+
+
+def bench_size(log_path, compress, number_of_lines, result_config, parser):
+    '''
+    Замер одного размера лога, запускается в отдельном процессе, чтобы пик RSS не смешивался между размерами.
+    '''
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+    latest_log = log_analyzer.FileSubscribe(datetime.datetime(2017, 6, 30), log_path, ".gz" if compress else "")
+
+    result = {"lines": number_of_lines, "get_parsed_line": bench_get_parsed_line(log_path, compress)}
+
+    start = time.perf_counter()
+    logs_statistic = log_analyzer.get_logs_statistics(100, latest_log, logger,
+                                                      log_analyzer.get_latency_factory(result_config),
+                                                      parser=parser)
+    result["get_logs_statistics"] = get_stage_result(number_of_lines, time.perf_counter() - start,
+                                                     urls=len(logs_statistic), peak_rss_mb=get_peak_rss_mb())
+
+    report_path = "{}.html".format(log_path)
+    start = time.perf_counter()
+    log_analyzer.render_html_report(result_config, report_path, logs_statistic, logger)
+    result["render_html_report"] = get_stage_result(min(len(logs_statistic), result_config["REPORT_SIZE"]),
+                                                    time.perf_counter() - start, peak_rss_mb=get_peak_rss_mb())
+    os.remove(report_path)
+
+    return result
+
+
+def run_suite(sizes, urls=1000, zipf=1.1, bad_ratio=0.01, compress=False, parser="fast", work_dir=None, seed=0):
+    '''
+    Прогон набора размеров: для каждого генерируется лог и отдельно замеряются
+    get_parsed_line, get_logs_statistics и render_html_report (строк/с, пик RSS).
+    Возвращает словарь для json: параметры, результаты по размерам и кривые масштабирования по этапам.
+    '''
+
+    result_config = {**log_analyzer.config, "TEMPLATE_PATH": os.path.join(os.path.dirname(os.path.abspath(
+        log_analyzer.__file__)), "reports", "report.html")}
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+
+    try:
+        for number_of_lines in sizes:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630" + (".gz" if compress else ""))
+            generate_log_file(log_path, number_of_lines, urls, zipf, bad_ratio, compress, seed)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(bench_size, log_path, compress, number_of_lines, result_config,
+                                               parser).result())
+            os.remove(log_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    stages = ("get_parsed_line", "get_logs_statistics", "render_html_report")
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "params": {"sizes": sizes, "urls": urls, "zipf": zipf, "bad_ratio": bad_ratio, "gz": compress,
+                   "parser": parser, "seed": seed},
+        "results": results,
+        "scaling": {stage: [[result["lines"], result[stage]["lines_per_sec"]] for result in results]
+                    for stage in stages}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['parsers', 'suite', 'readers'], default='parsers',
+                        help="'parsers' - parsers and aggregate micro-benchmark, 'suite' - full pipeline benchmark, "
+                             "'readers' - open() loop vs mmap for a plain log")
+    parser.add_argument('--lines', type=int, default=200000, help="Number of generated log lines")
+    parser.add_argument('--urls', type=int, default=1000, help="Number of distinct urls")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help="Suite: log sizes in lines")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Suite: Zipf skew of url popularity")
+    parser.add_argument('--bad-ratio', type=float, default=0.01, help="Suite: share of bad lines")
+    parser.add_argument('--gz', action='store_true', help="Suite: generate .gz logs")
+    parser.add_argument('--parser', default="fast", choices=sorted(log_analyzer.LOG_PARSERS), help="Suite: parser")
+    parser.add_argument('--work-dir', help="Suite: directory for generated logs")
+    parser.add_argument('--output', help="Suite: json result path (stdout by default)")
+    args = parser.parse_args()
+
+    if args.command == "suite":
+        suite = run_suite(args.sizes, args.urls, args.zipf, args.bad_ratio, args.gz, args.parser, args.work_dir)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as output:
+                json.dump(suite, output, indent=2)
+        else:
+            print(json.dumps(suite, indent=2))
+        return
+
+    if args.command == "readers":
+        tmp_dir = tempfile.mkdtemp(dir=args.work_dir)
+        try:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+            generate_log_file(log_path, args.lines, args.urls, args.zipf, args.bad_ratio)
+            for name, stat in bench_readers(log_path).items():
+                print("{:>12}: {:>10.0f} строк/с, {:>6.1f} МБ/с, пик {:.1f} МБ".format(
+                    name, stat["lines_per_sec"], stat["mb_per_sec"], stat["peak_mb"]))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    log_lines = generate_log_lines(args.lines, args.urls)
+    for name, lines_per_sec in bench_parsers(log_lines).items():
+        print("{:>8}: {:>12.0f} строк/с".format(name, lines_per_sec))
+
+    aggregate_stat = bench_aggregate(log_lines)
+    print("aggregate: add {add_time:.3f} с, finalize {finalize_time:.3f} с, "
+          "память {aggregate_mb:.1f} МБ, пик {peak_mb:.1f} МБ".format(**aggregate_stat))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,30 @@
 # -*- coding: utf-8 -*-
 
 
-# log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
+# log_format ui_short '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
 
 import collections
-import statistics
+import contextlib
+import threading
+import functools
+import itertools
+import heapq
 import argparse
 import datetime
 import pathlib
 import logging
 import string
-import gzip
+import struct
+import pickle
+import mmap
+import queue
+import zlib
+import array
 import json
+import math
 import time
 import sys
 import os
@@ -24,6 +34,11 @@ import re
 
 TEST_CASE = 100000   # Для отладки на ограниченной выборке, чтобы все не лопатить
 DEBUG_MODE = False    # Для отладки
+VECTOR_BACKEND = True  # Векторный агрегат на NumPy (VectorLogsAggregate), если NumPy установлен
+LOG_FORMAT_UI_SHORT = ('$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" '
+                       '$status $body_bytes_sent "$http_referer" '
+                       '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                       '$request_time')
 
 config = {
     "TEMPLATE_PATH": "./reports/report.html",    # Шаблон исходного отчета
@@ -31,25 +46,1324 @@ config = {
     "REPORT_DIR": "./reports",                   # Путь куда пишется отчет
     "LOG_DIR": "./log",                          # Путь откуда читаются исходные логи
     "ERRORS_LIMIT_PERC": 5,                      # Допустимая ошибка парсинга в %
-    "SELF_LOG_PATH": "./log/log_analyzer.log"    # Путь к собственныи логам программы
+    "SELF_LOG_PATH": "./log/log_analyzer.log",   # Путь к собственныи логам программы
+    "LATENCY_MODE": "exact",                     # Подсчет медианы: "exact" - точно, "sketch" - приближенно
+    "LATENCY_ACCURACY": 0.01,                    # Относительная ошибка квантилей в режиме "sketch"
+    "LOG_PARSER": "fast",                        # Парсер строк: "fast" - по байтам, "regex" - эталонный,
+                                                 # "format" - собранный из LOG_FORMAT
+    "LOG_FORMAT": LOG_FORMAT_UI_SHORT,           # nginx log_format для парсера "format"
+    "INCREMENTAL": False,                        # Дочитывать растущий лог с места прошлого запуска
+    "URL_NORMALIZE": False,                      # Убирать query string, id/hex/uuid в пути url -> {id}/{hex}/{uuid}
+    "URL_RULES": [],                             # Свои правила нормализации url: [["regex", "замена"], ...]
+    "URL_CACHE_SIZE": 100000,                    # Размер LRU кеша нормализованных url
+    "SNAPSHOT_DIR": "",                          # Куда писать полную статистику за день для rollup, "" - не писать
+    "TOP_URLS_LIMIT": 0,                         # Держать в памяти только ~2*N url с наибольшим time_sum, 0 - все
+    "FOLLOW_LOG": "nginx-access-ui.log",         # --follow: текущий (еще не ротированный) лог в LOG_DIR
+    "FOLLOW_WINDOWS": [5, 15, 60],               # --follow: скользящие окна статистики в минутах
+    "FOLLOW_BUCKET": 60,                         # --follow: шаг окон (размер корзины) в секундах
+    "FOLLOW_INTERVAL": 60,                       # --follow: как часто перерисовывать отчеты, в секундах
+    "FOLLOW_TOP_URLS_LIMIT": 1000,               # --follow: TOP_URLS_LIMIT для корзин окон, если TOP_URLS_LIMIT = 0
+    "SERVE_HOST": "127.0.0.1",                   # --serve: адрес HTTP сервера статистики
+    "SERVE_PORT": 8080,                          # --serve: порт HTTP сервера статистики, 0 - любой свободный
+    "GROUP_BY": [],                              # Доп. срезы за тот же проход: [["status", "url"], ["hour", "url"]]
+    "GROUP_LIMIT": 10000,                        # Сколько групп держать в каждом срезе (по наибольшему time_sum)
+    "LOG_INDEX": False,                          # Строить индекс лога (.idx рядом с логом) и считать по нему
+    "CACHE_DIR": "",                             # Кеш итоговой статистики между запусками, "" - не использовать
+    "CACHE_SIZE_MB": 256                         # Предельный размер кеша, старые записи вытесняются (LRU)
 }
 
-FileSubscribe = collections.namedtuple('Subscribe', ['f_date', 'f_path', 'f_ext'])
-LogSubscribe = collections.namedtuple('Subscribe', ['url', 'request_time', 'status'])
+FileSubscribe = collections.namedtuple('FileSubscribe', ['f_date', 'f_path', 'f_ext', 'f_index'], defaults=[None])
+LogSubscribe = collections.namedtuple('LogSubscribe', ['url', 'request_time', 'status'])
 
 
-def get_sys_args():
+class ExactLatency:
+    '''
+    Точная статистика времени запросов по одному url.
+    Все request_time хранятся в типизированном массиве array('d'), медиана считается один раз,
+    когда файл прочитан полностью.
+    '''
+
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = array.array('d')
+
+    def add(self, request_time):
+        self.values.append(request_time)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def median(self):
+        import statistics  # тяжелый импорт (fractions, decimal), нужен только для отчета
+
+        return statistics.median(self.values)
+
+    def quantiles(self):
+        return {}
+
+
+class SketchLatency:
+    '''
+    Приближенная статистика времени запросов по одному url (DDSketch).
+    Значения раскладываются по логарифмическим корзинам, поэтому память ограничена
+    количеством корзин, а любой квантиль считается с относительной ошибкой accuracy.
+    Если корзин стало больше max_bins - схлопываем самые младшие.
+    '''
+
+    __slots__ = ('accuracy', 'gamma', 'log_gamma', 'max_bins', 'bins', 'zero_count', 'count')
+
+    QUANTILES = (("time_p90", 0.9), ("time_p95", 0.95), ("time_p99", 0.99))
+    MIN_VALUE = 1e-9
+
+    def __init__(self, accuracy=0.01, max_bins=2048):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, request_time, count=1):
+        self.count += count
+        key = self.get_key(request_time)
+        if key is None:
+            self.zero_count += count
+            return
+        self.bins[key] = self.bins.get(key, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def get_key(self, request_time):
+        '''
+        Корзина для request_time, None - для нуля (меньше MIN_VALUE).
+        '''
+
+        return None if request_time < self.MIN_VALUE else math.ceil(math.log(request_time) / self.log_gamma)
+
+    def add_bins(self, bins, zero_count=0):
+        '''
+        Добавляет уже посчитанные корзины {корзина: колво} и колво нулей (merge и сборка пачкой в get_sketches).
+        '''
+
+        self.count += zero_count + sum(bins.values())
+        self.zero_count += zero_count
+        for key, count in bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            self.zero_count += other.zero_count
+            self.count += other.zero_count
+            for key, count in other.bins.items():
+                self.add(other.get_value(key), count)
+            return
+        self.add_bins(other.bins, other.zero_count)
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        extra = keys[:len(keys) - self.max_bins + 1]
+        self.bins[extra[-1]] += sum(self.bins.pop(key) for key in extra[:-1])
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return self.get_value(key)
+        return self.get_value(max(self.bins))
+
+    def get_value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def quantiles(self):
+        return {name: round(self.quantile(q), 3) for name, q in self.QUANTILES}
+
+
+def get_latency_factory(result_config):
+    '''
+    По config["LATENCY_MODE"] возвращает конструктор агрегатора времени запросов для одного url.
+    '''
+
+    mode = result_config.get("LATENCY_MODE", "exact")
+    if mode == "sketch":
+        return functools.partial(SketchLatency, result_config.get("LATENCY_ACCURACY", 0.01))
+    if mode == "exact":
+        return ExactLatency
+    raise ValueError("Неизвестный LATENCY_MODE: {}".format(mode))
+
+
+class UrlNormalizer:
+    '''
+    Нормализация url перед агрегацией, чтобы /api/v2/banner/25019354 и /api/v2/banner/25019355
+    попадали в одну строку отчета:
+        1. Отрезаем query string
+        2. Сегменты пути из цифр, длинные hex и uuid заменяем на {id}, {hex}, {uuid}
+        3. Применяем пользовательские правила [regex, замена] из config["URL_RULES"]
+    Результат кешируется в LRU кеше по исходному url.
+    '''
+
+    SEGMENT_RULES = (
+        (r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$', "{uuid}"),
+        (r'^\d+$', "{id}"),
+        (r'^(?=[a-fA-F]*\d)[0-9a-fA-F]{8,}$', "{hex}")
+    )
+
+    def __init__(self, strip_query=True, replace_ids=True, rules=(), cache_size=100000):
+        self.strip_query = strip_query
+        self.replace_ids = replace_ids
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.segment_rules = [(re.compile(pattern), placeholder) for pattern, placeholder in self.SEGMENT_RULES]
+        self.cache_size = cache_size
+        self.normalize = functools.lru_cache(maxsize=cache_size)(self._normalize)
+
+    def __getstate__(self):
+        return self.strip_query, self.replace_ids, [(regex.pattern, repl) for regex, repl in self.rules], self.cache_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __call__(self, url):
+        return self.normalize(url)
+
+    def _normalize_segment(self, segment):
+        for regex, placeholder in self.segment_rules:
+            if regex.match(segment):
+                return placeholder
+        return segment
+
+    def _normalize(self, url):
+        if self.strip_query:
+            url = url.split("?", 1)[0]
+        if self.replace_ids:
+            url = "/".join(map(self._normalize_segment, url.split("/")))
+        for regex, replacement in self.rules:
+            url = regex.sub(replacement, url)
+        return url
+
+
+def get_url_normalizer(result_config):
+    '''
+    По config["URL_NORMALIZE"] и config["URL_RULES"] возвращает UrlNormalizer или None, если нормализация выключена.
+    '''
+
+    normalize = result_config.get("URL_NORMALIZE", False)
+    rules = result_config.get("URL_RULES", [])
+    if not normalize and not rules:
+        return None
+    return UrlNormalizer(normalize, normalize, rules, result_config.get("URL_CACHE_SIZE", 100000))
+
+
+class GroupBy:
+    '''
+    Дополнительные срезы (view) статистики, которые LogsAggregate считает за тот же проход по логу.
+    Срез - набор измерений из DIMENSIONS, например ("status", "url") или ("hour", "url"):
+        url - url (после нормализации), method - метод, status - класс ответа (2xx, 5xx, ...),
+        minute / hour - начало минуты / часа из $time_local (29/Jun/2017:14:05 / 29/Jun/2017:14)
+    Ключ группы - значения измерений через пробел, поэтому срез - обычный LogsAggregate со строковыми ключами:
+    он сливается, вытесняет группы с наименьшим time_sum (limit групп) и рендерится тем же шаблоном.
+    Поля строки (fields) нужны парсеру LogFormatParser: метод, $status и $time_local.
+    '''
+
+    DIMENSIONS = ("url", "method", "status", "minute", "hour")
+
+    def __init__(self, views, limit=None):
+        self.views = [tuple(view) for view in views]
+        for view in self.views:
+            unknown = set(view) - set(self.DIMENSIONS)
+            if not view or unknown:
+                raise ValueError("Неизвестные измерения среза {}, доступны: {}".format(
+                    list(view), ", ".join(self.DIMENSIONS)))
+        self.limit = limit or None
+        self.names = ["-".join(view) for view in self.views]
+
+        dimensions = set(itertools.chain.from_iterable(self.views))
+        self.fields = ("method",) + (("status",) if "status" in dimensions else ()) + \
+            (("time_local",) if dimensions & {"minute", "hour"} else ())
+        self.time_size = 17 if "minute" in dimensions else 14
+        self.keys_cache = {}
+
+    def __getstate__(self):
+        return {"views": self.views, "limit": self.limit}
+
+    def __setstate__(self, state):
+        self.__init__(state["views"], state["limit"])
+
+    def get_key(self):
+        return self.views, self.limit
+
+    def get_keys(self, url, fields):
+        '''
+        Ключи групп строки для каждого среза, fields - значения self.fields (bytes) в том же порядке.
+        Ключи кешируются по url и значимой части полей (класс ответа, минута/час), кеш ограничен URL_DECODE_CACHE_SIZE.
+        '''
+
+        cache_key = (url, fields[0]) + tuple(value[:self.time_size] if name == "time_local" else value[:1]
+                                             for name, value in zip(self.fields[1:], fields[1:]))
+        keys = self.keys_cache.get(cache_key)
+        if keys is not None:
+            return keys
+
+        values = {"url": url, "method": fields[0].decode("latin-1")}
+        for name, value in zip(self.fields[1:], fields[1:]):
+            if name == "status":
+                values["status"] = value[:1].decode("latin-1") + "xx"
+            else:
+                values["minute"] = value[:17].decode("latin-1")
+                values["hour"] = value[:14].decode("latin-1")
+
+        if len(self.keys_cache) >= URL_DECODE_CACHE_SIZE:
+            self.keys_cache.clear()
+        keys = self.keys_cache[cache_key] = [" ".join([values[dimension] for dimension in view])
+                                             for view in self.views]
+        return keys
+
+
+def get_group_by(result_config):
+    '''
+    GroupBy по GROUP_BY и GROUP_LIMIT из config или None, если срезы не заданы.
+    '''
+
+    if not result_config.get("GROUP_BY"):
+        return None
+    return GroupBy(result_config["GROUP_BY"], result_config.get("GROUP_LIMIT"))
+
+
+class BadLines:
+    '''
+    Сводка плохих строк лога вместо записи в лог на каждую строку:
+        1. Счетчики по причине (reasons): format - строка не подходит под формат, request_time - время не число,
+           decode - url не декодируется в utf-8
+        2. По каждой причине - равномерная выборка примеров (reservoir sampling, алгоритм R) из size строк,
+           чтобы редкая причина не терялась среди частой. От строки хранится не больше EXAMPLE_SIZE байт
+    Сливается (merge) вместе с LogsAggregate, в лог пишется одной записью (log).
+    '''
+
+    SAMPLE_SIZE = 3
+    EXAMPLE_SIZE = 300
+
+    def __init__(self, size=SAMPLE_SIZE):
+        self.size = size
+        self.reasons = collections.Counter()
+        self.samples = {}
+        self.random = None
+
+    def get_random(self):
+        if self.random is None:
+            import random  # нужен только когда плохих строк больше size
+
+            self.random = random.Random()
+        return self.random
+
+    def add(self, reason, line):
+        self.reasons[reason] += 1
+        sample = self.samples.setdefault(reason, [])
+        if len(sample) < self.size:
+            sample.append(bytes(line[:self.EXAMPLE_SIZE]))
+        else:
+            index = self.get_random().randrange(self.reasons[reason])
+            if index < self.size:
+                sample[index] = bytes(line[:self.EXAMPLE_SIZE])
+
+    def merge(self, other):
+        '''
+        Примеры по причине берутся из обеих выборок пропорционально числу строк с этой причиной в каждой.
+        '''
+
+        for reason, other_sample in other.samples.items():
+            sample = self.samples.get(reason, [])
+            seen, other_seen = self.reasons[reason], other.reasons[reason]
+            taken = min(round(self.size * other_seen / (seen + other_seen)), len(other_sample))
+            kept = min(self.size - taken, len(sample))
+            taken = min(self.size - kept, len(other_sample))
+            random = self.get_random()
+            self.samples[reason] = random.sample(sample, kept) + random.sample(other_sample, taken)
+        self.reasons.update(other.reasons)
+        return self
+
+    def log(self, logger, number_of_logs):
+        if not self.reasons:
+            return
+        logger.warning("Не удалось разобрать {} из {} строк, по причинам:\n{}".format(
+            sum(self.reasons.values()), number_of_logs, "\n".join(
+                "  {}: {}, например {}".format(reason, count, ", ".join(map(repr, self.samples[reason])))
+                for reason, count in self.reasons.most_common())))
+
+
+class LogsAggregate:
+    '''
+    Частичная статистика по логам, которую можно сливать (merge) с другой такой же.
+    Хранится по колонкам: url интернируется в целочисленный id (url_ids / urls),
+    count, time_sum, time_max лежат в параллельных типизированных массивах array по этому id.
+    Для ExactLatency время запросов копится в двух плоских массивах (sample_ids, sample_times)
+    и раскладывается по url только в finalize(); для остальных агрегаторов (SketchLatency)
+    хранится список latencies по id.
+    Если задан url_normalizer, url нормализуется перед добавлением (UrlNormalizer).
+    Если задан max_urls (режим heavy hitters), то когда url становится 2 * max_urls, в памяти остаются
+    только max_urls url с наибольшим time_sum, остальные вытесняются (prune). Вытесненное время
+    учитывается в общем времени, а максимальный вытесненный time_sum - оценка ошибки для оставшихся url.
+    Производные поля (проценты, среднее, медиана) считаются только в finalize() и только для
+    строк, которые попадут в отчет.
+    Если задан group_by (GroupBy), за тот же проход считаются срезы views - вложенные LogsAggregate
+    с составными ключами, время в них всегда копится в SketchLatency (память на группу ограничена).
+    Плохие строки считаются в bad_logs, причины и примеры - в bad_lines (BadLines).
+    '''
+
+    def __init__(self, latency_factory=ExactLatency, url_normalizer=None, max_urls=None, group_by=None):
+        self.latency_factory = latency_factory
+        self.url_normalizer = url_normalizer
+        self.max_urls = max_urls or None
+        self.flat_latency = latency_factory is ExactLatency
+        self.url_ids = {}
+        self.urls = []
+        self.counts = array.array('Q')
+        self.time_sums = array.array('d')
+        self.time_maxs = array.array('d')
+        self.sample_ids = array.array('I')
+        self.sample_times = array.array('d')
+        self.latencies = []
+        self.number_of_logs = 0
+        self.bad_logs = 0
+        self.bad_lines = BadLines()
+        self.pruned_urls = 0
+        self.pruned_time_sum = 0.0
+        self.pruned_time_max = 0.0
+        self.group_by = group_by
+        self.views = {}
+        if group_by is not None:
+            view_latency_factory = SketchLatency if latency_factory is ExactLatency else latency_factory
+            self.views = {name: LogsAggregate(view_latency_factory, None, group_by.limit) for name in group_by.names}
+
+    def get_url_id(self, url, prune=True):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            if prune and self.max_urls is not None and len(self.urls) >= 2 * self.max_urls:
+                self.prune()
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.counts.append(0)
+            self.time_sums.append(0.0)
+            self.time_maxs.append(0.0)
+            if not self.flat_latency:
+                self.latencies.append(self.latency_factory())
+        return url_id
+
+    def add(self, url, request_time, fields=None):
+        if self.url_normalizer is not None:
+            url = self.url_normalizer(url)
+
+        if fields is not None and self.views:
+            for name, key in zip(self.group_by.names, self.group_by.get_keys(url, fields)):
+                self.views[name].add(key, request_time)
+
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.get_url_id(url)
+
+        self.counts[url_id] += 1
+        self.time_sums[url_id] = round(self.time_sums[url_id] + request_time, 3)
+        if request_time > self.time_maxs[url_id]:
+            self.time_maxs[url_id] = round(request_time, 3)
+
+        if self.flat_latency:
+            self.sample_ids.append(url_id)
+            self.sample_times.append(request_time)
+        else:
+            self.latencies[url_id].add(request_time)
+
+    def add_bad_line(self, reason, line):
+        self.bad_logs += 1
+        self.bad_lines.add(reason, line)
+
+    def flush(self):
+        '''
+        Колонки count, time_sum, time_max всегда актуальны, досчитывать нечего (см. VectorLogsAggregate).
+        '''
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.number_of_logs += other.number_of_logs
+        self.bad_logs += other.bad_logs
+        self.bad_lines.merge(other.bad_lines)
+        self.pruned_urls += other.pruned_urls
+        self.pruned_time_sum += other.pruned_time_sum
+        self.pruned_time_max = max(self.pruned_time_max, other.pruned_time_max)
+
+        id_map = array.array('I', map(functools.partial(self.get_url_id, prune=False), other.urls))
+        for other_id, url_id in enumerate(id_map):
+            self.counts[url_id] += other.counts[other_id]
+            self.time_sums[url_id] = round(self.time_sums[url_id] + other.time_sums[other_id], 3)
+            self.time_maxs[url_id] = max(self.time_maxs[url_id], other.time_maxs[other_id])
+            if not self.flat_latency:
+                self.latencies[url_id].merge(other.latencies[other_id])
+
+        if self.flat_latency:
+            self.extend_samples(id_map, other)
+
+        for name, view in other.views.items():
+            self.views[name].merge(view)
+
+        if self.max_urls is not None and len(self.urls) > 2 * self.max_urls:
+            self.prune()
+
+        return self
+
+    def extend_samples(self, id_map, other):
+        '''
+        Дописывает время запросов other (ExactLatency) в плоские массивы, id url other переводятся через id_map.
+        '''
+
+        self.sample_ids.extend(array.array('I', map(id_map.__getitem__, other.sample_ids)))
+        self.sample_times.extend(other.sample_times)
+
+    def add_index(self, urls, url_ids, request_times):
+        '''
+        Добавляет строки из колонок индекса лога (LogIndex): urls - словарь url индекса,
+        url_ids и request_times - колонки строк. url нормализуется и интернируется один раз на url словаря,
+        а не на строку, поэтому время на строку - только обновление счетчиков.
+        Вытеснение (max_urls) проверяется один раз в конце, срезы views по индексу не считаются.
+        '''
+
+        id_map = [None] * len(urls)
+        counts, time_sums, time_maxs, latencies = self.counts, self.time_sums, self.time_maxs, self.latencies
+        add_sample_id, add_sample_time = self.sample_ids.append, self.sample_times.append
+        flat_latency = self.flat_latency
+
+        for index_id, request_time in zip(url_ids, request_times):
+            url_id = id_map[index_id]
+            if url_id is None:
+                url = urls[index_id]
+                if self.url_normalizer is not None:
+                    url = self.url_normalizer(url)
+                url_id = id_map[index_id] = self.get_url_id(url, prune=False)
+
+            counts[url_id] += 1
+            time_sums[url_id] = round(time_sums[url_id] + request_time, 3)
+            if request_time > time_maxs[url_id]:
+                time_maxs[url_id] = round(request_time, 3)
+
+            if flat_latency:
+                add_sample_id(url_id)
+                add_sample_time(request_time)
+            else:
+                latencies[url_id].add(request_time)
+
+        if self.max_urls is not None and len(self.urls) > 2 * self.max_urls:
+            self.prune()
+
+        return self
+
+    def prune(self):
+        '''
+        Оставляет max_urls url с наибольшим time_sum (в исходном порядке), остальные вытесняет.
+        '''
+
+        self.flush()
+        keep = sorted(heapq.nlargest(self.max_urls, range(len(self.urls)), key=self.time_sums.__getitem__))
+        kept = set(keep)
+        pruned_sums = [time_sum for url_id, time_sum in enumerate(self.time_sums) if url_id not in kept]
+        self.pruned_urls += len(pruned_sums)
+        self.pruned_time_sum += math.fsum(pruned_sums)
+        self.pruned_time_max = max(self.pruned_time_max, max(pruned_sums, default=0.0))
+
+        if self.flat_latency:
+            id_map = array.array('l', [-1]) * len(self.urls)
+            for new_id, url_id in enumerate(keep):
+                id_map[url_id] = new_id
+            selector = bytes(id_map[url_id] >= 0 for url_id in self.sample_ids)
+            self.sample_ids = array.array('I', map(id_map.__getitem__, itertools.compress(self.sample_ids, selector)))
+            self.sample_times = array.array('d', itertools.compress(self.sample_times, selector))
+        else:
+            self.latencies = [self.latencies[url_id] for url_id in keep]
+
+        self.urls = [self.urls[url_id] for url_id in keep]
+        self.url_ids = {url: url_id for url_id, url in enumerate(self.urls)}
+        self.counts = array.array('Q', map(self.counts.__getitem__, keep))
+        self.time_sums = array.array('d', map(self.time_sums.__getitem__, keep))
+        self.time_maxs = array.array('d', map(self.time_maxs.__getitem__, keep))
+
+    def get_flat_samples(self):
+        '''
+        Раскладывает время запросов в один плоский буфер, сгруппированный по id (сортировка подсчетом).
+        Возвращает (буфер, смещения): время запросов url с id i лежит в buffer[offsets[i]:offsets[i + 1]].
+        '''
+
+        self.flush()
+        offsets = array.array('Q', [0])
+        offsets.extend(itertools.accumulate(self.counts))
+
+        positions = array.array('Q', offsets)
+        buffer = array.array('d', bytes(8 * len(self.sample_times)))
+        for url_id, request_time in zip(self.sample_ids, self.sample_times):
+            buffer[positions[url_id]] = request_time
+            positions[url_id] += 1
+
+        return buffer, offsets
+
+    def get_sketches(self, accuracy=0.01):
+        '''
+        Время запросов по каждому id в виде SketchLatency (для snapshot-ов).
+        Для ExactLatency - пачкой: запросы url считаются по значениям (collections.Counter), а корзина
+        считается один раз на значение по всему логу (request_time с точностью до мс, значений немного).
+        '''
+
+        if not self.flat_latency:
+            return self.latencies
+
+        buffer, offsets = self.get_flat_samples()
+        get_key = SketchLatency(accuracy).get_key
+        keys = {}
+        sketches = []
+        for url_id in range(len(self.urls)):
+            bins, zero_count = {}, 0
+            for request_time, count in collections.Counter(buffer[offsets[url_id]:offsets[url_id + 1]]).items():
+                key = keys.get(request_time)
+                if key is None and request_time not in keys:
+                    key = keys[request_time] = get_key(request_time)
+                if key is None:
+                    zero_count += count
+                else:
+                    bins[key] = bins.get(key, 0) + count
+            sketch = SketchLatency(accuracy)
+            sketch.add_bins(bins, zero_count)
+            sketches.append(sketch)
+        return sketches
+
+    def get_selected_samples(self, url_ids):
+        '''
+        Время запросов только для выбранных id: {id: array('d')}.
+        Фильтрация плоских массивов идет через itertools.compress, без цикла Python по всем запросам.
+        '''
+
+        samples = {url_id: array.array('d') for url_id in url_ids}
+        selector = bytes(map(samples.__contains__, self.sample_ids))
+        for url_id, request_time in zip(itertools.compress(self.sample_ids, selector),
+                                        itertools.compress(self.sample_times, selector)):
+            samples[url_id].append(request_time)
+        return samples
+
+    SORT_COLUMNS = {"time_sum": "time_sums", "count": "counts", "time_max": "time_maxs"}
+
+    def finalize(self, limit=None, sort="time_sum"):
+        '''
+        1. Выбираем limit id url с наибольшим sort (по умолчанию time_sum, heapq.nlargest), без limit - сортируем все
+        2. Собираем строки отчета только для выбранных url (get_rows)
+        Сам aggregate не меняется, в него можно дальше добавлять строки.
+        '''
+
+        self.flush()
+        key = getattr(self, self.SORT_COLUMNS[sort]).__getitem__
+        if limit is not None and limit < len(self.urls):
+            order = heapq.nlargest(limit, range(len(self.urls)), key=key)
+        else:
+            order = sorted(range(len(self.urls)), key=key, reverse=True)
+        return self.get_rows(order)
+
+    def get_view_statistics(self, limit=None):
+        '''
+        Строки отчета по каждому срезу group_by: {имя среза: строки}, проценты - от всех строк лога.
+        '''
+
+        view_statistics = {}
+        for name, view in self.views.items():
+            view.number_of_logs, view.bad_logs = self.number_of_logs, self.bad_logs
+            view_statistics[name] = view.finalize(limit)
+        return view_statistics
+
+    def get_url_row(self, url):
+        '''
+        Строка статистики по одному url (нормализуется, если задан url_normalizer) или None, если такого url нет.
+        '''
+
+        if self.url_normalizer is not None:
+            url = self.url_normalizer(url)
+        url_id = self.url_ids.get(url)
+        return None if url_id is None else self.get_rows([url_id])[0]
+
+    def get_medians(self, url_ids):
+        '''
+        Медианы времени запросов для url_ids по плоским массивам (ExactLatency): для части url - только по их
+        запросам (get_selected_samples), для всех - по буферу, сгруппированному по id (get_flat_samples).
+        '''
+
+        import statistics
+
+        if len(url_ids) < len(self.urls):
+            samples = self.get_selected_samples(url_ids)
+            return [statistics.median(samples[url_id]) for url_id in url_ids]
+
+        buffer, offsets = self.get_flat_samples()
+        return [statistics.median(buffer[offsets[url_id]:offsets[url_id + 1]]) for url_id in url_ids]
+
+    def get_rows(self, url_ids):
+        '''
+        Строки отчета для url_ids в заданном порядке, медиана (и квантили) считаются один раз по каждому url.
+        Общее время считается через math.fsum, чтобы результат не зависел от порядка слияния.
+        '''
+
+        self.flush()
+        time_sum_all_req = math.fsum(self.time_sums) + self.pruned_time_sum
+        medians = self.get_medians(url_ids) if self.flat_latency else None
+
+        common_stat_as_lst = []
+        for index, url_id in enumerate(url_ids):
+            count, time_sum = self.counts[url_id], self.time_sums[url_id]
+            row = {
+                "url": self.urls[url_id],
+                "count": count,
+                "time_max": self.time_maxs[url_id],
+                "time_sum": time_sum,
+                "count_perc": round((count / self.number_of_logs) * 100, 3),
+                "time_perc": round(time_sum / time_sum_all_req * 100, 3),
+                "time_avg": round(time_sum / count, 3)
+            }
+            if medians is not None:
+                row["time_med"] = round(medians[index], 3)
+            else:
+                latency = self.latencies[url_id]
+                row["time_med"] = round(latency.median(), 3)
+                row.update(latency.quantiles())
+            common_stat_as_lst.append(row)
+
+        return common_stat_as_lst
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    '''
+    Модуль numpy или None, если NumPy не установлен. Импорт тяжелый, поэтому только когда нужен агрегат.
+    '''
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class VectorLogsAggregate(LogsAggregate):
+    '''
+    LogsAggregate для ExactLatency с векторным бэкендом на NumPy.
+    Строка лога не обновляет счетчики: add только интернирует url и дописывает id и request_time
+    в плоские массивы sample_ids / sample_times. Дальше все пачкой:
+        1. count, time_sum, time_max по еще не учтенным строкам - np.bincount по id (с весами для суммы)
+           и np.maximum.at, перед любым чтением колонок (flush)
+        2. медиана - сортировка запросов по (id, время) и середина отрезка каждого url (get_medians)
+        3. id при слиянии и из индекса лога переводятся индексацией массива, а не циклом по строкам
+    Колонки - те же array, поэтому merge, prune, snapshot и checkpoint общие с LogsAggregate.
+    Для request_time с точностью до мс (как пишет nginx) результат совпадает с LogsAggregate.
+    '''
+
+    def __init__(self, latency_factory=ExactLatency, url_normalizer=None, max_urls=None, group_by=None):
+        super().__init__(latency_factory, url_normalizer, max_urls, group_by)
+        self.flushed = 0
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if get_numpy() is None:
+            self.__class__ = LogsAggregate
+
+    def add(self, url, request_time, fields=None):
+        if self.url_normalizer is not None:
+            url = self.url_normalizer(url)
+
+        if fields is not None and self.views:
+            for name, key in zip(self.group_by.names, self.group_by.get_keys(url, fields)):
+                self.views[name].add(key, request_time)
+
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.get_url_id(url)
+
+        self.sample_ids.append(url_id)
+        self.sample_times.append(request_time)
+
+    def flush(self):
+        '''
+        Досчитывает count, time_sum, time_max по строкам, добавленным после прошлого flush.
+        time_sum и time_max округляются так же, как в LogsAggregate.add.
+        '''
+
+        if self.flushed == len(self.sample_ids):
+            return
+
+        np = get_numpy()
+        url_ids = np.frombuffer(self.sample_ids, dtype=self.sample_ids.typecode)[self.flushed:]
+        request_times = np.frombuffer(self.sample_times, dtype=self.sample_times.typecode)[self.flushed:]
+        counts = np.bincount(url_ids, minlength=len(self.urls))
+        time_sums = np.bincount(url_ids, weights=request_times, minlength=len(self.urls))
+        time_maxs = np.zeros(len(self.urls))
+        np.maximum.at(time_maxs, url_ids, request_times)
+
+        touched = np.flatnonzero(counts)
+        for url_id, count, time_sum, time_max in zip(touched.tolist(), counts[touched].tolist(),
+                                                     time_sums[touched].tolist(), time_maxs[touched].tolist()):
+            self.counts[url_id] += count
+            self.time_sums[url_id] = round(self.time_sums[url_id] + time_sum, 3)
+            if time_max > self.time_maxs[url_id]:
+                self.time_maxs[url_id] = round(time_max, 3)
+
+        self.flushed = len(self.sample_ids)
+
+    def prune(self):
+        super().prune()
+        self.flushed = len(self.sample_ids)
+
+    def extend_samples(self, id_map, other):
+        np = get_numpy()
+        other_ids = np.frombuffer(other.sample_ids, dtype=other.sample_ids.typecode)
+        self.sample_ids.frombytes(np.frombuffer(id_map, dtype=id_map.typecode)[other_ids].tobytes())
+        self.sample_times.extend(other.sample_times)
+        self.flushed = len(self.sample_ids)
+
+    def add_index(self, urls, url_ids, request_times):
+        '''
+        LogsAggregate.add_index пачкой: url интернируются в порядке первого появления в колонке,
+        колонка id переводится индексацией массива, счетчики досчитывает flush.
+        Колонки - memoryview индекса (читаются без копирования) или итераторы отобранных строк (LogIndex.select).
+        '''
+
+        np = get_numpy()
+        index_ids = np.frombuffer(url_ids, dtype=url_ids.format) if isinstance(url_ids, memoryview) else \
+            np.fromiter(url_ids, dtype=self.sample_ids.typecode)
+        request_times = np.frombuffer(request_times, dtype=request_times.format) \
+            if isinstance(request_times, memoryview) else np.fromiter(request_times, dtype=self.sample_times.typecode)
+        used_ids, first_rows = np.unique(index_ids, return_index=True)
+        id_map = np.zeros(len(urls), dtype=self.sample_ids.typecode)
+        for index_id in used_ids[np.argsort(first_rows)].tolist():
+            url = urls[index_id]
+            if self.url_normalizer is not None:
+                url = self.url_normalizer(url)
+            id_map[index_id] = self.get_url_id(url, prune=False)
+
+        self.sample_ids.frombytes(id_map[index_ids].tobytes())
+        self.sample_times.frombytes(request_times.astype(self.sample_times.typecode).tobytes())
+        self.flush()
+
+        if self.max_urls is not None and len(self.urls) > 2 * self.max_urls:
+            self.prune()
+
+        return self
+
+    def get_flat_samples(self):
+        '''
+        LogsAggregate.get_flat_samples через устойчивую сортировку id: порядок запросов внутри url тот же.
+        '''
+
+        self.flush()
+        np = get_numpy()
+        sample_ids = np.frombuffer(self.sample_ids, dtype=self.sample_ids.typecode)
+        sample_times = np.frombuffer(self.sample_times, dtype=self.sample_times.typecode)
+
+        buffer = array.array('d', sample_times[np.argsort(sample_ids, kind="stable")].tobytes())
+        offsets = array.array('Q', [0])
+        offsets.extend(itertools.accumulate(self.counts))
+        return buffer, offsets
+
+    def get_sketches(self, accuracy=0.01):
+        '''
+        LogsAggregate.get_sketches одним векторным проходом: корзина каждого запроса - np.log по всему массиву,
+        колво запросов по (id, корзина) - np.unique по составному коду, цикл Python - только по непустым корзинам.
+        '''
+
+        self.flush()
+        np = get_numpy()
+        sample_ids = np.frombuffer(self.sample_ids, dtype=self.sample_ids.typecode).astype(np.int64)
+        sample_times = np.frombuffer(self.sample_times, dtype=self.sample_times.typecode)
+        sketches = [SketchLatency(accuracy) for _ in self.urls]
+        if not len(sample_times):
+            return sketches
+
+        zero = sample_times < SketchLatency.MIN_VALUE
+        keys = np.zeros(len(sample_times), dtype=np.int64)
+        keys[~zero] = np.ceil(np.log(sample_times[~zero]) / sketches[0].log_gamma)
+        zero_key = int(keys[~zero].min()) - 1 if not zero.all() else 0  # нули - в отдельную корзину ниже всех
+        keys[zero] = zero_key
+        width = int(keys.max()) - zero_key + 1
+        codes, counts = np.unique(sample_ids * width + (keys - zero_key), return_counts=True)
+
+        bins = [{} for _ in self.urls]
+        zero_counts = [0] * len(self.urls)
+        for url_id, key, count in zip((codes // width).tolist(), (codes % width + zero_key).tolist(), counts.tolist()):
+            if key == zero_key:
+                zero_counts[url_id] += count
+            else:
+                bins[url_id][key] = count
+        for sketch, url_bins, zero_count in zip(sketches, bins, zero_counts):
+            sketch.add_bins(url_bins, zero_count)
+        return sketches
+
+    def get_medians(self, url_ids):
+        '''
+        Медианы одним проходом: запросы выбранных url сортируются по (id, время) (np.lexsort),
+        медиана url - середина его отрезка, для четного колва - среднее двух средних (как statistics.median).
+        '''
+
+        if not url_ids:
+            return []
+
+        self.flush()
+        np = get_numpy()
+        sample_ids = np.frombuffer(self.sample_ids, dtype=self.sample_ids.typecode)
+        sample_times = np.frombuffer(self.sample_times, dtype=self.sample_times.typecode)
+        selected = np.asarray(url_ids, dtype=np.int64)
+        if len(url_ids) < len(self.urls):
+            mask = np.zeros(len(self.urls), dtype=bool)
+            mask[selected] = True
+            keep = mask[sample_ids]
+            sample_ids, sample_times = sample_ids[keep], sample_times[keep]
+
+        sorted_times = sample_times[np.lexsort((sample_times, sample_ids))]
+        counts = np.bincount(sample_ids, minlength=len(self.urls))
+        starts = (np.cumsum(counts) - counts)[selected]
+        sizes = counts[selected]
+        lower = sorted_times[starts + (sizes - 1) // 2]
+        upper = sorted_times[starts + sizes // 2]
+        return ((lower + upper) / 2).tolist()
+
+
+def create_aggregate(latency_factory=ExactLatency, url_normalizer=None, max_urls=None, group_by=None):
+    '''
+    Агрегат для разбора лога: для ExactLatency при установленном NumPy (и VECTOR_BACKEND) - VectorLogsAggregate,
+    иначе LogsAggregate.
+    '''
+
+    if VECTOR_BACKEND and latency_factory is ExactLatency and get_numpy() is not None:
+        return VectorLogsAggregate(latency_factory, url_normalizer, max_urls, group_by)
+    return LogsAggregate(latency_factory, url_normalizer, max_urls, group_by)
+
+
+class StatsStore:
+    '''
+    LogsAggregate, общий для чтения лога и HTTP сервера статистики (--serve).
+    Новые данные приходят готовыми LogsAggregate через ingest(), парсинг идет без блокировки.
+    Первый пришедший LogsAggregate берется как есть (без копирования), следующие сливаются в него.
+    Если блокировку держит запрос (строит отчет), ingest() не ждет: порция откладывается
+    и сливается при следующем ingest(), flush() или запросе (get_view), даже если новых строк больше нет.
+    Отсортированные выборки кешируются и сбрасываются при каждом слиянии новых данных.
+    '''
+
+    def __init__(self, aggregate=None):
+        self.aggregate = aggregate
+        self.lock = threading.Lock()
+        self.pending = []
+        self.version = 0
+        self.views = {}
+
+    def ingest(self, aggregate, block=False):
+        self.pending.append(aggregate)
+        if not self.lock.acquire(blocking=block):
+            return False
+        try:
+            self.merge_pending()
+        finally:
+            self.lock.release()
+        return True
+
+    def flush(self):
+        with self.lock:
+            self.merge_pending()
+
+    def merge_pending(self):
+        if not self.pending:
+            return
+        while self.pending:
+            aggregate = self.pending.pop(0)
+            if self.aggregate is None:
+                self.aggregate = aggregate
+            else:
+                self.aggregate.merge(aggregate)
+        self.version += 1
+        self.views = {}
+
+    def get_view(self, key, build):
+        if self.pending:
+            self.flush()
+        views = self.views
+        if key in views:
+            return views[key]
+        with self.lock:
+            if key not in self.views:
+                self.views[key] = build()
+            return self.views[key]
+
+    def top(self, limit, sort="time_sum"):
+        return self.get_view(("top", limit, sort), lambda: self.aggregate.finalize(limit, sort))
+
+    def url(self, url):
+        return self.get_view(("url", url), lambda: self.aggregate.get_url_row(url))
+
+
+def get_stats_response(store, target):
+    '''
+    Ответ HTTP сервера статистики на GET target: (код, json-объект)
+        /top?n=10&sort=time_sum|count|time_max - n url с наибольшим sort
+        /url?path=/api/... - статистика по одному url
+    '''
+
+    import urllib.parse
+
+    request = urllib.parse.urlsplit(target)
+    query = urllib.parse.parse_qs(request.query)
+    if request.path in ("/top", "/url") and store.aggregate is None and not store.pending:
+        return 503, {"error": "no data yet"}
+
+    if request.path == "/top":
+        sort = query.get("sort", ["time_sum"])[0]
+        if sort not in LogsAggregate.SORT_COLUMNS:
+            return 400, {"error": "sort must be one of: {}".format(", ".join(LogsAggregate.SORT_COLUMNS))}
+        try:
+            limit = int(query.get("n", ["10"])[0])
+        except ValueError:
+            return 400, {"error": "n must be an integer"}
+        table = store.top(max(limit, 0), sort)
+        return 200, {"lines": store.aggregate.number_of_logs, "table": table}
+
+    if request.path == "/url":
+        if "path" not in query:
+            return 400, {"error": "path is required"}
+        row = store.url(query["path"][0])
+        return (404, {"error": "url not found"}) if row is None else (200, row)
+
+    return 404, {"error": "not found"}
+
+
+class StatsServer(threading.Thread):
+    '''
+    HTTP сервер статистики на asyncio (только stdlib) в отдельном потоке со своим event loop.
+    Ответы строятся в пуле потоков (run_in_executor), поэтому медленный запрос не держит event loop.
+    port=0 - любой свободный порт, фактический порт доступен в self.port после started.
+    '''
+
+    def __init__(self, store, host, port, logger):
+        super().__init__(daemon=True)
+        self.store = store
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.started = threading.Event()
+        self.loop = None
+        self.stopped = None
+
+    def run(self):
+        import asyncio  # самый тяжелый импорт, нужен только с --serve
+
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.logger.info("HTTP сервер статистики: http://{}:{}/top".format(self.host, self.port))
+        self.started.set()
+        async with server:
+            await self.stopped
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set_result, None)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3 or parts[0] != "GET":
+                status, payload = 405, {"error": "only GET is supported"}
+            else:
+                status, payload = await self.loop.run_in_executor(None, get_stats_response, self.store, parts[1])
+
+            body = json.dumps(payload).encode("utf-8")
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                         "Connection: close\r\n\r\n".format(status, STATS_STATUS_REASONS[status], len(body))
+                         .encode("latin-1") + body)
+            await writer.drain()
+        except Exception:
+            self.logger.exception("Ошибка обработки HTTP запроса")
+        finally:
+            writer.close()
+
+
+STATS_STATUS_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                        503: "Service Unavailable"}
+
+
+class PipelineMetrics:
+    '''
+    Метрики одного прогона: время и пропускная способность по этапам
+    (discovery, decompress, parse, aggregate, save, finalize, render) и счетчики (строки, ошибки, url).
+    Время этапа копится, если этап выполнялся несколько раз. Пишется в json рядом с отчетом.
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    def add_stage(self, name, seconds, items=None):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "items": 0})
+        stage["seconds"] += seconds
+        stage["items"] += items or 0
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start, items)
+
+    def timed(self, name):
+        '''
+        Декоратор: время каждого вызова функции добавляется к этапу name.
+        '''
+
+        def real_decorator(func):
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return real_decorator
+
+    def as_dict(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, items_per_sec=stage["items"] / max(stage["seconds"], 1e-9))
+        return {"total_seconds": time.perf_counter() - self.started, "stages": stages, "counters": self.counters}
+
+    def log(self, logger):
+        for name, stage in self.as_dict()["stages"].items():
+            logger.debug("Этап {}: {:.3f} с{}".format(name, stage["seconds"], ", {:.0f} /с ({})".format(
+                stage["items_per_sec"], stage["items"]) if stage["items"] else ""))
+
+    def write(self, metrics_path, logger):
+        try:
+            with open(metrics_path, 'w', encoding='utf-8') as metrics_file:
+                json.dump(self.as_dict(), metrics_file, indent=2)
+        except OSError:
+            logger.exception("Не удалось записать метрики: {}".format(metrics_path))
+            return False
+        logger.debug("Метрики записаны: {}".format(metrics_path))
+        return True
+
+
+def get_metrics_path(report_path):
+    return pathlib.Path(report_path).with_suffix(".metrics.json")
+
+
+def run_profiled(func, profile_path, logger_name, *args):
+    '''
+    Режим --profile: выполняет func(*args) под cProfile и tracemalloc.
+    Статистика cProfile пишется в profile_path (python -m pstats profile_path),
+    в лог - топ функций по cumulative времени и топ мест выделения памяти.
+    '''
+
+    import tracemalloc  # нужны только с --profile
+    import cProfile
+    import pstats
+    import io
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        logger = logging.getLogger(logger_name)
+        profiler.dump_stats(profile_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(20)
+        logger.debug("cProfile ({}):\n{}".format(profile_path, stream.getvalue()))
+        logger.debug("tracemalloc, пик {:.1f} МБ:\n{}".format(peak / (1 << 20), "\n".join(
+            str(stat) for stat in snapshot.statistics("lineno")[:10])))
+
+
+def parse_date_arg(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y%m%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError("Дата должна быть в формате YYYYMMDD: {}".format(value))
+
+
+class SlidingWindowAggregate:
+    '''
+    Статистика за скользящие окна (например последние 5/15/60 минут) для режима --follow.
+    Кольцевой буфер из корзин по bucket_seconds секунд, каждая корзина - свой LogsAggregate
+    (по умолчанию с SketchLatency, чтобы память на url была ограничена).
+    Корзины старше самого большого окна переиспользуются, а url в каждой корзине ограничены max_urls
+    (по умолчанию FOLLOW_TOP_URLS_LIMIT), поэтому память не растет со временем.
+    Окно собирается слиянием последних корзин.
+    '''
+
+    def __init__(self, windows=(5, 15, 60), bucket_seconds=60, latency_factory=SketchLatency, url_normalizer=None,
+                 max_urls=None):
+        self.windows = sorted(windows)
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = max(math.ceil(self.windows[-1] * 60 / bucket_seconds), 1)
+        self.latency_factory = latency_factory
+        self.url_normalizer = url_normalizer
+        self.max_urls = max_urls or config["FOLLOW_TOP_URLS_LIMIT"]
+        self.buckets = [None] * self.bucket_count
+        self.bucket_index = [None] * self.bucket_count
+
+    def current(self, now):
+        '''
+        Корзина для момента now (секунды epoch), устаревшая корзина в этом слоте сбрасывается.
+        '''
+
+        index = int(now // self.bucket_seconds)
+        slot = index % self.bucket_count
+        if self.bucket_index[slot] != index:
+            self.buckets[slot] = LogsAggregate(self.latency_factory, self.url_normalizer, self.max_urls)
+            self.bucket_index[slot] = index
+        return self.buckets[slot]
+
+    def get_window(self, minutes, now):
+        '''
+        Сливает корзины за последние minutes минут (включая текущую) в новый LogsAggregate.
+        '''
+
+        last_index = int(now // self.bucket_seconds)
+        first_index = last_index - max(math.ceil(minutes * 60 / self.bucket_seconds), 1) + 1
+        window = LogsAggregate(self.latency_factory, None, self.max_urls)
+        for index, bucket in zip(self.bucket_index, self.buckets):
+            if index is not None and first_index <= index <= last_index:
+                window.merge(bucket)
+        return window
+
+
+class LogFollower:
+    '''
+    Чтение растущего лога как tail -F: отдает только полные строки, дописанные с прошлого вызова.
+    Ротацию определяет по смене inode (старый файл дочитывается до конца) или по уменьшению размера (copytruncate).
+    За один вызов читается не больше max_bytes.
+    '''
+
+    def __init__(self, log_path, from_start=False, max_bytes=16 << 20):
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.log_file = None
+        self.inode = None
+        self.tail = b""
+        self.open(not from_start)
+
+    def open(self, seek_end=False):
+        try:
+            self.log_file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            self.log_file = None
+            return
+        self.inode = os.fstat(self.log_file.fileno()).st_ino
+        if seek_end:
+            self.log_file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def read_available(self):
+        data = self.tail + self.log_file.read(self.max_bytes)
+        lines = data.split(b"\n")
+        self.tail = lines.pop()
+        return lines
+
+    def read_lines(self):
+        if self.log_file is None:
+            self.open()
+            if self.log_file is None:
+                return []
+
+        lines = self.read_available()
+        try:
+            log_stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            log_stat = None
+
+        if log_stat is not None and log_stat.st_ino == self.inode and log_stat.st_size >= self.log_file.tell():
+            return lines
+
+        if len(lines) and self.log_file.tell() < os.fstat(self.log_file.fileno()).st_size:
+            return lines    # старый файл еще не дочитан
+
+        if self.tail:
+            lines.append(self.tail)
+            self.tail = b""
+        self.close()
+        if log_stat is not None:
+            self.open()
+            lines.extend(self.read_available())
+        return lines
+
+
+def get_sys_args(argv=None):
     '''
     1. Создаем парсер аргуметов
     2. Задаем именованный параметр --config: путь до config файла
-    3. Возвращаем путь до config файла либо по default, либо пользовательский
+    3. Задаем именованный параметр --workers: колво процессов для парсинга лога
+    4. Задаем пакетный режим: --from/--to (диапазон дат) или --all-missing, --jobs - колво логов параллельно
+    5. Задаем подкоманду rollup: отчет за --from/--to по snapshot-ам, --output - путь отчета
+    6. Задаем режим --follow: чтение текущего лога и отчеты за скользящие окна
+    7. Задаем режим --serve: HTTP сервер статистики
+    8. Задаем --profile: путь для статистики cProfile
+    9. Задаем подкоманду query: выборка по индексу лога (--from - дата лога), --top, --sort и фильтры
+    10. Возвращаем аргументы, путь до config файла либо по default, либо пользовательский
     '''
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['report', 'rollup', 'query'], default='report',
+                        help="'report' - report for log(s), 'rollup' - report for --from/--to days from snapshots, "
+                             "'query' - ad-hoc statistics from the log index")
     parser.add_argument('--config', default="./config.json", help="Set path to 'config' file")
-    args = parser.parse_args()
-
-    return args.config
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to parse log")
+    parser.add_argument('--from', dest='date_from', type=parse_date_arg, help="Batch mode: first log date YYYYMMDD")
+    parser.add_argument('--to', dest='date_to', type=parse_date_arg, help="Batch mode: last log date YYYYMMDD")
+    parser.add_argument('--all-missing', action='store_true', help="Batch mode: all logs without report")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="Batch mode: logs processed at once")
+    parser.add_argument('--output', help="Rollup: report path")
+    parser.add_argument('--follow', action='store_true', help="Tail current log and re-render rolling-window reports")
+    parser.add_argument('--serve', action='store_true', help="Serve statistics over HTTP (/top, /url) until stopped")
+    parser.add_argument('--profile', nargs='?', const="log_analyzer.prof", default=None, metavar="PATH",
+                        help="Run under cProfile and tracemalloc, dump cProfile stats to PATH")
+    parser.add_argument('--top', type=int, default=10, help="Query: number of urls")
+    parser.add_argument('--sort', choices=list(LogsAggregate.SORT_COLUMNS), default="time_sum", help="Query: order")
+    parser.add_argument('--prefix', help="Query: only urls starting with prefix")
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat, help="Query: from $time_local, 2017-06-29T03:00")
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat, help="Query: until $time_local (exclusive)")
+    parser.add_argument('--status', help="Query: status class '5xx' or exact code '404'")
+    args = parser.parse_args(argv)
+
+    return args
 
 
 def get_result_config(default_config, config_path):
@@ -69,27 +1383,65 @@ def get_result_config(default_config, config_path):
 def create_logger(name, log_level=logging.DEBUG, stdout=True, file=None):
     '''
     Создает логера, есть возможность создать логера с выводом в stdout или в файл или туда и туда.
+    Логер только кладет записи в очередь (QueueHandler), в stdout и файл их пишет поток QueueListener,
+    поэтому парсинг не ждет диска. Очередь дописывается при выходе из программы (atexit).
+    В дочерних процессах (fork, пул --workers и --jobs) потока очереди нет, там логер пишет в обработчики напрямую.
     '''
 
+    import logging.handlers  # тянет socket, нужен только когда логер действительно создается
+    import atexit
+
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
     formatter = logging.Formatter('[%(asctime)s] - %(name)s - %(levelname).1s - %(message)s')
+    handlers = []
 
     if file is not None:
         fh = logging.FileHandler(file)
         fh.setLevel(log_level)
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        handlers.append(fh)
 
     if stdout:
         ch = logging.StreamHandler()
         ch.setLevel(log_level)
         ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        handlers.append(ch)
 
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(listener.queue)
+    logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def use_direct_handlers():
+        logger.removeHandler(queue_handler)
+        for handler in handlers:
+            logger.addHandler(handler)
+
+    os.register_at_fork(after_in_child=use_direct_handlers)
     return logger
 
 
+def find_logs(log_dir):
+    '''
+    Все логи 'nginx-access-ui.log-YYYYMMDD[.gz]' в указанной дериктории в порядке os.listdir.
+    '''
+
+    regex = re.compile(r'nginx-access-ui.log-([\d]{8})(.*)')
+    logs = []
+
+    for file_name in os.listdir(log_dir):
+        res = regex.search(file_name)
+        if (res is not None) and (res.group(2) == '.gz' or res.group(2) == ''):
+            date = res.group(1)  # без strptime: импорт _strptime и локали дороже всего поиска
+            f_date = datetime.datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
+            f_path = pathlib.Path(log_dir, file_name)
+            logs.append(FileSubscribe(f_date, f_path, os.path.splitext(f_path)[1]))
+
+    return logs
+
+
 def find_latest_log(log_dir, logger):
     '''
     Ищет в указанной дериктории (config["LOG_DIR"]) файл последнего лога:
@@ -99,46 +1451,97 @@ def find_latest_log(log_dir, logger):
             .\nginx-access-ui.log-20180630
             .\nginx-access-ui.log-20180701.gz
     будет выбран "nginx-access-ui.log-20180701.gz" как самый свежий.
+    Если рядом с логом есть актуальный индекс (find_log_index), его путь кладется в f_index.
     Возвращает полный путь файла.
     '''
 
     logger.info("Директория для поиска лога: {}".format(log_dir))
 
-    regex = re.compile(r'nginx-access-ui.log-([\d]{8})(.*)')
-
-    f_date_max = datetime.datetime.combine(datetime.date.min, datetime.datetime.min.time())
-    f_path_max = None
-    f_ext_max = None
+    latest_log = max(find_logs(log_dir), key=lambda log: log.f_date, default=None)
 
-    for file_name in os.listdir(log_dir):
-        res = regex.search(file_name)
-        if (res is not None) and (res.group(2) == '.gz' or res.group(2) == ''):
-            f_date = datetime.datetime.strptime(res.group(1), '%Y%m%d')
-            f_path = pathlib.Path(log_dir, file_name)
-            f_ext = os.path.splitext(f_path)[1]
-            if f_date > f_date_max:
-                f_date_max = f_date
-                f_path_max = f_path
-                f_ext_max = f_ext
-
-    if f_path_max is not None:
-        logger.info("Найден лог: {}".format(f_path_max))
-        return FileSubscribe(f_date_max, f_path_max, f_ext_max)
+    if latest_log is not None:
+        logger.info("Найден лог: {}".format(latest_log.f_path))
+        return latest_log._replace(f_index=find_log_index(latest_log, logger))
     else:
         logger.info("Файл лога не найден!")
         return None
 
 
-def get_report_path(report_dir, latest_log, logger):
+def plan_batch_jobs(log_dir, report_dir, logger, date_from=None, date_to=None, result_config=None):
+    '''
+    Пакетный режим: один раз сканирует LOG_DIR и возвращает список (лог, путь отчета)
+    для логов из диапазона дат [date_from, date_to], по которым еще нет отчета.
+    На одну дату берется один лог, логи отсортированы по дате.
+    Если передан result_config с кешем (CACHE_DIR), устаревший отчет тоже попадает в список -
+    так же, как при обработке последнего лога (get_result_render_key).
+    '''
+
+    jobs = {}
+    for log in find_logs(log_dir):
+        if (date_from is not None and log.f_date < date_from) or (date_to is not None and log.f_date > date_to):
+            continue
+        if log.f_date in jobs:
+            continue
+        render_key = get_result_render_key(result_config, log) if result_config is not None else None
+        report_path = get_report_path(report_dir, log, logger, render_key=render_key)
+        if report_path is not None:
+            jobs[log.f_date] = (log._replace(f_index=find_log_index(log, logger)), report_path)
+
+    logger.info("Логов к обработке: {}".format(len(jobs)))
+    return [jobs[f_date] for f_date in sorted(jobs)]
+
+
+def get_report_file(report_dir, latest_log):
+    return pathlib.Path(report_dir, "report-{}.html".format(latest_log.f_date.strftime('%Y.%m.%d')))
+
+
+def is_report_ready(result_config, args):
+    '''
+    Быстрая проверка для частых запусков из cron, до создания логера и любой тяжелой работы:
+    обычный запуск (без --follow/--serve/--profile, подкоманд, пакетного режима и INCREMENTAL)
+    и отчет по последнему логу уже есть. Индекс лога не проверяется, только имена файлов.
+    Если включен кеш (CACHE_DIR), отчет должен быть еще и актуальным (is_report_current): тот же лог,
+    настройки, шаблон и REPORT_SIZE.
+    '''
+
+    if (args.command != "report" or args.follow or args.serve or args.profile or result_config.get("INCREMENTAL")
+            or args.date_from or args.date_to or args.all_missing):
+        return False
+
+    try:
+        latest_log = max(find_logs(result_config["LOG_DIR"]), key=lambda log: log.f_date, default=None)
+    except (OSError, ValueError):
+        return False
+    if latest_log is None:
+        return False
+
+    report_file = get_report_file(result_config["REPORT_DIR"], latest_log)
+    if not os.path.exists(report_file):
+        return False
+    try:
+        render_key = get_result_render_key(result_config, latest_log)
+    except (OSError, ValueError):
+        return False
+    return render_key is None or is_report_current(report_file, render_key)
+
+
+def get_report_path(report_dir, latest_log, logger, incremental=False, render_key=None):
     '''
     Проверяем, существует ли отчет с таким именем в указанной dir.
     Если да, да парсинг выполнялся и прошел успешно возвращаем None, заканчиваем работу.
     Если нет, возвращаем path для записи отчета
+    В режиме incremental отчет перезаписывается по дочитанному логу, поэтому path возвращается всегда.
+    Если задан render_key (get_render_key), а отчет построен с другим ключом - отчет перезаписывается.
     '''
 
-    report_name = "report-{}.html".format(latest_log.f_date.strftime('%Y.%m.%d'))
-    report_path = pathlib.Path(report_dir, report_name)
-    if os.path.exists(report_path):
+    report_path = get_report_file(report_dir, latest_log)
+    if incremental:
+        logger.info("Отчет будет обновлен в файле: {}".format(report_path))
+        return report_path
+    elif os.path.exists(report_path) and render_key is not None and not is_report_current(report_path, render_key):
+        logger.info("Отчет устарел (сменились лог, настройки или шаблон), будет перезаписан: {}".format(report_path))
+        return report_path
+    elif os.path.exists(report_path):
         logger.info("Файл отчета уже существует: {}".format(report_path))
         return None
     else:
@@ -146,16 +1549,14 @@ def get_report_path(report_dir, latest_log, logger):
         return report_path
 
 
-def get_parsed_line(regex, line, logger):
+def get_parsed_line(regex, line):
 
     try:
         res_regex = regex.search(line.decode("utf-8"))
     except UnicodeError:
-        logger.exception("Не удалось декодировать запись: {}".format(line))
         return LogSubscribe(None, None, "error")
 
     if res_regex is None:
-        logger.debug("Не удалось распарсить запись: {}".format(line))
         return LogSubscribe(None, None, "bad_log")
 
     url = res_regex.group(1).strip()
@@ -164,176 +1565,2195 @@ def get_parsed_line(regex, line, logger):
     return LogSubscribe(url, request_time, None)
 
 
-def get_logs_statistics(error_limits, latest_log, logger):
+class GzipLineReader:
+    '''
+    Конвейерное чтение .gz лога.
+    Отдельный поток распаковывает файл крупными блоками в ограниченную очередь, а парсинг
+    забирает из нее строки (без b"\\n"). zlib отпускает GIL, поэтому распаковка и парсинг идут параллельно.
+    Если архив состоит из нескольких gzip member-ов (склеенные logrotate/pigz архивы) и workers > 1,
+    member-ы после первого распаковываются параллельно в пуле потоков: каждый в свою очередь
+    на member_queue_size блоков, а в общую очередь блоки уходят по порядку member-ов,
+    так что в памяти не больше workers * 2 таких очередей.
+    В stats копится время распаковки и ожидания очереди, чтобы отдельно считать скорость распаковки и парсинга.
     '''
-    Обрабатываем фал лога:
-        1. Читаем строку лога
-        2. Парсим строку регуляркой
-        3. Ищем url в словаре по ключу! Добавляем строку в словарь с первичной статистикой если такой url еще нет.
-           Обновляем статистику если строка с таким url уже есть в словаре
-           Cтруктура словаря {url1:{stat1}, url2:{stat2}, url3:{stat3} ...}
-        4. Чекаем на колво ошибо парсинга. Если ошибок больше установленого ERRORS_LIMIT_PERC в config выходим
-        5. Выгружаем из dict.values() -> list
-        6. Дописываем статистику
-        7. Сортируем list
-        8. Возвращаем статистику по логам
-    '''
-
-    common_stat = {}
-    time_sum_all_req = 0
-    bad_logs = 0
-    number_of_logs = 0
-    regex = re.compile(r'(?:GET|POST|HEAD|PUT|OPTIONS|DELETE).(.*).HTTP/.* (\d{1,6}[.]\d+)')
-    log_path = latest_log.f_path
 
-    try:
-        log_file = gzip.open(log_path, 'rb') if latest_log.f_ext == ".gz" else open(log_path, 'rb')
-    except OSError:
-        logger.error("Не удалось открыть файл лога: {}".format(log_path))
+    GZIP_MAGIC = b"\x1f\x8b\x08"
+    _END = object()
+
+    def __init__(self, log_path, workers=1, block_size=1 << 20, queue_size=16, member_queue_size=4):
+        self.log_path = log_path
+        self.workers = workers
+        self.block_size = block_size
+        self.member_queue_size = member_queue_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.stats = {"raw_bytes": 0, "bytes": 0, "members": 0, "decompress_time": 0.0, "wait_time": 0.0}
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._decompress, daemon=True)
+        thread.start()
+        tail = b""
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                block = self.queue.get()
+                self.stats["wait_time"] += time.perf_counter() - wait_start
+                if block is self._END:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                lines = (tail + block).split(b"\n")
+                tail = lines.pop()
+                yield from lines
+            if tail:
+                yield tail
+        finally:
+            self.stop.set()
+            thread.join()
+
+    def _put(self, item, target=None, cancel=None):
+        target = self.queue if target is None else target
+        while not self.stop.is_set() and not (cancel is not None and cancel.is_set()):
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decompress(self):
+        try:
+            offset = self._decompress_stream(first_member=self.workers > 1)
+            if offset is not None:
+                self._decompress_members(self.iter_member_offsets(offset), offset)
+            self._put(self._END)
+        except Exception as err:
+            self._put(err)
+
+    def _decompress_stream(self, first_member=False):
+        '''
+        Последовательная распаковка файла. Если first_member и после первого member-а в файле есть еще данные,
+        останавливается на них и возвращает их смещение - остальные member-ы распаковываются параллельно.
+        Так файл из одного member-а (обычный logrotate) не сканируется в поисках границ member-ов.
+        '''
+
+        with open(self.log_path, 'rb') as gz_file:
+            decompressor = zlib.decompressobj(wbits=31)
+            self.stats["members"] += 1
+            position = 0
+            while not self.stop.is_set():
+                raw = gz_file.read(self.block_size)
+                if not raw:
+                    break
+                position += len(raw)
+                read_size = len(raw)
+                start = time.perf_counter()
+                blocks = []
+                while raw:
+                    if decompressor.eof:
+                        raw = raw.lstrip(b"\x00")  # нули после member-а допустимы, как в gzip.open и zcat
+                        if not raw or first_member:
+                            break
+                        decompressor = zlib.decompressobj(wbits=31)
+                        self.stats["members"] += 1
+                    blocks.append(decompressor.decompress(raw))
+                    raw = decompressor.unused_data
+                block = b"".join(blocks)
+                self.stats["decompress_time"] += time.perf_counter() - start
+                self.stats["raw_bytes"] += read_size - len(raw)
+                self.stats["bytes"] += len(block)
+                if block and not self._put(block):
+                    return None
+                if raw:
+                    return position - len(raw)
+            if not decompressor.eof:
+                raise EOFError("Сжатый файл закончился раньше конца потока: {}".format(self.log_path))
         return None
 
-    for line in log_file:
-        if DEBUG_MODE and number_of_logs == TEST_CASE:  # Использую для отладки на частичной выборке
+    def iter_member_offsets(self, start=0):
+        '''
+        Кандидаты на начало gzip member-а - вхождения заголовка gzip в файле начиная со start.
+        Файл сканируется лениво, по мере того как пул забирает кандидатов, а не целиком до распаковки.
+        Ложные кандидаты (заголовок внутри сжатых данных) отсеиваются при распаковке.
+        '''
+
+        with open(self.log_path, 'rb') as gz_file:
+            gz_file.seek(start)
+            position = start
+            overlap = b""
+            last = None
+            while True:
+                raw = gz_file.read(self.block_size)
+                if not raw:
+                    break
+                data = overlap + raw
+                base = position - len(overlap)
+                found = data.find(self.GZIP_MAGIC)
+                while found != -1:
+                    if base + found != last:
+                        last = base + found
+                        yield last
+                    found = data.find(self.GZIP_MAGIC, found + 1)
+                position += len(raw)
+                overlap = data[-(len(self.GZIP_MAGIC) - 1):]
+
+    def _decompress_member(self, offset, chunks, cancel):
+        '''
+        Распаковывает один member с заданного смещения блоками в его собственную ограниченную очередь chunks,
+        так что память на member в полете не больше member_queue_size блоков, а не весь member целиком.
+        Последним кладет (_END, конец member-а) или (_END, None), если с этого смещения member не начинается.
+        Возвращает время распаковки в этом потоке - в stats его складывает поток, который забирает member-ы.
+        '''
+
+        decompress_time = 0.0
+        decompressor = zlib.decompressobj(wbits=31)
+        position, end = offset, None
+        try:
+            with open(self.log_path, 'rb') as gz_file:
+                gz_file.seek(offset)
+                while not decompressor.eof and not cancel.is_set():
+                    raw = gz_file.read(self.block_size)
+                    if not raw:
+                        break
+                    start = time.perf_counter()
+                    block = decompressor.decompress(raw)
+                    decompress_time += time.perf_counter() - start
+                    position += len(raw)
+                    if block and not self._put(block, chunks, cancel):
+                        break
+                if decompressor.eof:
+                    end = self._skip_padding(gz_file, position - len(decompressor.unused_data))
+        except zlib.error:
+            pass
+        finally:
+            self._put((self._END, end), chunks, cancel)
+        return decompress_time
+
+    def _skip_padding(self, gz_file, offset):
+        '''
+        Смещение первого ненулевого байта начиная с offset (или размер файла): gzip допускает нули после member-а.
+        '''
+
+        gz_file.seek(offset)
+        while True:
+            raw = gz_file.read(self.block_size)
+            padding = len(raw) - len(raw.lstrip(b"\x00"))
+            offset += padding
+            if padding < len(raw) or not raw:
+                return offset
+
+    def _decompress_members(self, members, expected=0):
+        import concurrent.futures  # тянет logging, threading, multiprocessing - только когда нужен пул
+
+        size = os.path.getsize(self.log_path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            window = collections.deque()
+            candidates = iter(members)
+            try:
+                while True:
+                    for offset in itertools.islice(candidates, self.workers * 2 - len(window)):
+                        chunks, cancel = queue.Queue(maxsize=self.member_queue_size), threading.Event()
+                        future = executor.submit(self._decompress_member, offset, chunks, cancel)
+                        window.append((offset, chunks, cancel, future))
+                    if not window:
+                        break
+                    offset, chunks, cancel, future = window.popleft()
+                    if offset == expected:
+                        expected = self._take_member(offset, chunks, expected)
+                    else:
+                        cancel.set()  # ложный кандидат внутри уже распакованного member-а
+                    self.stats["decompress_time"] += future.result()
+                    if expected is None:
+                        return
+            finally:
+                for _, _, cancel, _ in window:
+                    cancel.set()
+        if expected != size:
+            raise EOFError("Не удалось распаковать файл целиком: {}".format(self.log_path))
+
+    def _take_member(self, offset, chunks, expected):
+        '''
+        Перекладывает блоки member-а, начинающегося на ожидаемом смещении, в общую очередь по мере распаковки.
+        Возвращает смещение следующего member-а, expected - если member не распаковался, None - если чтение остановили.
+        '''
+
+        while True:
+            try:
+                block = chunks.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return None
+                continue
+            if isinstance(block, tuple):
+                break
+            self.stats["bytes"] += len(block)
+            if not self._put(block):
+                return None
+        end = block[1]
+        if end is None:
+            return expected
+        self.stats["members"] += 1
+        self.stats["raw_bytes"] += end - offset
+        return end
+
+
+def aggregate_log_lines(log_lines, aggregate, logger):
+    '''
+    Парсим строки лога регуляркой и добавляем их в aggregate (LogsAggregate).
+    Плохие и недекодируемые строки идут в aggregate.add_bad_line, в лог по строке ничего не пишется.
+    '''
+
+    regex = re.compile(r'(?:GET|POST|HEAD|PUT|OPTIONS|DELETE).(.*).HTTP/.* (\d{1,6}[.]\d+)')
+
+    for line in log_lines:
+        if DEBUG_MODE and aggregate.number_of_logs == TEST_CASE:  # Использую для отладки на частичной выборке
             break
 
-        number_of_logs += 1
-        parsed_line = get_parsed_line(regex, line, logger)
+        aggregate.number_of_logs += 1
+        parsed_line = get_parsed_line(regex, line)
         status = parsed_line.status
 
         if status == "bad_log":
-            bad_logs += 1
+            aggregate.add_bad_line("format", line)
             continue
         elif status == "error":
-            return None
+            aggregate.add_bad_line("decode", line)
+            continue
 
-        url = parsed_line.url
-        request_time = float(parsed_line.request_time)
-        time_sum_all_req += request_time
-        url_stat = common_stat.get(url)
-
-        if url_stat is not None:
-            url_stat["count"] += 1
-            url_stat["time_sum"] = round(url_stat["time_sum"] + request_time, 3)
-            url_stat["time_max"] = round(request_time if request_time > url_stat["time_max"] else
-                                         url_stat["time_max"], 3)
-            url_stat["time_lst"].append(request_time)
-            url_stat["time_med"] = round(statistics.median(url_stat["time_lst"]), 3)
-        else:
-            common_stat[url] = {
-                "url": url,
-                "count": 1,
-                "count_perc": round((1 / number_of_logs) * 100, 3),
-                "time_avg": round(request_time, 3),
-                "time_max": round(request_time, 3),
-                "time_med": round(statistics.median([request_time]), 3),
-                "time_perc": round(request_time / time_sum_all_req * 100, 3),
-                "time_sum": round(request_time, 3),
-                "time_lst": [request_time]
-            }
+        aggregate.add(parsed_line.url, float(parsed_line.request_time))
+
+    return True
 
-    log_file.close()
-    logger.debug("{} : логов прочитано".format(number_of_logs))
-    logger.debug("{} : логов не удалось обработать".format(bad_logs))
 
-    if (bad_logs / number_of_logs) * 100 > error_limits:
-        logger.error("Сменился формат логирования!")
-        return None
+ERROR_CHECK_LINES = 1 << 16
+ERROR_CHECK_BYTES = 8 << 20
+PREFLIGHT_Z = 3.0
+
 
-    common_stat_as_lst = list(common_stat.values())
+def get_min_line_size(log_format):
+    '''
+    Длина самой короткой строки (с \n), которую принимает LogFormatParser для log_format: литералы формата,
+    "GET  HTTP/" за $request и цифра за $request_time, остальные переменные могут быть пустыми.
+    '''
 
-    for url_stat in common_stat_as_lst:
-        url_stat["count_perc"] = round((url_stat["count"] / number_of_logs) * 100, 3)
-        url_stat["time_perc"] = round(url_stat["time_sum"] / time_sum_all_req * 100, 3)
-        url_stat["time_avg"] = round(url_stat["time_sum"] / url_stat["count"], 3)
-        del url_stat["time_lst"]
+    variables = {"request": len("GET  HTTP/"), "request_time": 1}
+    return sum(variables.pop(token[1:], 0) if token.startswith("$") else len(token.encode("utf-8"))
+               for token in re.split(r'(\$\w+)', log_format)) + 1
 
-    return sorted(common_stat_as_lst, key=lambda x: x["time_sum"], reverse=True)
 
+MIN_LINE_SIZES = {                           # Самая короткая строка (с \n), которую принимает парсер
+    "regex": len(b'GET  HTTP/ 0.0\n'),       # Метод, два любых символа, HTTP/, " цифры.цифры"
+    "fast": len(b'"GET HTTP/ 0\n'),          # Кавычка, метод, " HTTP/", последнее поле с цифры
+}
+CHECKPOINT_VERSION = 6
+URL_DECODE_CACHE_SIZE = 1 << 20
+LOG_METHODS = frozenset([b"GET", b"POST", b"HEAD", b"PUT", b"OPTIONS", b"DELETE"])
 
-def render_html_report(result_config, report_path, logs_statistic, logger):
+
+def aggregate_log_lines_fast(log_lines, aggregate, logger):
     '''
-    Дампим статистику в json строку.
-    Копируем шаблон отчета в указанную в config dir уже с нужным именем
-    Рендерим отчет
+    Быстрый парсер формата ui_short, работает прямо с bytes без регулярки:
+        1. "$request" - между первыми двумя кавычками, url - между методом и последним " HTTP/"
+        2. $request_time - последнее поле строки
+        3. url декодируется в str только один раз, когда встречается впервые
+        4. Строка сразу добавляется в aggregate, без промежуточного LogSubscribe
+    Кеш декодированных url ограничен URL_DECODE_CACHE_SIZE, чтобы память не росла с числом уникальных url.
+    Плохие строки (и url не в utf-8) идут в aggregate.add_bad_line с причиной, разбор продолжается.
     '''
 
-    table_json = json.dumps(logs_statistic[:result_config["REPORT_SIZE"]])
-    template_path = result_config["TEMPLATE_PATH"]
+    url_cache = {}
+    methods = LOG_METHODS
+    add, add_bad_line = aggregate.add, aggregate.add_bad_line
+
+    for line in log_lines:
+        if DEBUG_MODE and aggregate.number_of_logs == TEST_CASE:  # Использую для отладки на частичной выборке
+            break
+
+        aggregate.number_of_logs += 1
+        start = line.find(b'"') + 1
+        end = line.find(b'"', start)
+        space = line.find(b" ", start, end)
+        http = line.rfind(b" HTTP/", start, end)
+        time_end = len(line) - 1 if line.endswith(b"\n") else len(line)
+        token = line[line.rfind(b" ", 0, time_end) + 1:time_end]
+
+        if not start or space < 0 or http < space or line[start:space] not in methods or not token[:1].isdigit():
+            add_bad_line("format", line)
+            continue
 
-    with open(report_path, 'w', encoding='utf-8') as report, open(template_path, 'r', encoding='utf-8') as tmpl:
-        tmpl_obj = string.Template(tmpl.read())
         try:
-            render_html = tmpl_obj.safe_substitute(table_json=table_json)
-        except Exception:
-            logger.error("Не удалось отрендерить шаблон!")
-            return False
-        report.write(render_html)
+            request_time = float(token)
+        except ValueError:
+            add_bad_line("request_time", line)
+            continue
+
+        url_bytes = line[space + 1:http].strip()
+        url = url_cache.get(url_bytes)
+        if url is None:
+            if len(url_cache) >= URL_DECODE_CACHE_SIZE:
+                url_cache.clear()
+            try:
+                url = url_cache[url_bytes] = url_bytes.decode("utf-8")
+            except UnicodeError:
+                add_bad_line("decode", line)
+                continue
+
+        add(url, request_time)
+
     return True
 
 
-def main():
+def aggregate_buffer_fast(buffer, start, end, aggregate, logger):
     '''
-    1. Получаем результирующий config
-    2. Создаем логера
-    3. Проверяем параметры результирующего config
-    4. Ищем файл последнего лога, если не находим конец
-    5. Проверяем есть ли уже отчет в указанной папке, если находим конец
-    6. Получаем статистику по логам
-    7. Создаем отчет
+    aggregate_log_lines_fast для строк буфера (mmap) в диапазоне байт [start, end):
+    границы строк и полей ищутся find/rfind прямо в буфере по смещениям, bytes объект на строку
+    не создается - копируются только метод, url и request_time (и плохие строки для BadLines).
     '''
 
-    str_start = "*************** Программа запущена ***************"
-    str_finish = "********************* Конец **********************"
-    star_time = time.time()
+    url_cache = {}
+    methods = LOG_METHODS
+    add, add_bad_line = aggregate.add, aggregate.add_bad_line
+    find, rfind = buffer.find, buffer.rfind
+    position = start
 
-    config_path = get_sys_args()
-    if not os.path.exists(config_path):
-        sys.exit(1)
+    while position < end:
+        if DEBUG_MODE and aggregate.number_of_logs == TEST_CASE:  # Использую для отладки на частичной выборке
+            break
 
-    result_config = get_result_config(config, config_path)
-    if result_config is None:
-        sys.exit(1)
+        line_start = position
+        line_end = find(b"\n", line_start, end)
+        newline = line_end >= 0
+        if not newline:
+            line_end = end
+        position = line_end + 1
+
+        aggregate.number_of_logs += 1
+        quote = find(b'"', line_start, line_end)
+        request_start = quote + 1
+        request_end = find(b'"', request_start, line_end) if quote >= 0 else -1
+        if request_end < 0:
+            request_end = line_end if newline else line_end - 1   # как срез line[start:-1] в быстром парсере
+        space = find(b" ", request_start, request_end)
+        http = rfind(b" HTTP/", request_start, request_end)
+        time_start = rfind(b" ", line_start, line_end) + 1
+        token = buffer[time_start or line_start:line_end]
+
+        if quote < 0 or space < 0 or http < space or buffer[request_start:space] not in methods or \
+                not token[:1].isdigit():
+            add_bad_line("format", buffer[line_start:position])
+            continue
 
-    log_path = result_config.get('SELF_LOG_PATH')
-    if not os.path.exists(log_path):
-        log_path = None
+        try:
+            request_time = float(token)
+        except ValueError:
+            add_bad_line("request_time", buffer[line_start:position])
+            continue
 
-    logger = create_logger(__name__, file=log_path)
-    logger.info(str_start)
+        url_bytes = buffer[space + 1:http].strip()
+        url = url_cache.get(url_bytes)
+        if url is None:
+            if len(url_cache) >= URL_DECODE_CACHE_SIZE:
+                url_cache.clear()
+            try:
+                url = url_cache[url_bytes] = url_bytes.decode("utf-8")
+            except UnicodeError:
+                add_bad_line("decode", buffer[line_start:position])
+                continue
 
-    latest_log = find_latest_log(result_config["LOG_DIR"], logger)
-    if latest_log is None:
-        logger.info(str_finish)
-        sys.exit(0)
+        add(url, request_time)
 
-    report_path = get_report_path(result_config["REPORT_DIR"], latest_log, logger)
-    if report_path is None:
-        logger.info(str_finish)
-        sys.exit(0)
+    return True
 
-    try:
-        logs_statistic = get_logs_statistics(result_config["ERRORS_LIMIT_PERC"], latest_log, logger)
-    except Exception:
-        logger.error("Аварийное завершение программы!!!")
-        logger.info(str_finish)
+
+class LogFormatParser:
+    '''
+    Парсер, собранный из строки nginx log_format (compile_log_format) в одну bytes регулярку:
+        1. Литералы формата экранируются как есть
+        2. Нужные поля захватываются группами: $request (метод и url), $request_time и fields
+        3. Ненужные поля пропускаются без захвата: [^c]*, где c - первый символ следующего литерала
+    Строки разбираются как в aggregate_log_lines_fast: метод из LOG_METHODS, url - до последнего " HTTP/",
+    url декодируется один раз. Если заданы fields, их значения передаются в aggregate.add (срезы GroupBy).
+    Объект pickle-ится строкой формата, в процессе-воркере берется из кеша compile_log_format,
+    поэтому регулярка компилируется один раз на процесс.
+    '''
+
+    FIELDS = ("request", "request_time", "method", "status", "body_bytes_sent", "upstream_response_time",
+              "time_local")
+
+    def __init__(self, log_format, fields=()):
+        self.log_format = log_format
+        self.fields = tuple(fields)
+        self.min_line_size = get_min_line_size(log_format)
+
+        tokens = [token for token in re.split(r'(\$\w+)', log_format) if token]
+        variables = {token[1:] for token in tokens if token.startswith("$")}
+        for field in ("request", "request_time") + self.fields:
+            if field not in self.FIELDS:
+                raise ValueError("Поле ${} не поддерживается, доступны: {}".format(field, ", ".join(self.FIELDS)))
+            if field not in variables and field != "method":
+                raise ValueError("В log_format нет поля ${}".format(field))
+
+        pattern = []
+        group_names = []
+        for index, token in enumerate(tokens):
+            if not token.startswith("$"):
+                pattern.append(re.escape(token.encode("utf-8")))
+                continue
+
+            following = tokens[index + 1] if index + 1 < len(tokens) else ""
+            stop = re.escape(following[:1].encode("utf-8")) if following and not following.startswith("$") else rb'\n'
+            value = rb'[^' + stop + rb']*'
+            name = token[1:]
+
+            if name == "request" and "request" not in group_names:
+                methods = b"|".join(sorted(LOG_METHODS))
+                pattern.append(rb'(' + methods + rb') (' + value + rb') HTTP/' + value)
+                group_names.extend(["method", "url"])
+            elif name == "request_time" and "request_time" not in group_names:
+                pattern.append(rb'([0-9]' + value + rb')')
+                group_names.append(name)
+            elif name in self.fields and name not in group_names:
+                pattern.append(rb'(' + value + rb')')
+                group_names.append(name)
+            else:
+                pattern.append(value)
+
+        self.pattern = b"".join(pattern) + rb'\r?\n?\Z'
+        self.groups = {name: index + 1 for index, name in enumerate(group_names)}
+        self.field_groups = tuple(self.groups[field] for field in self.fields)
+
+    @functools.cached_property
+    def regex(self):
+        return re.compile(self.pattern)  # при первом разборе, а не при импорте (LOG_PARSERS)
+
+    def __reduce__(self):
+        return compile_log_format, (self.log_format, self.fields) if self.fields else (self.log_format,)
+
+    def extract(self, line):
+        '''
+        Поля строки {имя: bytes} (method, url, request_time и fields) или None, если строка не подходит под формат.
+        '''
+
+        match = self.regex.match(line)
+        return None if match is None else {name: match.group(index) for name, index in self.groups.items()}
+
+    def __call__(self, log_lines, aggregate, logger):
+        '''
+        Тот же контракт, что у парсеров из LOG_PARSERS: строки добавляются в aggregate,
+        плохие строки (и url не в utf-8) - в aggregate.add_bad_line.
+        '''
+
+        match_line = self.regex.match
+        return self.aggregate_matches((match_line(line) or line for line in log_lines), aggregate, logger)
+
+    def parse_buffer(self, buffer, start, end, aggregate, logger):
+        '''
+        То же для строк буфера (mmap) в диапазоне [start, end): регулярка применяется по смещениям
+        (match(buffer, pos, endpos)), bytes создаются только для url и request_time (и для плохих строк).
+        '''
+
+        return self.aggregate_matches(self.match_buffer(buffer, start, end), aggregate, logger)
+
+    def match_buffer(self, buffer, start, end):
+        match_line, find = self.regex.match, buffer.find
+        position = start
+        while position < end:
+            line_end = find(b"\n", position, end)
+            if line_end < 0:
+                line_end = end
+            yield match_line(buffer, position, line_end) or buffer[position:line_end]
+            position = line_end + 1
+
+    def aggregate_matches(self, matches, aggregate, logger):
+        '''
+        Добавляет в aggregate результаты match по строкам, для неподошедшей строки вместо match - сама строка.
+        '''
+
+        url_cache = {}
+        url_group, time_group = self.groups["url"], self.groups["request_time"]
+        field_groups = self.field_groups
+        add, add_bad_line = aggregate.add, aggregate.add_bad_line
+
+        for match in matches:
+            if DEBUG_MODE and aggregate.number_of_logs == TEST_CASE:  # Использую для отладки на частичной выборке
+                break
+
+            aggregate.number_of_logs += 1
+            if isinstance(match, bytes):
+                add_bad_line("format", match)
+                continue
+
+            url_bytes, token = match.group(url_group, time_group)
+            try:
+                request_time = float(token)
+            except ValueError:
+                add_bad_line("request_time", match.group(0))
+                continue
+
+            url_bytes = url_bytes.strip()
+            url = url_cache.get(url_bytes)
+            if url is None:
+                if len(url_cache) >= URL_DECODE_CACHE_SIZE:
+                    url_cache.clear()
+                try:
+                    url = url_cache[url_bytes] = url_bytes.decode("utf-8")
+                except UnicodeError:
+                    add_bad_line("decode", match.group(0))
+                    continue
+
+            if field_groups:
+                add(url, request_time, match.group(0, *field_groups)[1:])
+            else:
+                add(url, request_time)
+
+        return True
+
+
+@functools.lru_cache(maxsize=32)
+def compile_log_format(log_format, fields=()):
+    '''
+    Собирает (один раз на процесс для пары log_format, fields) LogFormatParser из строки nginx log_format.
+    '''
+
+    return LogFormatParser(log_format, fields)
+
+
+LOG_PARSERS = {
+    "regex": aggregate_log_lines,
+    "fast": aggregate_log_lines_fast,
+    "format": compile_log_format(LOG_FORMAT_UI_SHORT)
+}
+
+
+def get_log_parser(parser):
+    '''
+    parser - имя из LOG_PARSERS или готовый парсер (LogFormatParser).
+    '''
+
+    return LOG_PARSERS[parser] if isinstance(parser, str) else parser
+
+
+BUFFER_PARSERS = {
+    aggregate_log_lines_fast: aggregate_buffer_fast
+}
+
+
+def get_buffer_parser(parser):
+    '''
+    Вариант парсера для разбора строк прямо в буфере (mmap) по смещениям или None, если его нет ("regex").
+    '''
+
+    parse = get_log_parser(parser)
+    return BUFFER_PARSERS.get(parse) or getattr(parse, "parse_buffer", None)
+
+
+def get_result_parser(result_config):
+    '''
+    Парсер из config: для "format" - собранный из LOG_FORMAT, иначе имя из LOG_PARSERS.
+    Срезы GROUP_BY требуют полей строки, поэтому с ними всегда используется парсер из LOG_FORMAT.
+    '''
+
+    group_by = get_group_by(result_config)
+    if group_by is not None:
+        return compile_log_format(result_config.get("LOG_FORMAT", LOG_FORMAT_UI_SHORT), group_by.fields)
+    if result_config["LOG_PARSER"] == "format":
+        return compile_log_format(result_config.get("LOG_FORMAT", LOG_FORMAT_UI_SHORT))
+    return result_config["LOG_PARSER"]
+
+
+def get_error_perc(bad_logs, number_of_logs):
+    '''
+    Доля ошибок парсинга в %, для пустого лога - 0.
+    '''
+
+    return bad_logs / number_of_logs * 100 if number_of_logs else 0.0
+
+
+def get_error_rate_bounds(bad_logs, number_of_logs, z=PREFLIGHT_Z):
+    '''
+    Доверительный интервал Уилсона для доли ошибок парсинга в % по выборке.
+    '''
+
+    if not number_of_logs:
+        return 0.0, 100.0
+    rate = bad_logs / number_of_logs
+    denominator = 1 + z * z / number_of_logs
+    center = rate + z * z / (2 * number_of_logs)
+    spread = z * math.sqrt(rate * (1 - rate) / number_of_logs + z * z / (4 * number_of_logs * number_of_logs))
+    return (center - spread) / denominator * 100, (center + spread) / denominator * 100
+
+
+def read_sample_lines(latest_log, samples=32, lines_per_sample=32, block_size=1 << 16):
+    '''
+    Выборка строк для предварительной проверки формата:
+        несжатый лог - по lines_per_sample строк с samples равномерно разнесенных смещений (seek)
+        .gz лог - строки из первых блоков, распаковываются только пока не наберется samples * lines_per_sample
+    '''
+
+    sample_size = samples * lines_per_sample
+    log_path = latest_log.f_path
+
+    if latest_log.f_ext == ".gz":
+        data = b""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        unused_data = b""
+        with open(log_path, 'rb') as log_file:
+            while data.count(b"\n") < sample_size:
+                block = unused_data or log_file.read(block_size)
+                if not block:
+                    break
+                if decompressor.eof:
+                    block = block.lstrip(b"\x00")  # нули после member-а, как в GzipLineReader
+                    if not block:
+                        unused_data = b""
+                        continue
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(block)
+                unused_data = decompressor.unused_data
+        return data.split(b"\n")[:-1][:sample_size]
+
+    sample = []
+    size = os.path.getsize(log_path)
+    with open(log_path, 'rb') as log_file:
+        for offset in sorted({size * i // samples for i in range(samples)}):
+            if offset < log_file.tell():
+                continue
+            log_file.seek(offset)
+            if offset:
+                log_file.readline()
+            sample.extend(line for line in itertools.islice(log_file, lines_per_sample) if line.endswith(b"\n"))
+    return sample
+
+
+def check_log_format(latest_log, error_limits, logger, parser="fast"):
+    '''
+    Предварительная проверка формата по выборке строк (read_sample_lines), занимает миллисекунды.
+    Если даже нижняя граница доверительного интервала доли ошибок выше error_limits - формат точно сменился,
+    возвращаем False. Если выборку не удалось разобрать (ошибка декодирования) - решает полный проход.
+    '''
+
+    sample = LogsAggregate()
+    if not get_log_parser(parser)(read_sample_lines(latest_log), sample, logger) or not sample.number_of_logs:
+        return True
+
+    lower, upper = get_error_rate_bounds(sample.bad_logs, sample.number_of_logs)
+    logger.debug("Проверка формата: {} ошибок в {} строках, доля ошибок {:.1f}%..{:.1f}%".format(
+        sample.bad_logs, sample.number_of_logs, lower, upper))
+    return lower <= error_limits
+
+
+def error_limit_exceeded(aggregate, error_limits, remaining_bytes, min_line_size):
+    '''
+    True, если error_limits уже нельзя выполнить: даже если все оставшиеся байты - хорошие строки
+    минимальной длины (min_line_size, с \n), доля ошибок по всему логу будет больше error_limits.
+    '''
+
+    max_lines = aggregate.number_of_logs + (remaining_bytes + 1) // min_line_size  # последняя строка - без \n
+    return aggregate.bad_logs * 100 > error_limits * max_lines
+
+
+def parse_buffer_with_error_limit(parse_buffer, buffer, start, end, aggregate, logger, error_limits, min_line_size):
+    '''
+    parse_with_error_limit для буфера: разбираем порциями по ERROR_CHECK_BYTES байт (по границам строк).
+    '''
+
+    position = start
+    while position < end:
+        block_end = buffer.find(b"\n", min(position + ERROR_CHECK_BYTES, end) - 1, end) + 1 or end
+        if not parse_buffer(buffer, position, block_end, aggregate, logger):
+            return False
+        position = block_end
+        if error_limit_exceeded(aggregate, error_limits, end - position, min_line_size):
+            logger.debug("Доля ошибок уже не уложится в {}%, чтение остановлено на {} строке".format(
+                error_limits, aggregate.number_of_logs))
+            break
+    return True
+
+
+def aggregate_plain_log(log_path, parser, aggregate, logger, start=0, end=None, error_limits=None, use_mmap=True):
+    '''
+    Парсит несжатый лог (диапазон байт [start, end), end=None - до конца файла) в aggregate.
+    Если у парсера есть вариант для буфера (get_buffer_parser), файл отображается в память (mmap)
+    и строки разбираются прямо в нем по смещениям, без bytes объекта на каждую строку.
+    Иначе (или use_mmap=False) файл читается по строкам.
+    Если задан error_limits, чтение останавливается, как только лимит ошибок уже нельзя выполнить.
+    '''
+
+    parse = get_log_parser(parser)
+    parse_buffer = get_buffer_parser(parser) if use_mmap else None
+    min_line_size = getattr(parse, "min_line_size", None) or MIN_LINE_SIZES.get(parser, 1)
+
+    with open(log_path, 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        chunk_end = size if end is None else min(end, size)
+
+        if parse_buffer is None or chunk_end <= start:
+            log_lines = log_file if start == 0 and end is None else read_file_chunk(log_file, start, chunk_end)
+            if error_limits is None:
+                return parse(log_lines, aggregate, logger)
+            return parse_with_error_limit(parse, log_file, log_lines, aggregate, logger, error_limits, chunk_end,
+                                          min_line_size)
+
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(buffer, "madvise"):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            if error_limits is None:
+                return parse_buffer(buffer, start, chunk_end, aggregate, logger)
+            return parse_buffer_with_error_limit(parse_buffer, buffer, start, chunk_end, aggregate, logger,
+                                                 error_limits, min_line_size)
+
+
+def parse_with_error_limit(parse, log_file, log_lines, aggregate, logger, error_limits, end, min_line_size):
+    '''
+    Парсинг порциями по ERROR_CHECK_LINES строк: после каждой порции проверяем, можно ли еще уложиться
+    в error_limits (error_limit_exceeded по позиции в файле), если нет - дальше лог не читаем.
+    '''
+
+    log_lines = iter(log_lines)
+    while True:
+        number_of_logs = aggregate.number_of_logs
+        if not parse(itertools.islice(log_lines, ERROR_CHECK_LINES), aggregate, logger):
+            return False
+        if aggregate.number_of_logs == number_of_logs:
+            return True
+        if error_limit_exceeded(aggregate, error_limits, max(end - log_file.tell(), 0), min_line_size):
+            logger.debug("Доля ошибок уже не уложится в {}%, чтение остановлено на {} строке".format(
+                error_limits, aggregate.number_of_logs))
+            return True
+
+
+def get_file_chunks(log_path, workers, start=0, end=None):
+    '''
+    Делит диапазон байт файла [start, end) на workers кусков, границы выравниваются по концу строки.
+    '''
+
+    end = os.path.getsize(log_path) if end is None else end
+    bounds = [start]
+
+    with open(log_path, 'rb') as log_file:
+        for i in range(1, workers):
+            offset = max(start + (end - start) * i // workers, bounds[-1])
+            if offset > 0:
+                log_file.seek(offset - 1)
+                log_file.readline()
+            bounds.append(min(max(log_file.tell(), bounds[-1]), end))
+
+    bounds.append(end)
+    return [(chunk_start, chunk_end) for chunk_start, chunk_end in zip(bounds, bounds[1:]) if chunk_end > chunk_start]
+
+
+def read_file_chunk(log_file, start, end):
+    '''
+    Генератор строк файла из диапазона байт [start, end).
+    '''
+
+    log_file.seek(start)
+    position = start
+    for line in log_file:
+        if position >= end:
+            break
+        position += len(line)
+        yield line
+
+
+def get_complete_size(log_path, start=0, block_size=1 << 16):
+    '''
+    Размер файла до конца последней полной строки: недописанная строка растущего лога не читается.
+    '''
+
+    with open(log_path, 'rb') as log_file:
+        end = log_file.seek(0, os.SEEK_END)
+        while end > start:
+            block_start = max(end - block_size, start)
+            log_file.seek(block_start)
+            newline = log_file.read(end - block_start).rfind(b"\n")
+            if newline >= 0:
+                return block_start + newline + 1
+            end = block_start
+    return start
+
+
+def get_checkpoint_path(report_dir, latest_log):
+    '''
+    Путь к checkpoint-у лога: лежит в dir отчетов рядом с отчетом.
+    '''
+
+    checkpoint_name = "report-{}.checkpoint".format(latest_log.f_date.strftime('%Y.%m.%d'))
+    return pathlib.Path(report_dir, checkpoint_name)
+
+
+def get_aggregate_key(latency_factory, url_normalizer, max_urls=None, group_by=None):
+    '''
+    Настройки агрегации, при смене которых накопленная статистика не годится.
+    '''
+
+    sample = latency_factory()
+    normalizer_state = url_normalizer.__getstate__() if url_normalizer is not None else None
+    return (type(sample).__name__, getattr(sample, "accuracy", None), normalizer_state, max_urls or None,
+            group_by.get_key() if group_by is not None else None)
+
+
+def load_checkpoint(checkpoint_path, latest_log, latency_factory, logger, url_normalizer=None, max_urls=None,
+                    group_by=None):
+    '''
+    Читаем checkpoint: накопленную статистику (LogsAggregate) и смещение, до которого лог уже прочитан.
+    Если лог ротировали (сменился inode или файл стал меньше) либо сменился агрегатор времени -
+    checkpoint не годится, возвращаем (None, 0) и лог читается с начала.
+    Так же и при смене нормализации url, лимита url или срезов group_by.
+    '''
+
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None, 0
+
+    try:
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        logger.error("Не удалось прочитать checkpoint: {}".format(checkpoint_path))
+        return None, 0
+
+    log_stat = os.stat(latest_log.f_path)
+    if (checkpoint.get("version") != CHECKPOINT_VERSION
+            or checkpoint["log_path"] != str(latest_log.f_path)
+            or checkpoint["inode"] != log_stat.st_ino
+            or checkpoint["size"] > log_stat.st_size
+            or checkpoint["aggregate_key"] != get_aggregate_key(latency_factory, url_normalizer, max_urls, group_by)):
+        logger.info("Checkpoint устарел, лог будет прочитан с начала: {}".format(checkpoint_path))
+        return None, 0
+
+    logger.info("Лог дочитывается с позиции {} из {}".format(checkpoint["offset"], log_stat.st_size))
+    return checkpoint["aggregate"], checkpoint["offset"]
+
+
+def save_checkpoint(checkpoint_path, latest_log, aggregate, offset, logger):
+    '''
+    Пишем checkpoint во временный файл и атомарно переименовываем.
+    '''
+
+    log_stat = os.stat(latest_log.f_path)
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "log_path": str(latest_log.f_path),
+        "inode": log_stat.st_ino,
+        "size": log_stat.st_size,
+        "offset": offset,
+        "aggregate_key": get_aggregate_key(aggregate.latency_factory, aggregate.url_normalizer, aggregate.max_urls,
+                                           aggregate.group_by),
+        "aggregate": aggregate
+    }
+    tmp_path = "{}.tmp".format(checkpoint_path)
+    with open(tmp_path, 'wb') as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, checkpoint_path)
+    logger.debug("Checkpoint сохранен: {}, позиция {}".format(checkpoint_path, offset))
+
+
+SNAPSHOT_MAGIC = b"NLAS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHdQQQdI')
+SNAPSHOT_URL = struct.Struct('<QddQI')
+SNAPSHOT_BIN = struct.Struct('<iQ')
+
+
+def get_snapshot_path(snapshot_dir, latest_log):
+    snapshot_name = "snapshot-{}.bin".format(latest_log.f_date.strftime('%Y.%m.%d'))
+    return pathlib.Path(snapshot_dir, snapshot_name)
+
+
+def save_snapshot(snapshot_path, aggregate, logger, accuracy=0.01):
+    '''
+    Пишет полную статистику по всем url (LogsAggregate) в компактный бинарный snapshot:
+        заголовок: magic, версия формата, точность sketch-ей, колво строк, колво ошибок,
+                   колво вытесненных url и их суммарное время (heavy hitters), колво url
+        по каждому url: count, time_sum, time_max, zero_count и корзины SketchLatency, затем url в utf-8
+    Все сжимается zlib, пишется во временный файл и атомарно переименовывается.
+    '''
+
+    sketches = aggregate.get_sketches(accuracy)
+    accuracy = sketches[0].accuracy if sketches else accuracy
+    compressor = zlib.compressobj()
+    tmp_path = "{}.tmp".format(snapshot_path)
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(compressor.compress(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, accuracy, aggregate.number_of_logs, aggregate.bad_logs,
+            aggregate.pruned_urls, aggregate.pruned_time_sum, len(aggregate.urls))))
+        for url_id, url in enumerate(aggregate.urls):
+            sketch = sketches[url_id]
+            url_bytes = url.encode("utf-8")
+            chunk = [SNAPSHOT_URL.pack(aggregate.counts[url_id], aggregate.time_sums[url_id],
+                                       aggregate.time_maxs[url_id], sketch.zero_count, len(sketch.bins))]
+            chunk.extend(SNAPSHOT_BIN.pack(key, count) for key, count in sketch.bins.items())
+            chunk.append(struct.pack('<I', len(url_bytes)))
+            chunk.append(url_bytes)
+            snapshot_file.write(compressor.compress(b"".join(chunk)))
+        snapshot_file.write(compressor.flush())
+
+    os.replace(tmp_path, snapshot_path)
+    logger.debug("Snapshot сохранен: {}".format(snapshot_path))
+
+
+def load_snapshot(snapshot_path):
+    '''
+    Читает snapshot в LogsAggregate с SketchLatency, который можно сливать с другими snapshot-ами.
+    '''
+
+    with open(snapshot_path, 'rb') as snapshot_file:
+        data = zlib.decompress(snapshot_file.read())
+
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or struct.unpack_from('<H', data, 4)[0] != SNAPSHOT_VERSION:
+        raise ValueError("Неизвестный формат snapshot-а: {}".format(snapshot_path))
+
+    _, _, accuracy, number_of_logs, bad_logs, pruned_urls, pruned_time_sum, urls = SNAPSHOT_HEADER.unpack_from(data)
+    aggregate = LogsAggregate(functools.partial(SketchLatency, accuracy))
+    aggregate.number_of_logs = number_of_logs
+    aggregate.bad_logs = bad_logs
+    aggregate.pruned_urls = pruned_urls
+    aggregate.pruned_time_sum = pruned_time_sum
+    position = SNAPSHOT_HEADER.size
+
+    for _ in range(urls):
+        count, time_sum, time_max, zero_count, bins = SNAPSHOT_URL.unpack_from(data, position)
+        position += SNAPSHOT_URL.size
+        sketch = SketchLatency(accuracy)
+        sketch.zero_count = zero_count
+        sketch.count = zero_count
+        for key, bin_count in SNAPSHOT_BIN.iter_unpack(data[position:position + bins * SNAPSHOT_BIN.size]):
+            sketch.bins[key] = bin_count
+            sketch.count += bin_count
+        position += bins * SNAPSHOT_BIN.size
+        url_len, = struct.unpack_from('<I', data, position)
+        position += 4
+        url = data[position:position + url_len].decode("utf-8")
+        position += url_len
+
+        aggregate.url_ids[url] = len(aggregate.urls)
+        aggregate.urls.append(url)
+        aggregate.counts.append(count)
+        aggregate.time_sums.append(time_sum)
+        aggregate.time_maxs.append(time_max)
+        aggregate.latencies.append(sketch)
+
+    return aggregate
+
+
+def find_snapshots(snapshot_dir, date_from=None, date_to=None):
+    '''
+    Snapshot-ы 'snapshot-YYYY.MM.DD.bin' из диапазона дат [date_from, date_to], отсортированные по дате.
+    '''
+
+    regex = re.compile(r'^snapshot-(\d{4}\.\d{2}\.\d{2})\.bin$')
+    snapshots = []
+
+    for file_name in os.listdir(snapshot_dir):
+        res = regex.search(file_name)
+        if res is None:
+            continue
+        f_date = datetime.datetime.strptime(res.group(1), '%Y.%m.%d')
+        if (date_from is None or f_date >= date_from) and (date_to is None or f_date <= date_to):
+            snapshots.append((f_date, pathlib.Path(snapshot_dir, file_name)))
+
+    return [snapshot_path for _, snapshot_path in sorted(snapshots)]
+
+
+def get_rollup_statistics(snapshot_paths, logger, report_size=None):
+    '''
+    Сливает snapshot-ы за несколько дней в одну статистику, сырые логи не читаются.
+    '''
+
+    aggregate = None
+    for snapshot_path in snapshot_paths:
+        logger.info("Snapshot: {}".format(snapshot_path))
+        snapshot = load_snapshot(snapshot_path)
+        aggregate = snapshot if aggregate is None else aggregate.merge(snapshot)
+
+    if aggregate is None or aggregate.number_of_logs == 0:
+        logger.info("Snapshot-ы не найдены!")
+        return None
+
+    return aggregate.finalize(report_size)
+
+
+INDEX_MAGIC = b"NLAI"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('<4sHHqqIIQQQQQ')
+INDEX_FIELDS = ("status", "time_local")
+LOG_MONTHS = {b"Jan": 1, b"Feb": 2, b"Mar": 3, b"Apr": 4, b"May": 5, b"Jun": 6,
+              b"Jul": 7, b"Aug": 8, b"Sep": 9, b"Oct": 10, b"Nov": 11, b"Dec": 12}
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_log_index_path(log_path):
+    return pathlib.Path("{}.idx".format(log_path))
+
+
+def get_log_index_key(log_format, url_normalizer=None):
+    '''
+    Ключ настроек индекса (первые 8 байт sha256): log_format, по которому строится индекс, и нормализация url.
+    Пишется в заголовок индекса, при смене настроек индекс считается устаревшим и строится заново.
+    '''
+
+    import hashlib
+
+    normalizer_state = url_normalizer.__getstate__()[:3] if url_normalizer is not None else None
+    digest = hashlib.sha256(repr((log_format, normalizer_state)).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def get_parser_format(parser):
+    '''
+    log_format, по которому разбирает строки parser: у LogFormatParser - свой, у "fast" и "regex" - ui_short.
+    '''
+
+    return parser.log_format if isinstance(parser, LogFormatParser) else LOG_FORMAT_UI_SHORT
+
+
+def get_log_checksum(log_path, size, samples=3, block_size=1 << 16):
+    '''
+    crc32 нескольких блоков файла (начало, середина, конец): дешевая проверка, что файл не подменили,
+    без чтения всего лога.
+    '''
+
+    checksum = 0
+    with open(log_path, 'rb') as log_file:
+        for sample in range(samples):
+            log_file.seek(max(size - block_size, 0) * sample // max(samples - 1, 1))
+            checksum = zlib.crc32(log_file.read(block_size), checksum)
+    return checksum
+
+
+def get_epoch_minute(moment):
+    return int((moment - EPOCH).total_seconds()) // 60
+
+
+def get_log_minute(time_local):
+    '''
+    Минута от 1970-01-01 по $time_local (b"29/Jun/2017:03:50:22 +0300") как она записана, без учета часового пояса.
+    0 - если время не разобрать.
+    '''
+
+    try:
+        moment = datetime.datetime(int(time_local[7:11]), LOG_MONTHS[time_local[3:6]], int(time_local[:2]),
+                                   int(time_local[12:14]), int(time_local[15:17]))
+    except (KeyError, ValueError):
+        return 0
+    return get_epoch_minute(moment)
+
+
+class LogIndexBuilder:
+    '''
+    Колонки индекса лога, заполняются парсером из LOG_FORMAT (fields = INDEX_FIELDS) вместо LogsAggregate:
+        словарь url (url_ids / urls) и по строке: request_time, id url, минута $time_local, $status
+    Разбор $time_local кешируется по минуте, поэтому на строку приходится поиск в словаре, а не strptime.
+    '''
+
+    def __init__(self):
+        self.url_ids = {}
+        self.urls = []
+        self.request_times = array.array('d')
+        self.line_url_ids = array.array('I')
+        self.minutes = array.array('I')
+        self.statuses = array.array('H')
+        self.minutes_cache = {}
+        self.number_of_logs = 0
+        self.bad_logs = 0
+        self.bad_lines = BadLines()
+
+    def add_bad_line(self, reason, line):
+        self.bad_logs += 1
+        self.bad_lines.add(reason, line)
+
+    def add(self, url, request_time, fields):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+
+        status, time_local = fields
+        minute = self.minutes_cache.get(time_local[:17])
+        if minute is None:
+            minute = self.minutes_cache[time_local[:17]] = get_log_minute(time_local)
+
+        self.request_times.append(request_time)
+        self.line_url_ids.append(url_id)
+        self.minutes.append(minute)
+        self.statuses.append(int(status) if status.isdigit() and len(status) <= 4 else 0)
+
+
+def save_log_index(index_path, log_path, builder, logger, index_key=0):
+    '''
+    Пишет индекс лога (sidecar рядом с логом):
+        заголовок: magic, версия формата, размер, mtime и контрольная сумма лога (get_log_checksum),
+                   колво url, ключ настроек (get_log_index_key), колво строк лога, колво ошибок,
+                   колво строк в колонках, размер словаря url
+        колонки (порядок байт платформы): request_time 'd', id url 'I', минута 'I', status 'H'
+        словарь url: url в utf-8 через "\n"
+    Колонки 'd' идут первыми сразу за заголовком, поэтому выровнены для memoryview.cast.
+    Пишется во временный файл и атомарно переименовывается.
+    '''
+
+    log_stat = os.stat(log_path)
+    urls_bytes = "\n".join(builder.urls).encode("utf-8")
+    tmp_path = "{}.tmp".format(index_path)
+
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, 0, log_stat.st_size, log_stat.st_mtime_ns,
+            get_log_checksum(log_path, log_stat.st_size), len(builder.urls), index_key, builder.number_of_logs,
+            builder.bad_logs, len(builder.request_times), len(urls_bytes)))
+        for column in (builder.request_times, builder.line_url_ids, builder.minutes, builder.statuses):
+            column.tofile(index_file)
+        index_file.write(urls_bytes)
+
+    os.replace(tmp_path, index_path)
+    logger.debug("Индекс лога сохранен: {}, строк {}, url {}".format(index_path, len(builder.request_times),
+                                                                       len(builder.urls)))
+
+
+def build_log_index(latest_log, log_format, logger, url_normalizer=None):
+    '''
+    Индексирующий проход: парсит лог парсером из log_format с полями INDEX_FIELDS и пишет индекс рядом с логом.
+    В заголовок пишется ключ log_format и нормализации url (get_log_index_key).
+    Возвращает путь индекса или None, если лог не удалось прочитать или индекс не удалось записать.
+    '''
+
+    log_path = latest_log.f_path
+    index_path = get_log_index_path(log_path)
+    builder = LogIndexBuilder()
+
+    try:
+        parser = compile_log_format(log_format, INDEX_FIELDS)
+        if latest_log.f_ext == ".gz":
+            parser(GzipLineReader(log_path), builder, logger)
+        else:
+            aggregate_plain_log(log_path, parser, builder, logger)
+        builder.bad_lines.log(logger, builder.number_of_logs)
+        save_log_index(index_path, log_path, builder, logger, get_log_index_key(log_format, url_normalizer))
+    except ValueError as err:
+        logger.error("Индекс лога не построен: {}".format(err))
+        return None
+    except (OSError, EOFError, zlib.error):
+        logger.exception("Не удалось построить индекс лога: {}".format(index_path))
+        return None
+
+    return index_path
+
+
+def find_log_index(latest_log, logger, index_key=None):
+    '''
+    Путь индекса лога, если он есть и построен по этому же файлу: совпадают размер, mtime
+    и контрольная сумма блоков лога, а если задан index_key - и ключ log_format и нормализации url.
+    Иначе None (индекса нет или он устарел).
+    '''
+
+    index_path = get_log_index_path(latest_log.f_path)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        log_stat = os.stat(latest_log.f_path)
+        with open(index_path, 'rb') as index_file:
+            magic, version, _, size, mtime_ns, checksum, _, key, *_ = INDEX_HEADER.unpack(
+                index_file.read(INDEX_HEADER.size))
+        actual = (magic == INDEX_MAGIC and version == INDEX_VERSION and size == log_stat.st_size
+                  and mtime_ns == log_stat.st_mtime_ns and checksum == get_log_checksum(latest_log.f_path, size)
+                  and (index_key is None or key == index_key))
+    except (OSError, struct.error):
+        actual = False
+
+    if not actual:
+        logger.info("Индекс лога устарел: {}".format(index_path))
+        return None
+
+    logger.info("Найден индекс лога: {}".format(index_path))
+    return index_path
+
+
+class LogIndex:
+    '''
+    Индекс лога, отображенный в память (mmap): колонки - memoryview прямо в файле, словарь url читается целиком.
+    Запросы (top-N, префикс url, окно времени, класс ответа) идут по колонкам без чтения и парсинга лога.
+    Используется как контекстный менеджер: mmap закрывается после освобождения memoryview колонок.
+    '''
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_file:
+            self.buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (magic, version, _, self.size, self.mtime_ns, self.checksum, urls, self.index_key, self.number_of_logs,
+             self.bad_logs, lines, urls_size) = INDEX_HEADER.unpack_from(self.buffer)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError("Неизвестный формат индекса лога: {}".format(index_path))
+
+            self.view = memoryview(self.buffer)
+            position = INDEX_HEADER.size
+            self.columns = []
+            for typecode in ('d', 'I', 'I', 'H'):
+                column_size = lines * array.array(typecode).itemsize
+                self.columns.append(self.view[position:position + column_size].cast(typecode))
+                position += column_size
+            self.request_times, self.url_ids, self.minutes, self.statuses = self.columns
+            self.urls = self.view[position:position + urls_size].tobytes().decode("utf-8").split("\n") if urls else []
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for column in getattr(self, "columns", []):
+            column.release()
+        self.columns = []
+        if hasattr(self, "view"):
+            self.view.release()
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def select(self, url_prefix=None, time_from=None, time_to=None, status=None):
+        '''
+        Колонки (id url, request_time) строк, подходящих под фильтры, и их количество:
+            url_prefix - url начинается с префикса (проверяется один раз по словарю url)
+            time_from / time_to - минута $time_local в [time_from, time_to), datetime
+            status - класс ответа "5xx" или точный код "404"
+        Без фильтров колонки возвращаются как есть (memoryview), иначе через itertools.compress по маске строк.
+        '''
+
+        masks = []
+        if url_prefix is not None:
+            allowed = bytes(url.startswith(url_prefix) for url in self.urls)
+            masks.append(map(allowed.__getitem__, self.url_ids))
+        if time_from is not None or time_to is not None:
+            minute_from = get_epoch_minute(time_from) if time_from is not None else 0
+            minute_to = get_epoch_minute(time_to) if time_to is not None else 1 << 32
+            masks.append((minute_from <= minute < minute_to for minute in self.minutes))
+        if status is not None:
+            status_from = int(status[0]) * 100 if status.endswith("xx") else int(status)
+            status_to = status_from + (100 if status.endswith("xx") else 1)
+            masks.append((status_from <= code < status_to for code in self.statuses))
+
+        if not masks:
+            return self.url_ids, self.request_times, len(self.request_times)
+
+        selector = bytes(map(all, zip(*masks)))
+        return (itertools.compress(self.url_ids, selector), itertools.compress(self.request_times, selector),
+                selector.count(1))
+
+    def get_aggregate(self, latency_factory=ExactLatency, url_normalizer=None, max_urls=None, **filters):
+        '''
+        LogsAggregate по строкам индекса (фильтры - как в select). Без фильтров колво строк и ошибок - как в логе,
+        с фильтрами - только отобранные строки.
+        '''
+
+        url_ids, request_times, lines = self.select(**filters)
+        aggregate = create_aggregate(latency_factory, url_normalizer, max_urls)
+        aggregate.add_index(self.urls, url_ids, request_times)
+        aggregate.number_of_logs = lines
+        if not any(value is not None for value in filters.values()):
+            aggregate.number_of_logs, aggregate.bad_logs = self.number_of_logs, self.bad_logs
+        return aggregate
+
+
+def get_index_aggregate(latest_log, logger, latency_factory=ExactLatency, url_normalizer=None, max_urls=None,
+                        index_format=None, metrics=None, log_format=LOG_FORMAT_UI_SHORT):
+    '''
+    LogsAggregate по индексу лога: по найденному (latest_log.f_index), а если его нет и задан index_format -
+    сначала строим индекс (build_log_index). None - если индекса нет и построить его не удалось.
+    Найденный индекс годится, только если построен по тому же формату (index_format, иначе log_format -
+    формат парсера) и с той же нормализацией url, иначе он строится заново (или лог парсится).
+    '''
+
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    index_key = get_log_index_key(index_format or log_format, url_normalizer)
+    index_path = latest_log.f_index
+    if index_path is not None:
+        index_path = find_log_index(latest_log, logger, index_key)
+    if index_path is None and index_format is not None:
+        with metrics.stage("index", os.path.getsize(latest_log.f_path)):
+            index_path = build_log_index(latest_log, index_format, logger, url_normalizer)
+    if index_path is None:
+        return None
+
+    try:
+        with metrics.stage("aggregate"), LogIndex(index_path) as log_index:
+            aggregate = log_index.get_aggregate(latency_factory, url_normalizer, max_urls)
+    except (OSError, ValueError):
+        logger.exception("Не удалось прочитать индекс лога: {}".format(index_path))
+        return None
+
+    logger.info("Статистика посчитана по индексу лога: {}".format(index_path))
+    return aggregate
+
+
+RESULT_CACHE_VERSION = 2
+
+
+def get_cache_key(log_path, result_config):
+    '''
+    Ключ записи ResultCache (sha256): отпечаток лога (размер, mtime, crc32 выборочных блоков - get_log_checksum)
+    и настройки разбора и агрегации (LOG_PARSER, LOG_FORMAT, get_aggregate_key).
+    REPORT_SIZE, шаблон и ERRORS_LIMIT_PERC в ключ не входят - они применяются к записи при чтении.
+    '''
+
+    import hashlib
+
+    log_stat = os.stat(log_path)
+    aggregate_key = get_aggregate_key(get_latency_factory(result_config), get_url_normalizer(result_config),
+                                      result_config.get("TOP_URLS_LIMIT"), get_group_by(result_config))
+    source = (RESULT_CACHE_VERSION, log_stat.st_size, log_stat.st_mtime_ns,
+              get_log_checksum(log_path, log_stat.st_size), result_config.get("LOG_PARSER", "fast"),
+              result_config.get("LOG_FORMAT", LOG_FORMAT_UI_SHORT), aggregate_key)
+    return hashlib.sha256(repr(source).encode("utf-8")).hexdigest()
+
+
+def get_render_key(cache_key, result_config):
+    '''
+    Ключ отчета: ключ статистики (get_cache_key), шаблон (путь и mtime) и REPORT_SIZE.
+    Пишется рядом с отчетом (report-YYYY.MM.DD.key), по нему видно, что отчет надо перерисовать.
+    '''
+
+    import hashlib
+
+    template_path = result_config["TEMPLATE_PATH"]
+    try:
+        template_mtime = os.stat(template_path).st_mtime_ns
+    except OSError:
+        template_mtime = None
+    source = (cache_key, str(template_path), template_mtime, result_config["REPORT_SIZE"])
+    return hashlib.sha256(repr(source).encode("utf-8")).hexdigest()
+
+
+def get_result_render_key(result_config, latest_log):
+    '''
+    Ключ отчета по логу для config или None, если кеш (CACHE_DIR) выключен.
+    '''
+
+    if not result_config.get("CACHE_DIR"):
+        return None
+    return get_render_key(get_cache_key(latest_log.f_path, result_config), result_config)
+
+
+def get_render_key_path(report_path):
+    return pathlib.Path(report_path).with_suffix(".key")
+
+
+def is_report_current(report_path, render_key):
+    '''
+    Отчет построен по тому же логу, с теми же настройками и шаблоном: render_key совпадает с записанным рядом.
+    Если файла ключа нет (отчет построен без кеша), отчет считается актуальным.
+    '''
+
+    try:
+        with open(get_render_key_path(report_path), 'r', encoding='ascii') as key_file:
+            return key_file.read().strip() == render_key
+    except FileNotFoundError:
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def save_render_key(report_path, render_key, logger):
+    try:
+        with open(get_render_key_path(report_path), 'w', encoding='ascii') as key_file:
+            key_file.write(render_key)
+    except OSError:
+        logger.exception("Не удалось записать ключ отчета: {}".format(get_render_key_path(report_path)))
+
+
+class ResultCache:
+    '''
+    Кеш итоговой статистики между запусками: CACHE_DIR/<ключ>.cache, ключ - get_cache_key.
+    В записи первые limit строк по url (уже отсортированы по time_sum) и по группам срезов, limit и счетчики:
+    отчет с другим шаблоном или REPORT_SIZE не больше limit - это срез готовых строк и рендер, лог не читается.
+    Запись - pickle + zlib, пишется атомарно. Размер кеша ограничен max_bytes (LRU):
+    при чтении у записи обновляется mtime, после записи удаляются записи с самым старым mtime.
+    '''
+
+    SUFFIX = ".cache"
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def get_path(self, key):
+        return self.cache_dir / "{}{}".format(key, self.SUFFIX)
+
+    def get(self, key, logger):
+        cache_path = self.get_path(key)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                entry = pickle.loads(zlib.decompress(cache_file.read()))
+            os.utime(cache_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError, AttributeError):
+            logger.error("Не удалось прочитать запись кеша: {}".format(cache_path))
+            return None
+
+        if entry.get("version") != RESULT_CACHE_VERSION:
+            return None
+        logger.info("Статистика взята из кеша: {}".format(cache_path))
+        return entry
+
+    def put(self, key, entry, logger):
+        cache_path = self.get_path(key)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(zlib.compress(pickle.dumps(dict(entry, version=RESULT_CACHE_VERSION),
+                                                            protocol=pickle.HIGHEST_PROTOCOL), 1))
+            os.replace(tmp_path, cache_path)
+            self.evict(logger)
+        except OSError:
+            logger.exception("Не удалось записать кеш: {}".format(cache_path))
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            return False
+        logger.debug("Статистика сохранена в кеш: {}".format(cache_path))
+        return True
+
+    def evict(self, logger):
+        '''
+        Удаляет записи с самым старым mtime, пока кеш больше max_bytes.
+        Записи может одновременно удалять другой процесс (пакетный режим), поэтому пропавшие файлы не ошибка.
+        '''
+
+        entries = []
+        with os.scandir(self.cache_dir) as cache_files:
+            for cache_file in cache_files:
+                if cache_file.name.endswith(self.SUFFIX):
+                    with contextlib.suppress(FileNotFoundError):
+                        cache_stat = cache_file.stat()
+                        entries.append((cache_stat.st_mtime_ns, cache_stat.st_size, cache_file.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, cache_path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(cache_path)
+            total_size -= size
+            evicted += 1
+
+        if evicted:
+            logger.debug("Из кеша вытеснено записей: {}".format(evicted))
+        return evicted
+
+
+def get_result_cache(result_config):
+    '''
+    ResultCache по CACHE_DIR и CACHE_SIZE_MB из config или None, если кеш выключен.
+    '''
+
+    cache_dir = result_config.get("CACHE_DIR")
+    if not cache_dir:
+        return None
+    return ResultCache(cache_dir, result_config.get("CACHE_SIZE_MB", 256) << 20)
+
+
+def get_cache_limit(report_size, max_urls=None):
+    '''
+    Сколько строк класть в запись ResultCache: не меньше REPORT_SIZE и TOP_URLS_LIMIT, чтобы отчет
+    считался через finalize(limit) (без медиан по всем url), None - все строки.
+    '''
+
+    return None if report_size is None else max(report_size, max_urls or 0)
+
+
+def is_cache_entry_complete(entry, report_size):
+    return entry["limit"] is None or (report_size is not None and report_size <= entry["limit"])
+
+
+def get_cached_statistics(entry, error_limits, logger, report_size=None, metrics=None, view_statistics=None):
+    '''
+    Статистика из записи ResultCache: лимит ошибок проверяется заново (он не входит в ключ),
+    берутся первые report_size строк - те же, что вернул бы LogsAggregate.finalize(report_size).
+    Пустой лог ошибкой не считается.
+    '''
+
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    metrics.counters.update(entry["counters"])
+
+    if get_error_perc(entry["counters"]["bad_lines"], entry["counters"]["lines"]) > error_limits:
+        logger.error("Сменился формат логирования!")
+        return None
+
+    if view_statistics is not None:
+        view_statistics.update((name, rows[:report_size]) for name, rows in entry["views"].items())
+    return entry["rows"][:report_size]
+
+
+def get_chunk_aggregate(log_path, start, end, latency_factory, logger_name, parser="fast", url_normalizer=None,
+                        max_urls=None, group_by=None):
+    '''
+    Воркер пула процессов: считает частичную статистику по куску файла [start, end).
+    '''
+
+    aggregate = create_aggregate(latency_factory, url_normalizer, max_urls, group_by)
+    aggregate_plain_log(log_path, parser, aggregate, logging.getLogger(logger_name), start, end)
+    return aggregate
+
+
+def get_parallel_aggregate(log_path, workers, latency_factory, logger, parser="fast", start=0, end=None,
+                           url_normalizer=None, max_urls=None, metrics=None, group_by=None):
+    '''
+    Параллельный парсинг несжатого лога: файл делится на куски по границам строк,
+    каждый кусок обрабатывается в отдельном процессе, частичные статистики сливаются.
+    В metrics ожидание процессов идет в этап parse, слияние - в aggregate.
+    '''
+
+    import concurrent.futures
+
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    chunks = get_file_chunks(log_path, workers, start, end)
+    logger.debug("Лог разбит на {} кусков, процессов: {}".format(len(chunks), workers))
+
+    aggregate = create_aggregate(latency_factory, url_normalizer, max_urls, group_by)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_chunk_aggregate, log_path, start, end, latency_factory, logger.name,
+                                   parser, url_normalizer, max_urls, group_by)
+                   for start, end in chunks]
+        for future in futures:
+            with metrics.stage("parse"):
+                chunk_aggregate = future.result()
+            with metrics.stage("aggregate"):
+                aggregate.merge(chunk_aggregate)
+
+    metrics.stages["parse"]["items"] += aggregate.number_of_logs
+    return aggregate
+
+
+def log_gz_throughput(stats, number_of_logs, elapsed, logger):
+    '''
+    Пишет в лог раздельно скорость распаковки и скорость парсинга .gz лога.
+    '''
+
+    megabytes = stats["bytes"] / (1 << 20)
+    parse_time = max(elapsed - stats["wait_time"], 1e-9)
+    logger.debug("Распаковка: {:.1f} МБ за {:.3f} с ({:.1f} МБ/с), gzip member-ов: {}".format(
+        megabytes, stats["decompress_time"], megabytes / max(stats["decompress_time"], 1e-9), stats["members"]))
+    logger.debug("Парсинг: {} строк за {:.3f} с ({:.0f} строк/с)".format(
+        number_of_logs, parse_time, number_of_logs / parse_time))
+
+
+def get_logs_aggregate(latest_log, logger, latency_factory=ExactLatency, workers=1, parser="fast", start=0, end=None,
+                       url_normalizer=None, max_urls=None, metrics=None, error_limits=None, group_by=None):
+    '''
+    Считает LogsAggregate по логу (для несжатого лога - по диапазону байт [start, end)):
+        При workers > 1 несжатый лог парсится кусками в пуле процессов, результаты сливаются
+        .gz лог распаковывается в отдельном потоке (GzipLineReader), читается целиком
+        Несжатый лог (и каждый кусок в процессе) разбирается через mmap без копирования строк (aggregate_plain_log)
+        Если задан error_limits, несжатый лог в одном процессе перестает читаться, как только
+        доля ошибок уже не может уложиться в error_limits
+    Если задан group_by, за тот же проход считаются срезы статистики (LogsAggregate.views).
+    В metrics пишутся этапы decompress (время потока распаковки, байты) и parse (строки).
+    Парсер сразу добавляет строку в aggregate, поэтому parse включает и add, а для несжатого лога и чтение файла.
+    '''
+
+    log_path = latest_log.f_path
+    metrics = metrics if metrics is not None else PipelineMetrics()
+
+    if latest_log.f_ext == ".gz":
+        aggregate = create_aggregate(latency_factory, url_normalizer, max_urls, group_by)
+        parse_start = time.perf_counter()
+        log_lines = GzipLineReader(log_path, workers)
+        get_log_parser(parser)(log_lines, aggregate, logger)
+        elapsed = time.perf_counter() - parse_start
+        log_gz_throughput(log_lines.stats, aggregate.number_of_logs, elapsed, logger)
+        metrics.add_stage("decompress", log_lines.stats["decompress_time"], log_lines.stats["bytes"])
+        metrics.add_stage("parse", max(elapsed - log_lines.stats["wait_time"], 0.0), aggregate.number_of_logs)
+        return aggregate
+
+    if workers > 1 and not DEBUG_MODE:
+        return get_parallel_aggregate(log_path, workers, latency_factory, logger, parser, start, end, url_normalizer,
+                                      max_urls, metrics, group_by)
+
+    aggregate = create_aggregate(latency_factory, url_normalizer, max_urls, group_by)
+    parse_start = time.perf_counter()
+    aggregate_plain_log(log_path, parser, aggregate, logger, start, end, error_limits)
+    metrics.add_stage("parse", time.perf_counter() - parse_start, aggregate.number_of_logs)
+    return aggregate
+
+
+def get_logs_statistics(error_limits, latest_log, logger, latency_factory=ExactLatency, workers=1, parser="fast",
+                        checkpoint_path=None, url_normalizer=None, snapshot_path=None, report_size=None,
+                        max_urls=None, metrics=None, store=None, group_by=None, view_statistics=None,
+                        index_format=None, result_cache=None, cache_key=None):
+    '''
+    Обрабатываем фал лога:
+        1. Проверяем формат по выборке строк (check_log_format), если формат явно сменился - выходим сразу
+           Читаем строку лога
+        2. Парсим строку парсером parser из LOG_PARSERS ("fast" - по байтам, "regex" - регуляркой,
+           "format" - собранный из log_format) или готовым LogFormatParser
+        3. Ищем url в словаре по ключу! Добавляем строку в словарь с первичной статистикой если такой url еще нет.
+           Обновляем статистику если строка с таким url уже есть в словаре (LogsAggregate)
+           Время запросов копится в агрегаторе latency_factory() (ExactLatency / SketchLatency)
+           Если задан url_normalizer - url нормализуется перед агрегацией (UrlNormalizer)
+           Если задан max_urls - в памяти держатся только url с наибольшим time_sum (heavy hitters)
+           Если задан group_by - за тот же проход считаются срезы (GroupBy), парсер должен отдавать group_by.fields
+           Если задан checkpoint_path - берем статистику из checkpoint-а и дочитываем только новый хвост лога
+           Иначе, если у лога есть актуальный индекс (latest_log.f_index) или задан index_format (LOG_INDEX) -
+           считаем по индексу (get_index_aggregate), лог не парсится. Срезы group_by по индексу не считаются
+        4. Чекаем на колво ошибо парсинга (включая строки с url не в utf-8), причины и примеры пишем одной записью
+           (BadLines). Если ошибок больше установленого ERRORS_LIMIT_PERC в config выходим
+           (несжатый лог перестает читаться, как только лимит уже нельзя выполнить; хвост после checkpoint-а
+           читается целиком)
+        5. Сохраняем checkpoint и snapshot (если заданы пути)
+        6. Выбираем report_size url с наибольшим time_sum и дописываем статистику только по ним (LogsAggregate.finalize)
+           Если задан result_cache - строки (не меньше max_urls, get_cache_limit) сохраняются в кеш по cache_key
+           (кроме режимов checkpoint и store)
+        7. Возвращаем статистику по логам
+    Если в result_cache уже есть запись по cache_key, в ней не меньше report_size строк (и snapshot уже записан) -
+    лог не читается, статистика берется из кеша (get_cached_statistics).
+    В metrics (PipelineMetrics, если передан) пишутся время этапов и счетчики: строк, ошибок парсинга, уникальных url.
+    Если передан store (StatsStore, режим --serve), статистика сливается в него для HTTP сервера.
+    В словарь view_statistics (если передан) пишутся строки отчета по каждому срезу group_by.
+    '''
+
+    log_path = latest_log.f_path
+    metrics = metrics if metrics is not None else PipelineMetrics()
+
+    if result_cache is not None and store is None and checkpoint_path is None and \
+            (snapshot_path is None or os.path.exists(snapshot_path)):
+        with metrics.stage("cache"):
+            entry = result_cache.get(cache_key, logger)
+        if entry is not None and not is_cache_entry_complete(entry, report_size):
+            logger.info("В кеше только {} строк, статистика будет посчитана заново".format(entry["limit"]))
+        elif entry is not None:
+            return get_cached_statistics(entry, error_limits, logger, report_size, metrics, view_statistics)
+
+    try:
+        with metrics.stage("aggregate"):
+            aggregate, offset = load_checkpoint(checkpoint_path, latest_log, latency_factory, logger, url_normalizer,
+                                                max_urls, group_by)
+        end = None
+        if checkpoint_path is not None:
+            end = os.path.getsize(log_path) if latest_log.f_ext == ".gz" else get_complete_size(log_path, offset)
+            if latest_log.f_ext == ".gz" and offset != end:
+                aggregate, offset = None, 0
+
+        if aggregate is None and not check_log_format(latest_log, error_limits, logger, parser):
+            logger.error("Сменился формат логирования!")
+            return None
+
+        index_aggregate = None
+        if aggregate is None and checkpoint_path is None and group_by is None:
+            index_aggregate = get_index_aggregate(latest_log, logger, latency_factory, url_normalizer, max_urls,
+                                                  index_format, metrics, get_parser_format(parser))
+
+        if index_aggregate is not None:
+            aggregate = index_aggregate
+        elif aggregate is None or offset < end:
+            # Ранняя остановка судит только по тому, что читается сейчас: для хвоста после checkpoint-а ее нет,
+            # иначе пачка ошибок в начале хвоста оборвет чтение, а checkpoint все равно сдвинется на конец лога
+            tail_aggregate = get_logs_aggregate(latest_log, logger, latency_factory, workers, parser, offset, end,
+                                                url_normalizer, max_urls, metrics,
+                                                error_limits if aggregate is None else None, group_by)
+            with metrics.stage("aggregate"):
+                aggregate = tail_aggregate if aggregate is None else aggregate.merge(tail_aggregate)
+        else:
+            logger.info("Новых записей в логе нет")
+    except (OSError, EOFError, zlib.error):
+        logger.error("Не удалось открыть файл лога: {}".format(log_path))
+        return None
+
+    metrics.counters.update({"lines": aggregate.number_of_logs, "bad_lines": aggregate.bad_logs,
+                             "bad_line_reasons": dict(aggregate.bad_lines.reasons),
+                             "urls": len(aggregate.urls) + aggregate.pruned_urls})
+
+    logger.debug("{} : логов прочитано".format(aggregate.number_of_logs))
+    logger.debug("{} : логов не удалось обработать".format(aggregate.bad_logs))
+    aggregate.bad_lines.log(logger, aggregate.number_of_logs)
+
+    if get_error_perc(aggregate.bad_logs, aggregate.number_of_logs) > error_limits:
+        logger.error("Сменился формат логирования!")
+        return None
+
+    with metrics.stage("save"):
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, latest_log, aggregate, end, logger)
+
+        if snapshot_path is not None:
+            save_snapshot(snapshot_path, aggregate, logger, getattr(latency_factory(), "accuracy", 0.01))
+
+    if aggregate.pruned_urls:
+        logger.debug("{} : url вытеснено, максимальный вытесненный time_sum {:.3f}".format(
+            aggregate.pruned_urls, aggregate.pruned_time_max))
+
+    finalize_start = time.perf_counter()
+    if result_cache is not None and store is None and checkpoint_path is None:
+        cache_limit = get_cache_limit(report_size, max_urls)
+        entry = {"counters": dict(metrics.counters), "limit": cache_limit, "rows": aggregate.finalize(cache_limit),
+                 "views": aggregate.get_view_statistics(cache_limit)}
+        result_cache.put(cache_key, entry, logger)
+        logs_statistic = get_cached_statistics(entry, error_limits, logger, report_size, metrics, view_statistics)
+    else:
+        if store is not None:
+            store.ingest(aggregate, block=True)
+            logs_statistic = store.top(report_size)
+        else:
+            logs_statistic = aggregate.finalize(report_size)
+        if view_statistics is not None:
+            view_statistics.update(aggregate.get_view_statistics(report_size))
+    metrics.add_stage("finalize", time.perf_counter() - finalize_start, len(logs_statistic))
+
+    return logs_statistic
+
+
+@functools.lru_cache(maxsize=8)
+def get_template_parts(template_path, template_mtime):
+    '''
+    Читает шаблон отчета один раз и режет его по плейсхолдеру $table_json (по правилам string.Template).
+    Остальной текст обрабатывается как safe_substitute без переменных ($$ -> $).
+    Кешируется по пути и времени изменения шаблона.
+    '''
+
+    with open(template_path, 'r', encoding='utf-8') as tmpl:
+        text = tmpl.read()
+
+    parts = []
+    position = 0
+    for res in string.Template.pattern.finditer(text):
+        if (res.group("named") or res.group("braced")) == "table_json":
+            parts.append(string.Template(text[position:res.start()]).safe_substitute())
+            position = res.end()
+    parts.append(string.Template(text[position:]).safe_substitute())
+
+    if len(parts) == 1:
+        raise ValueError("В шаблоне нет $table_json: {}".format(template_path))
+    return tuple(parts)
+
+
+def write_table_json(report, logs_statistic):
+    '''
+    Пишет статистику в json построчно, не собирая всю таблицу в одну строку (тот же вывод, что и json.dumps).
+    '''
+
+    report.write("[")
+    for i, url_stat in enumerate(logs_statistic):
+        if i:
+            report.write(", ")
+        report.write(json.dumps(url_stat))
+    report.write("]")
+
+
+def render_html_report(result_config, report_path, logs_statistic, logger):
+    '''
+    Берем из кеша шаблон отчета, разрезанный по $table_json.
+    Пишем отчет во временный файл рядом с отчетом: части шаблона и между ними статистику в json по строкам.
+    Атомарно переименовываем временный файл в отчет, чтобы недописанный отчет никогда не считался готовым.
+    '''
+
+    template_path = result_config["TEMPLATE_PATH"]
+    table = logs_statistic[:result_config["REPORT_SIZE"]]
+
+    try:
+        parts = get_template_parts(template_path, os.stat(template_path).st_mtime_ns)
+    except (OSError, ValueError):
+        logger.error("Не удалось отрендерить шаблон!")
+        return False
+
+    tmp_path = "{}.tmp".format(report_path)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as report:
+            report.write(parts[0])
+            for part in parts[1:]:
+                write_table_json(report, table)
+                report.write(part)
+        os.replace(tmp_path, report_path)
+    except Exception:
+        logger.exception("Не удалось записать отчет: {}".format(report_path))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    return True
+
+
+def render_view_reports(result_config, report_path, view_statistics, logger):
+    '''
+    Отчеты по срезам GROUP_BY рядом с основным: report-YYYY.MM.DD.<срез>.html, например report-2017.06.30.status-url.html
+    '''
+
+    rendered = True
+    for name, logs_statistic in view_statistics.items():
+        view_path = pathlib.Path(report_path).with_suffix(".{}.html".format(name))
+        rendered = render_html_report(result_config, view_path, logs_statistic, logger) and rendered
+    return rendered
+
+
+def get_result_index_format(result_config):
+    return result_config.get("LOG_FORMAT", LOG_FORMAT_UI_SHORT) if result_config.get("LOG_INDEX") else None
+
+
+def get_result_snapshot_path(result_config, latest_log):
+    snapshot_dir = result_config.get("SNAPSHOT_DIR")
+    return get_snapshot_path(snapshot_dir, latest_log) if snapshot_dir else None
+
+
+def run_rollup(result_config, logger, date_from=None, date_to=None, output=None):
+    '''
+    Подкоманда rollup: отчет за несколько дней по snapshot-ам из SNAPSHOT_DIR.
+    '''
+
+    snapshot_dir = result_config.get("SNAPSHOT_DIR")
+    if not snapshot_dir or not os.path.isdir(snapshot_dir):
+        logger.error("Директория snapshot-ов не найдена: {}".format(snapshot_dir))
+        return False
+
+    snapshot_paths = find_snapshots(snapshot_dir, date_from, date_to)
+    logs_statistic = get_rollup_statistics(snapshot_paths, logger, result_config["REPORT_SIZE"])
+    if logs_statistic is None:
+        return False
+
+    if output is None:
+        first_date = re.search(r'(\d{4}\.\d{2}\.\d{2})', snapshot_paths[0].name).group(1)
+        last_date = re.search(r'(\d{4}\.\d{2}\.\d{2})', snapshot_paths[-1].name).group(1)
+        output = pathlib.Path(result_config["REPORT_DIR"], "report-{}-{}.html".format(first_date, last_date))
+
+    logger.info("Rollup отчет будет записан в файл: {}".format(output))
+    return render_html_report(result_config, output, logs_statistic, logger)
+
+
+def run_query(result_config, logger, log_date=None, top=None, sort="time_sum", **filters):
+    '''
+    Подкоманда query: выборка по индексу лога за дату log_date (по умолчанию последний лог) без отчета.
+    Если актуального индекса нет, сначала выполняется индексирующий проход (build_log_index).
+    Фильтры - как в LogIndex.select. Возвращает top строк статистики по sort или None.
+    '''
+
+    logs = [log for log in find_logs(result_config["LOG_DIR"]) if log_date is None or log.f_date == log_date]
+    latest_log = max(logs, key=lambda log: log.f_date, default=None)
+    if latest_log is None:
+        logger.info("Файл лога не найден!")
+        return None
+
+    log_format = result_config.get("LOG_FORMAT", LOG_FORMAT_UI_SHORT)
+    url_normalizer = get_url_normalizer(result_config)
+    index_path = find_log_index(latest_log, logger, get_log_index_key(log_format, url_normalizer)) or \
+        build_log_index(latest_log, log_format, logger, url_normalizer)
+    if index_path is None:
+        return None
+
+    with LogIndex(index_path) as log_index:
+        aggregate = log_index.get_aggregate(get_latency_factory(result_config), url_normalizer, **filters)
+    return aggregate.finalize(top, sort)
+
+
+def write_live_reports(result_config, windows, now, logger):
+    '''
+    Режим --follow: для каждого окна пишет report-live-{N}m.html и общий report-live.json
+    (json пишется во временный файл и атомарно переименовывается).
+    '''
+
+    live_report = {"generated": datetime.datetime.fromtimestamp(now).isoformat(timespec="seconds"), "windows": {}}
+
+    for minutes in windows.windows:
+        window = windows.get_window(minutes, now)
+        logs_statistic = window.finalize(result_config["REPORT_SIZE"]) if window.number_of_logs else []
+        live_report["windows"]["{}m".format(minutes)] = {
+            "lines": window.number_of_logs,
+            "bad_lines": window.bad_logs,
+            "table": logs_statistic
+        }
+        if logs_statistic:
+            report_path = pathlib.Path(result_config["REPORT_DIR"], "report-live-{}m.html".format(minutes))
+            render_html_report(result_config, report_path, logs_statistic, logger)
+
+    json_path = pathlib.Path(result_config["REPORT_DIR"], "report-live.json")
+    tmp_path = "{}.tmp".format(json_path)
+    with open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(live_report, json_file)
+    os.replace(tmp_path, json_path)
+    logger.debug("Live отчеты обновлены: {}".format(json_path))
+
+
+def get_follow_latency_factory(result_config):
+    return functools.partial(SketchLatency, result_config.get("LATENCY_ACCURACY", 0.01))
+
+
+def get_follow_max_urls(result_config):
+    '''
+    Лимит url для --follow: TOP_URLS_LIMIT, а если он 0 - FOLLOW_TOP_URLS_LIMIT,
+    чтобы долго работающий процесс не копил все url без ограничения.
+    '''
+
+    return result_config.get("TOP_URLS_LIMIT") or result_config.get("FOLLOW_TOP_URLS_LIMIT") or \
+        config["FOLLOW_TOP_URLS_LIMIT"]
+
+
+def run_follow(result_config, logger, stop=None, clock=time.time, poll_interval=0.5, store=None):
+    '''
+    Режим --follow: читаем дописываемые строки текущего лога (LogFollower), парсим тем же парсером,
+    копим статистику в корзинах скользящих окон (SlidingWindowAggregate) и раз в FOLLOW_INTERVAL
+    секунд перерисовываем отчеты. Работает пока не выставлен stop (threading.Event) или Ctrl+C.
+    Если передан store (режим --serve), каждая порция строк сливается и в него (статистика с момента запуска).
+    Плохие строки копятся в BadLines и пишутся в лог одной сводкой вместе с отчетами, не чаще FOLLOW_INTERVAL.
+    '''
+
+    log_path = pathlib.Path(result_config["LOG_DIR"], result_config["FOLLOW_LOG"])
+    logger.info("Чтение лога в режиме --follow: {}".format(log_path))
+
+    follower = LogFollower(log_path)
+    latency_factory = get_follow_latency_factory(result_config)
+    url_normalizer = get_url_normalizer(result_config)
+    max_urls = get_follow_max_urls(result_config)
+    windows = SlidingWindowAggregate(result_config["FOLLOW_WINDOWS"], result_config["FOLLOW_BUCKET"],
+                                     latency_factory, url_normalizer, max_urls)
+    parse = get_log_parser(get_result_parser(result_config))
+    next_report = clock() + result_config["FOLLOW_INTERVAL"]
+    bad_lines, number_of_logs = BadLines(), 0
+
+    try:
+        while stop is None or not stop.is_set():
+            log_lines = follower.read_lines()
+            if log_lines:
+                batch = LogsAggregate(latency_factory, url_normalizer, max_urls)
+                parse(log_lines, batch, logger)
+                bad_lines.merge(batch.bad_lines)
+                number_of_logs += batch.number_of_logs
+                windows.current(clock()).merge(batch)
+                if store is not None:
+                    store.ingest(batch)
+
+            now = clock()
+            if now >= next_report:
+                write_live_reports(result_config, windows, now, logger)
+                bad_lines.log(logger, number_of_logs)
+                bad_lines, number_of_logs = BadLines(), 0
+                next_report = now + result_config["FOLLOW_INTERVAL"]
+
+            if not log_lines:
+                if stop is not None:
+                    stop.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+    finally:
+        follower.close()
+
+
+def run_batch_job(result_config, latest_log, report_path, logger_name, workers=1):
+    '''
+    Задача пакетного режима: статистика и отчет по одному логу.
+    Возвращает словарь с результатом и скоростью обработки, исключения не выпускает.
+    '''
+
+    logger = logging.getLogger(logger_name)
+    start = time.perf_counter()
+    job_result = {"log": str(latest_log.f_path), "ok": False, "lines": 0, "bytes": 0, "seconds": 0.0}
+
+    try:
+        job_result["bytes"] = os.path.getsize(latest_log.f_path)
+        metrics = PipelineMetrics()
+        view_statistics = {}
+        result_cache = get_result_cache(result_config)
+        cache_key = get_cache_key(latest_log.f_path, result_config) if result_cache is not None else None
+        logs_statistic = get_logs_statistics(result_config["ERRORS_LIMIT_PERC"], latest_log, logger,
+                                             get_latency_factory(result_config), workers,
+                                             get_result_parser(result_config), None, get_url_normalizer(result_config),
+                                             get_result_snapshot_path(result_config, latest_log),
+                                             result_config["REPORT_SIZE"], result_config.get("TOP_URLS_LIMIT"),
+                                             metrics, None, get_group_by(result_config), view_statistics,
+                                             get_result_index_format(result_config), result_cache, cache_key)
+        job_result["lines"] = metrics.counters.get("lines", 0)
+        if logs_statistic is not None:
+            with metrics.stage("render", len(logs_statistic)):
+                job_result["ok"] = render_html_report(result_config, report_path, logs_statistic, logger) and \
+                    render_view_reports(result_config, report_path, view_statistics, logger)
+            if job_result["ok"] and cache_key is not None:
+                save_render_key(report_path, get_render_key(cache_key, result_config), logger)
+            metrics.write(get_metrics_path(report_path), logger)
+    except Exception:
+        logger.exception("Не удалось обработать лог: {}".format(latest_log.f_path))
+
+    job_result["seconds"] = time.perf_counter() - start
+    return job_result
+
+
+def run_batch(result_config, jobs, logger, concurrency=1, workers=1):
+    '''
+    Пакетный режим: обрабатывает логи параллельно в пуле процессов (не больше concurrency одновременно).
+    Ошибка в одном логе не останавливает остальные. В конце пишет сводку скорости по каждому логу.
+    Возвращает список результатов run_batch_job.
+    '''
+
+    import concurrent.futures
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = {executor.submit(run_batch_job, result_config, latest_log, report_path, logger.name, workers):
+                   latest_log for latest_log, report_path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                logger.exception("Процесс обработки лога упал: {}".format(futures[future].f_path))
+                results.append({"log": str(futures[future].f_path), "ok": False, "lines": 0, "bytes": 0,
+                                "seconds": 0.0})
+
+    results.sort(key=lambda job_result: job_result["log"])
+    for job_result in results:
+        seconds = max(job_result["seconds"], 1e-9)
+        logger.info("{} - {}: {} строк за {:.2f} с ({:.0f} строк/с, {:.1f} МБ/с)".format(
+            "OK" if job_result["ok"] else "ОШИБКА", job_result["log"], job_result["lines"], job_result["seconds"],
+            job_result["lines"] / seconds, job_result["bytes"] / (1 << 20) / seconds))
+    logger.info("Обработано логов: {} из {}".format(sum(job_result["ok"] for job_result in results), len(results)))
+
+    return results
+
+
+def main(profiled=False):
+    '''
+    С --profile main выполняется еще раз внутри run_profiled (cProfile + tracemalloc).
+    1. Получаем результирующий config
+    2. Если отчет по последнему логу уже есть (is_report_ready) - выходим сразу, даже логер не создаем
+       Создаем логера
+    3. Проверяем параметры результирующего config
+    4. Режим --serve - запускаем HTTP сервер статистики (/top, /url), после отчета он работает до Ctrl+C
+       Режим --follow - отчеты за скользящие окна по текущему логу, пока не остановят
+       Подкоманда rollup - отчет по snapshot-ам за несколько дней
+       Подкоманда query - выборка по индексу лога в stdout (json)
+       В пакетном режиме (--from/--to/--all-missing) обрабатываем все логи без отчета и выходим
+       Иначе ищем файл последнего лога, если не находим конец
+    5. Проверяем есть ли уже отчет в указанной папке, если находим конец
+       (с кешем CACHE_DIR - и что отчет актуален по ключу report-YYYY.MM.DD.key, иначе перерисовываем)
+    6. Получаем статистику по логам (при попадании в кеш ResultCache - без чтения лога)
+    7. Создаем отчет и отчеты по срезам GROUP_BY, рядом пишем метрики по этапам (report-YYYY.MM.DD.metrics.json)
+       и ключ отчета
+    '''
+
+    str_start = "*************** Программа запущена ***************"
+    str_finish = "********************* Конец **********************"
+    star_time = time.time()
+
+    args = get_sys_args()
+    if args.profile and not profiled:
+        return run_profiled(main, args.profile, __name__, True)
+
+    metrics = PipelineMetrics()
+    config_path = args.config
+    if not os.path.exists(config_path):
+        sys.exit(1)
+
+    result_config = get_result_config(config, config_path)
+    if result_config is None:
+        sys.exit(1)
+
+    if is_report_ready(result_config, args):
+        sys.exit(0)
+
+    log_path = result_config.get('SELF_LOG_PATH')
+    if not os.path.exists(log_path):
+        log_path = None
+
+    logger = create_logger(__name__, file=log_path)
+    logger.info(str_start)
+
+    store = server = None
+    if args.serve:
+        store = StatsStore()
+        server = StatsServer(store, result_config["SERVE_HOST"], result_config["SERVE_PORT"], logger)
+        server.start()
+
+    if args.follow:
+        run_follow(result_config, logger, store=store)
+        logger.info(str_finish)
+        sys.exit(0)
+
+    if args.command == "rollup":
+        ok = run_rollup(result_config, logger, args.date_from, args.date_to, args.output)
+        logger.info(str_finish)
+        sys.exit(0 if ok else 1)
+
+    if args.command == "query":
+        rows = run_query(result_config, logger, args.date_from, args.top, args.sort, url_prefix=args.prefix,
+                         time_from=args.since, time_to=args.until, status=args.status)
+        if rows is not None:
+            print(json.dumps(rows, ensure_ascii=False, indent=2))
+        logger.info(str_finish)
+        sys.exit(0 if rows is not None else 1)
+
+    if args.date_from or args.date_to or args.all_missing:
+        jobs = plan_batch_jobs(result_config["LOG_DIR"], result_config["REPORT_DIR"], logger,
+                               args.date_from, args.date_to, result_config)
+        results = run_batch(result_config, jobs, logger, args.jobs, args.workers)
+        logger.info(str_finish)
+        sys.exit(0 if all(job_result["ok"] for job_result in results) else 1)
+
+    with metrics.stage("discovery"):
+        latest_log = find_latest_log(result_config["LOG_DIR"], logger)
+        if latest_log is not None:
+            incremental = result_config["INCREMENTAL"]
+            result_cache = None if incremental or args.serve else get_result_cache(result_config)
+            cache_key = get_cache_key(latest_log.f_path, result_config) if result_cache is not None else None
+            render_key = get_render_key(cache_key, result_config) if cache_key is not None else None
+            report_path = get_report_path(result_config["REPORT_DIR"], latest_log, logger, incremental or args.serve,
+                                          render_key)
+
+    if latest_log is None:
+        logger.info(str_finish)
+        sys.exit(0)
+
+    if report_path is None:
+        logger.info(str_finish)
+        sys.exit(0)
+
+    checkpoint_path = get_checkpoint_path(result_config["REPORT_DIR"], latest_log) if incremental else None
+
+    view_statistics = {}
+    try:
+        latency_factory = get_latency_factory(result_config)
+        url_normalizer = get_url_normalizer(result_config)
+        logs_statistic = get_logs_statistics(result_config["ERRORS_LIMIT_PERC"], latest_log, logger,
+                                             latency_factory, args.workers, get_result_parser(result_config),
+                                             checkpoint_path, url_normalizer,
+                                             get_result_snapshot_path(result_config, latest_log),
+                                             result_config["REPORT_SIZE"], result_config["TOP_URLS_LIMIT"],
+                                             metrics, store, get_group_by(result_config), view_statistics,
+                                             get_result_index_format(result_config), result_cache, cache_key)
+    except Exception:
+        logger.error("Аварийное завершение программы!!!")
+        logger.info(str_finish)
         sys.exit(1)
 
     if logs_statistic is None:
         logger.info(str_finish)
         sys.exit(1)
 
-    if not render_html_report(result_config, report_path, logs_statistic, logger):
+    with metrics.stage("render", len(logs_statistic)):
+        rendered = render_html_report(result_config, report_path, logs_statistic, logger) and \
+            render_view_reports(result_config, report_path, view_statistics, logger)
+    if not rendered:
         logger.info(str_finish)
         sys.exit(1)
+    if render_key is not None:
+        save_render_key(report_path, render_key, logger)
+
+    metrics.log(logger)
+    metrics.write(get_metrics_path(report_path), logger)
+
+    if server is not None:
+        server.join()
 
     logger.info(str_finish)
     logger.debug("Время выполнения программы: {}".format(datetime.timedelta(seconds=(time.time() - star_time))))
 
 
-if __name__ == "__main__":
+def run():
     try:
         main()
     except KeyboardInterrupt as err:
         logging.exception(err)
     except Exception as err:
         logging.exception(err)
+
+
+if __name__ == "__main__":
+    run()
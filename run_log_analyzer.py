@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Точка входа для cron: python run_log_analyzer.py --config "Путь", аргументы те же, что у log_analyzer.py.
+log_analyzer импортируется как модуль, поэтому берется байткод из __pycache__,
+а не компилируется весь файл на каждом запуске.
+'''
+
+import log_analyzer
+
+
+if __name__ == "__main__":
+    log_analyzer.run()
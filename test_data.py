@@ -52,3 +52,32 @@ parsed_line_tests = [
     (b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "-" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" -',
         (None, None, "bad_log"))
 ]
+
+log_lines_sample = [
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n',
+    b'1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.133\n',
+    b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 1020 "-" "Configovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.199\n',
+    b'1.199.4.96 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/slot/4705/groups HTTP/1.1" 200 2613 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-3800516057-4708-9752745" "2a828197ae235b0b3cb" 0.704\n',
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.811\n',
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "-" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n',
+]
+
+logs_statistics_sample = [
+    {"url": "/api/v2/banner/25019354", "count": 3, "count_perc": 50.0, "time_avg": 0.467, "time_max": 0.811,
+     "time_med": 0.39, "time_perc": 62.584, "time_sum": 1.4},
+    {"url": "/api/v2/slot/4705/groups", "count": 1, "count_perc": 16.667, "time_avg": 0.704, "time_max": 0.704,
+     "time_med": 0.704, "time_perc": 31.471, "time_sum": 0.704},
+    {"url": "/api/1/photogenic_banners/list/?server_name=WIN7RB4", "count": 1, "count_perc": 16.667,
+     "time_avg": 0.133, "time_max": 0.133, "time_med": 0.133, "time_perc": 5.945, "time_sum": 0.133}
+]
+
+normalized_url_tests = [
+    ("/api/v2/banner/25019354", "/api/v2/banner/{id}"),
+    ("/api/1/photogenic_banners/list/?server_name=WIN7RB4", "/api/{id}/photogenic_banners/list/"),
+    ("/export/appinstall_raw/2017-06-29/", "/export/appinstall_raw/2017-06-29/"),
+    ("/api/v2/slot/4705/groups", "/api/v2/slot/{id}/groups"),
+    ("/api/v2/internal/revenue_share/service/276/partner/1f2c6c3a9b/statistic/v2",
+     "/api/v2/internal/revenue_share/service/{id}/partner/{hex}/statistic/v2"),
+    ("/agency/banners_stats/6f1f1bb3-3a69-4c2c-9a5e-2c27c8d6bbf5/", "/agency/banners_stats/{uuid}/"),
+    ("/api/v2/group/deadbeefcafe", "/api/v2/group/deadbeefcafe"),
+]
@@ -1,18 +1,161 @@
+import urllib.request
+import urllib.parse
+import urllib.error
+import unittest.mock
 import unittest
+import tempfile
+import shutil
+import pickle
+import gzip
+import json
+import subprocess
+import statistics
+import random
+import math
+import time
+import string
+import sys
 import os
 import re
 
+from datetime import datetime
+
+
+import log_analyzer
 
 from log_analyzer import create_logger
 from log_analyzer import get_result_config
 from log_analyzer import get_parsed_line
 from log_analyzer import find_latest_log
+from log_analyzer import get_logs_statistics
+from log_analyzer import get_logs_aggregate
+from log_analyzer import get_latency_factory
+from log_analyzer import get_file_chunks
+from log_analyzer import GzipLineReader
+from log_analyzer import get_checkpoint_path
+from log_analyzer import get_url_normalizer
+from log_analyzer import UrlNormalizer
+from log_analyzer import plan_batch_jobs
+from log_analyzer import run_batch
+from log_analyzer import save_snapshot
+from log_analyzer import load_snapshot
+from log_analyzer import get_rollup_statistics
+from log_analyzer import render_html_report
+from log_analyzer import FileSubscribe
+from log_analyzer import LogsAggregate
+from log_analyzer import LOG_PARSERS
+from log_analyzer import ExactLatency
+from log_analyzer import SketchLatency
+from log_analyzer import SlidingWindowAggregate
+from log_analyzer import LogFollower
+from log_analyzer import StatsStore
+from log_analyzer import StatsServer
+from log_analyzer import PipelineMetrics
+from log_analyzer import get_metrics_path
+from log_analyzer import check_log_format
+from log_analyzer import get_error_rate_bounds
+from log_analyzer import read_sample_lines
+from log_analyzer import compile_log_format
+from log_analyzer import get_result_parser
+from log_analyzer import LOG_FORMAT_UI_SHORT
+from log_analyzer import aggregate_plain_log
+from log_analyzer import get_group_by
+from log_analyzer import get_follow_max_urls
+from log_analyzer import build_log_index
+from log_analyzer import find_log_index
+from log_analyzer import get_log_index_key
+from log_analyzer import LogIndex
+from log_analyzer import run_query
+from log_analyzer import BadLines
+from log_analyzer import ResultCache
+from log_analyzer import get_cache_key
+from log_analyzer import get_render_key
+from log_analyzer import get_report_path
+from log_analyzer import VectorLogsAggregate
+from log_analyzer import create_aggregate
+from log_analyzer import get_numpy
+
+from bench_log_analyzer import generate_log_file
+from bench_log_analyzer import generate_log_lines
 
 from test_data import compare_tests
 from test_data import parsed_line_tests
+from test_data import log_lines_sample
+from test_data import logs_statistics_sample
+from test_data import normalized_url_tests
 
 logger = create_logger("test")
 
+STARTUP_BUDGET_MS = 80   # Запуск из cron, когда отчет уже есть: медиана сверх python -c pass, мс
+STARTUP_BUDGET_ENV = "LOG_ANALYZER_STARTUP_BUDGET_MS"   # Другой бюджет в мс для медленных стендов
+STARTUP_RUNS = 5
+STARTUP_LAZY_MODULES = ("asyncio", "concurrent.futures", "statistics", "_strptime", "gzip")
+
+
+def get_import_times(*args):
+    '''
+    Запускает интерпретатор с -X importtime и возвращает результат запуска, stderr без строк importtime
+    и имена всех импортированных модулей.
+    '''
+
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], capture_output=True, text=True, timeout=60)
+    names = re.findall(r'^import time:\s+\d+ \|\s+\d+ \| *(\S+)$', result.stderr, re.MULTILINE)
+    errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+    return result, errors, names
+
+
+def get_run_time_ms(*args):
+    '''
+    Медиана времени запуска интерпретатора с args по STARTUP_RUNS запускам, мс. Байткод пишется в __pycache__,
+    как при обычном запуске, первый (прогревочный) запуск не считается.
+    '''
+
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    times = []
+    for _ in range(STARTUP_RUNS + 1):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], env=env, capture_output=True, check=True, timeout=60)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times[1:])[STARTUP_RUNS // 2]
+
+
+def get_reference_rows(requests, max_urls=None):
+    '''
+    Статистика по [(url, request_time)] на словаре {url: {stat}}, как до колоночного LogsAggregate.
+    С max_urls - то же вытеснение: перед новым url, когда их уже 2 * max_urls, остаются max_urls с наибольшим time_sum.
+    Возвращает (строки по убыванию time_sum, {url: время запросов по порядку}, сколько url вытеснено).
+    '''
+
+    common_stat, pruned_sums = {}, []
+    for url, request_time in requests:
+        if url not in common_stat and max_urls and len(common_stat) >= 2 * max_urls:
+            keep = set(sorted(common_stat, key=lambda key: common_stat[key]["time_sum"], reverse=True)[:max_urls])
+            pruned_sums.extend(common_stat.pop(key)["time_sum"] for key in list(common_stat) if key not in keep)
+        url_stat = common_stat.setdefault(url, {"count": 0, "time_sum": 0.0, "time_max": 0.0, "times": []})
+        url_stat["count"] += 1
+        url_stat["time_sum"] = round(url_stat["time_sum"] + request_time, 3)
+        if request_time > url_stat["time_max"]:
+            url_stat["time_max"] = round(request_time, 3)
+        url_stat["times"].append(request_time)
+
+    time_sum_all_req = math.fsum(url_stat["time_sum"] for url_stat in common_stat.values()) + math.fsum(pruned_sums)
+    rows = [{"url": url, "count": url_stat["count"], "time_max": url_stat["time_max"], "time_sum": url_stat["time_sum"],
+             "count_perc": round(url_stat["count"] / len(requests) * 100, 3),
+             "time_perc": round(url_stat["time_sum"] / time_sum_all_req * 100, 3),
+             "time_avg": round(url_stat["time_sum"] / url_stat["count"], 3),
+             "time_med": round(statistics.median(url_stat["times"]), 3)}
+            for url, url_stat in common_stat.items()]
+    rows.sort(key=lambda row: (-row["time_sum"], row["url"]))
+    return rows, {url: url_stat["times"] for url, url_stat in common_stat.items()}, len(pruned_sums)
+
+
+def get_aggregate(requests, max_urls=None):
+    aggregate = LogsAggregate(max_urls=max_urls)
+    for url, request_time in requests:
+        aggregate.add(url, request_time)
+    aggregate.number_of_logs = len(requests)
+    return aggregate
+
 
 class LogAnalyzerTest(unittest.TestCase):
 
@@ -26,12 +169,835 @@ class LogAnalyzerTest(unittest.TestCase):
         regex = re.compile(r'(?:GET|POST|HEAD|PUT|OPTIONS|DELETE).(.*).HTTP/.* (\d{1,6}[.]\d+)')
 
         for log_str, tlp in parsed_line_tests:
-            self.assertEqual(get_parsed_line(regex, log_str, logger), tlp)
+            self.assertEqual(get_parsed_line(regex, log_str), tlp)
+
+    def test_log_parsers(self):
+        log_lines = log_lines_sample + [log_str for log_str, _ in parsed_line_tests]
+        results = {}
+
+        for name, parse in LOG_PARSERS.items():
+            aggregate = LogsAggregate()
+            self.assertTrue(parse(log_lines, aggregate, logger))
+            results[name] = (aggregate.number_of_logs, aggregate.bad_logs, aggregate.finalize())
+
+        self.assertEqual(results["fast"], results["regex"])
+        self.assertEqual(results["fast"][:2], (10, 3))
 
     def test_find_latest_log(self):
         latest_log = find_latest_log("./tests/latest_log/", logger)
         self.assertEqual(os.path.basename(latest_log.f_path), "nginx-access-ui.log-20180730")
 
+    def test_get_logs_statistics(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines_sample)
+
+        latest_log = FileSubscribe(None, log_path, "")
+        self.assertEqual(get_logs_statistics(50, latest_log, logger), logs_statistics_sample)
+        self.assertIsNone(get_logs_statistics(5, latest_log, logger))
+
+        sketch_stat = get_logs_statistics(50, latest_log, logger, get_latency_factory({"LATENCY_MODE": "sketch"}))
+        self.assertEqual(sketch_stat[0]["count"], 3)
+        self.assertIn("time_p99", sketch_stat[0])
+
+    def test_get_logs_statistics_workers(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines_sample * 50)
+
+        chunks = get_file_chunks(log_path, 4)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(log_path))
+        with open(log_path, 'rb') as log_file:
+            for start, _ in chunks[1:]:
+                log_file.seek(start - 1)
+                self.assertEqual(log_file.read(1), b"\n")
+
+        latest_log = FileSubscribe(None, log_path, "")
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, workers=4),
+                         get_logs_statistics(50, latest_log, logger))
+
+    def test_gzip_line_reader(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        gz_path = log_path + ".gz"
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines_sample * 50)
+        with open(gz_path, 'wb') as gz_file:
+            for _ in range(5):
+                gz_file.write(gzip.compress(b"".join(log_lines_sample * 10)))
+
+        lines = [line.rstrip(b"\n") for line in log_lines_sample * 50]
+        self.assertEqual(list(GzipLineReader(gz_path, block_size=512)), lines)
+
+        # Архив из одного member-а не сканируется в поисках границ member-ов
+        single_path = os.path.join(tmp_dir, "single.gz")
+        with open(single_path, 'wb') as gz_file:
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 50)))
+        with unittest.mock.patch.object(GzipLineReader, "iter_member_offsets") as iter_member_offsets:
+            self.assertEqual(list(GzipLineReader(single_path, workers=2, block_size=512)), lines)
+        iter_member_offsets.assert_not_called()
+
+        reader = GzipLineReader(gz_path, workers=2, block_size=512)
+        self.assertEqual(list(reader), lines)
+        self.assertEqual(reader.stats["members"], 5)
+        self.assertGreater(reader.stats["decompress_time"], 0)
+
+        self.assertEqual(get_logs_statistics(50, FileSubscribe(None, gz_path, ".gz"), logger, workers=2),
+                         get_logs_statistics(50, FileSubscribe(None, log_path, ""), logger))
+
+        # member-ы отдаются блоками через очередь на один блок, заголовок gzip внутри данных - не member
+        mixed_path = os.path.join(tmp_dir, "mixed.gz")
+        with open(mixed_path, 'wb') as gz_file:
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 10)))
+            gz_file.write(gzip.compress(b"\x1f\x8b\x08 not a member\n" * 100, compresslevel=0))
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 40)))
+        reader = GzipLineReader(mixed_path, workers=2, block_size=64, queue_size=1, member_queue_size=1)
+        self.assertEqual(list(reader), [line.rstrip(b"\n") for line in log_lines_sample * 10] +
+                         [b"\x1f\x8b\x08 not a member"] * 100 + lines[:len(log_lines_sample) * 40])
+        self.assertEqual(reader.stats["members"], 3)
+        self.assertEqual(reader.stats["raw_bytes"], os.path.getsize(mixed_path))
+
+        # Нули после member-ов (как у ленточных архивов) gzip.open и zcat пропускают - и мы тоже
+        padded_path = os.path.join(tmp_dir, "padded.gz")
+        with open(padded_path, 'wb') as gz_file:
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 20)) + b"\x00" * 1000)
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 30)) + b"\x00" * 100)
+        for workers in (1, 2):
+            reader = GzipLineReader(padded_path, workers=workers, block_size=512)
+            self.assertEqual(list(reader), lines)
+            self.assertEqual(reader.stats["members"], 2)
+        self.assertEqual(get_logs_statistics(50, FileSubscribe(None, padded_path, ".gz"), logger, workers=2),
+                         get_logs_statistics(50, FileSubscribe(None, log_path, ""), logger))
+
+    def test_get_logs_statistics_checkpoint(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        latest_log = FileSubscribe(datetime(2017, 6, 30), log_path, "")
+        checkpoint_path = get_checkpoint_path(tmp_dir, latest_log)
+        head, tail = b"".join(log_lines_sample * 5), b"".join(log_lines_sample * 7)
+
+        with open(log_path, 'wb') as log_file:
+            log_file.write(head)
+        head_stat = get_logs_statistics(50, latest_log, logger)
+
+        with open(log_path, 'wb') as log_file:
+            log_file.write(head + tail[:50])
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, checkpoint_path=checkpoint_path), head_stat)
+        self.assertTrue(os.path.exists(checkpoint_path))
+
+        with open(log_path, 'wb') as log_file:
+            log_file.write(head + tail)
+        incremental_stat = get_logs_statistics(50, latest_log, logger, checkpoint_path=checkpoint_path)
+        self.assertEqual(incremental_stat, get_logs_statistics(50, latest_log, logger))
+
+        with open(log_path, 'wb') as log_file:
+            log_file.write(head)
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, checkpoint_path=checkpoint_path), head_stat)
+
+    def test_url_normalizer(self):
+        self.assertIsNone(get_url_normalizer({"URL_NORMALIZE": False}))
+        url_normalizer = get_url_normalizer({"URL_NORMALIZE": True})
+
+        for url, normalized_url in normalized_url_tests:
+            self.assertEqual(url_normalizer(url), normalized_url)
+
+        rules_normalizer = UrlNormalizer(False, False, [[r"^/export/.*", "/export/*"]])
+        self.assertEqual(rules_normalizer("/export/appinstall_raw/2017-06-29/"), "/export/*")
+        self.assertEqual(rules_normalizer("/api/v2/banner/25019354"), "/api/v2/banner/25019354")
+        self.assertEqual(pickle.loads(pickle.dumps(rules_normalizer))("/export/1/"), "/export/*")
+
+        aggregate = LogsAggregate(url_normalizer=url_normalizer)
+        self.assertTrue(LOG_PARSERS["fast"](log_lines_sample, aggregate, logger))
+        self.assertEqual([row["url"] for row in aggregate.finalize()],
+                         ["/api/v2/banner/{id}", "/api/v2/slot/{id}/groups", "/api/{id}/photogenic_banners/list/"])
+
+    def test_batch_mode(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        for name, log_lines in (("nginx-access-ui.log-20170629", log_lines_sample[:5]),
+                                ("nginx-access-ui.log-20170630", log_lines_sample[:5]),
+                                ("nginx-access-ui.log-20170701", log_lines_sample[5:]),
+                                ("nginx-access-ui.log-20170702", log_lines_sample[:5])):
+            with open(os.path.join(tmp_dir, name), 'wb') as log_file:
+                log_file.writelines(log_lines)
+        with open(os.path.join(tmp_dir, "report-2017.06.30.html"), 'w') as report:
+            report.write("")
+
+        jobs = plan_batch_jobs(tmp_dir, tmp_dir, logger, date_to=datetime(2017, 7, 1))
+        self.assertEqual([os.path.basename(report_path) for _, report_path in jobs],
+                         ["report-2017.06.29.html", "report-2017.07.01.html"])
+
+        result_config = {**compare_tests[1][2], "LOG_PARSER": "fast", "REPORT_DIR": tmp_dir}
+        results = run_batch(result_config, jobs, logger, concurrency=2)
+        self.assertEqual([(job_result["ok"], job_result["lines"]) for job_result in results], [(True, 5), (False, 0)])
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, "report-2017.06.29.html")))
+
+    def test_snapshot_rollup(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        snapshot_paths = [os.path.join(tmp_dir, "snapshot-2017.06.29.bin"),
+                          os.path.join(tmp_dir, "snapshot-2017.06.30.bin")]
+        full_aggregate = LogsAggregate()
+
+        for snapshot_path, log_lines in zip(snapshot_paths, (log_lines_sample[:3], log_lines_sample[3:])):
+            aggregate = LogsAggregate()
+            LOG_PARSERS["fast"](log_lines, aggregate, logger)
+            LOG_PARSERS["fast"](log_lines, full_aggregate, logger)
+            save_snapshot(snapshot_path, aggregate, logger)
+
+        snapshot = load_snapshot(snapshot_paths[0])
+        self.assertEqual((snapshot.number_of_logs, snapshot.bad_logs, snapshot.urls),
+                         (3, 0, ["/api/v2/banner/25019354", "/api/1/photogenic_banners/list/?server_name=WIN7RB4"]))
+
+        expected = full_aggregate.finalize()
+        rollup = get_rollup_statistics(snapshot_paths, logger)
+        key_fields = ("url", "count", "count_perc", "time_sum", "time_max", "time_avg", "time_perc")
+        self.assertEqual([[row[key] for key in key_fields] for row in rollup],
+                         [[row[key] for key in key_fields] for row in expected])
+        for row, expected_row in zip(rollup, expected):
+            self.assertAlmostEqual(row["time_med"], expected_row["time_med"], delta=expected_row["time_med"] * 0.02)
+            self.assertIn("time_p99", row)
+
+        # Sketch-и для snapshot-а собираются пачкой, но совпадают с добавлением запросов по одному
+        log_lines = generate_log_lines(3000, urls=40, zipf=1.1)
+        for aggregate_class in (LogsAggregate, VectorLogsAggregate) if get_numpy() else (LogsAggregate,):
+            aggregate = aggregate_class()
+            LOG_PARSERS["fast"](log_lines, aggregate, logger)
+            buffer, offsets = aggregate.get_flat_samples()
+            expected = []
+            for url_id in range(len(aggregate.urls)):
+                sketch = SketchLatency()
+                for request_time in buffer[offsets[url_id]:offsets[url_id + 1]]:
+                    sketch.add(request_time)
+                expected.append((sketch.count, sketch.zero_count, sketch.bins))
+            self.assertEqual([(sketch.count, sketch.zero_count, sketch.bins) for sketch in aggregate.get_sketches()],
+                             expected)
+            self.assertGreater(sum(sketch.zero_count for sketch in aggregate.get_sketches()), 0)
+
+    def test_generate_log_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630.gz")
+        generate_log_file(log_path, 20000, urls=50, zipf=1.2, bad_ratio=0.05, compress=True)
+
+        aggregate = LogsAggregate()
+        self.assertTrue(LOG_PARSERS["fast"](GzipLineReader(log_path), aggregate, logger))
+        self.assertEqual(aggregate.number_of_logs, 20000)
+        self.assertAlmostEqual(aggregate.bad_logs / aggregate.number_of_logs, 0.05, delta=0.01)
+        rows = aggregate.finalize()
+        self.assertLessEqual(len(rows), 50)
+        self.assertGreater(rows[0]["count"], rows[-1]["count"] * 10)
+
+    def test_finalize_top_k(self):
+        log_lines = generate_log_lines(5000, urls=300, zipf=1.1)
+        aggregate = LogsAggregate()
+        LOG_PARSERS["fast"](log_lines, aggregate, logger)
+        full = aggregate.finalize()
+        self.assertEqual(aggregate.finalize(20), full[:20])
+
+        heavy_hitters = LogsAggregate(max_urls=50)
+        LOG_PARSERS["fast"](log_lines, heavy_hitters, logger)
+        self.assertLessEqual(len(heavy_hitters.urls), 100)
+        self.assertGreater(heavy_hitters.pruned_urls, 0)
+        top = heavy_hitters.finalize(10)
+        self.assertEqual([row["url"] for row in top], [row["url"] for row in full[:10]])
+        self.assertEqual([row["time_perc"] for row in top], [row["time_perc"] for row in full[:10]])
+
+    def test_logs_aggregate_columnar(self):
+        rng = random.Random(0)
+        requests = [("/api/{}".format(int(300 * rng.random() ** 2)), round(rng.uniform(0.001, 3.0), 3))
+                    for _ in range(6000)]
+        by_time_sum = dict(key=lambda row: (-row["time_sum"], row["url"]))
+
+        def get_flat_samples(aggregate):
+            buffer, offsets = aggregate.get_flat_samples()
+            return {url: list(buffer[offsets[url_id]:offsets[url_id + 1]]) for url_id, url in enumerate(aggregate.urls)}
+
+        expected, expected_samples, _ = get_reference_rows(requests)
+        aggregate = get_aggregate(requests)
+        self.assertEqual(sorted(aggregate.finalize(), **by_time_sum), expected)
+        self.assertEqual(get_flat_samples(aggregate), expected_samples)
+        self.assertEqual(sorted(aggregate.finalize(10), **by_time_sum), expected[:10])
+
+        # merge частей в любом порядке url дает то же, что один проход по словарю
+        parts = [get_aggregate(requests[:1000]), get_aggregate(requests[1000:1001]), get_aggregate(requests[1001:])]
+        merged = parts[2].merge(parts[0]).merge(parts[1])
+        self.assertEqual(sorted(merged.finalize(), **by_time_sum), expected)
+        self.assertEqual({url: sorted(times) for url, times in get_flat_samples(merged).items()},
+                         {url: sorted(times) for url, times in expected_samples.items()})
+
+        # Граница вытеснения: 2 * max_urls url держатся все, новый url сверх них оставляет max_urls лучших + себя
+        max_urls = 5
+        boundary = [("/url/{}".format(index), float(index + 1)) for index in range(2 * max_urls)]
+        aggregate = get_aggregate(boundary + [("/url/0", 1.0)], max_urls)
+        self.assertEqual((len(aggregate.urls), aggregate.pruned_urls), (2 * max_urls, 0))
+        aggregate = get_aggregate(boundary + [("/url/new", 0.5)], max_urls)
+        self.assertEqual(aggregate.urls, ["/url/{}".format(index) for index in range(max_urls, 2 * max_urls)] +
+                         ["/url/new"])
+        self.assertEqual((aggregate.pruned_urls, aggregate.pruned_time_sum, aggregate.pruned_time_max),
+                         (max_urls, 15.0, 5.0))
+
+        for max_urls in (20, 50):
+            expected, expected_samples, pruned_urls = get_reference_rows(requests, max_urls)
+            aggregate = get_aggregate(requests, max_urls)
+            self.assertGreater(pruned_urls, 0)
+            self.assertEqual(aggregate.pruned_urls, pruned_urls)
+            self.assertEqual(sorted(aggregate.finalize(), **by_time_sum), expected)
+            self.assertEqual(get_flat_samples(aggregate), expected_samples)
+
+    def test_render_html_report(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        template_path = os.path.join(tmp_dir, "report.html")
+        report_path = os.path.join(tmp_dir, "report-2017.06.30.html")
+        with open(template_path, 'w', encoding='utf-8') as tmpl:
+            tmpl.write("<script>var a = $table_json; var b = ${table_json}; $$('x'); $(document)</script>")
+
+        result_config = {"TEMPLATE_PATH": template_path, "REPORT_SIZE": 2}
+        self.assertTrue(render_html_report(result_config, report_path, logs_statistics_sample, logger))
+        with open(report_path, encoding='utf-8') as report, open(template_path, encoding='utf-8') as tmpl:
+            expected = string.Template(tmpl.read()).safe_substitute(
+                table_json=json.dumps(logs_statistics_sample[:2]))
+            self.assertEqual(report.read(), expected)
+
+        with open(template_path, 'w', encoding='utf-8') as tmpl:
+            tmpl.write("<html>no placeholder</html>")
+        os.utime(template_path, ns=(0, 0))
+        self.assertFalse(render_html_report(result_config, report_path + ".new", logs_statistics_sample, logger))
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ["report-2017.06.30.html", "report.html"])
+
+    def test_latency_aggregators(self):
+        values = [i / 1000 for i in range(1, 10001)]
+        exact, sketch = ExactLatency(), SketchLatency(0.01)
+        for value in values:
+            exact.add(value)
+            sketch.add(value)
+
+        self.assertAlmostEqual(exact.median(), 5.0005)
+        self.assertAlmostEqual(sketch.median(), exact.median(), delta=exact.median() * 0.01)
+        self.assertAlmostEqual(sketch.quantile(0.99), 9.9, delta=9.9 * 0.01)
+
+        other = SketchLatency(0.01)
+        other.add(100.0, count=len(values))
+        sketch.merge(other)
+        self.assertAlmostEqual(sketch.quantile(0.9), 100.0, delta=1.0)
+
+    def test_sliding_window_aggregate(self):
+        log_lines = generate_log_lines(60, urls=3)
+        windows = SlidingWindowAggregate((5, 15), bucket_seconds=60)
+        self.assertEqual(windows.bucket_count, 15)
+
+        for minute in range(20):
+            LOG_PARSERS["fast"](log_lines[minute * 3:minute * 3 + 3], windows.current(minute * 60 + 30), logger)
+
+        now = 19 * 60 + 59
+        self.assertEqual(windows.get_window(5, now).number_of_logs, 15)
+        self.assertEqual(windows.get_window(15, now).number_of_logs, 45)
+        self.assertEqual(sum(row["count"] for row in windows.get_window(5, now).finalize()), 15)
+        self.assertEqual(windows.get_window(5, now + 3600).number_of_logs, 0)
+        self.assertEqual(sum(bucket is not None for bucket in windows.buckets), 15)
+
+        self.assertEqual(windows.max_urls, 1000)
+        self.assertEqual(get_follow_max_urls({"TOP_URLS_LIMIT": 0, "FOLLOW_TOP_URLS_LIMIT": 50}), 50)
+        self.assertEqual(get_follow_max_urls({"TOP_URLS_LIMIT": 20, "FOLLOW_TOP_URLS_LIMIT": 50}), 20)
+        self.assertEqual(get_follow_max_urls({"TOP_URLS_LIMIT": 0}), 1000)
+
+        capped = SlidingWindowAggregate((5,), bucket_seconds=60, max_urls=10)
+        many_urls = generate_log_lines(3000, urls=500)
+        for minute in range(10):
+            LOG_PARSERS["fast"](many_urls[minute * 300:minute * 300 + 300], capped.current(minute * 60 + 30), logger)
+        self.assertTrue(all(len(bucket.urls) <= 20 for bucket in capped.buckets if bucket is not None))
+        window = capped.get_window(5, 9 * 60 + 59)
+        self.assertLessEqual(len(window.urls), 20)
+        self.assertEqual(window.number_of_logs, 1500)
+
+    def test_log_follower(self):
+        tmp_dir = tempfile.mkdtemp()
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log")
+        try:
+            with open(log_path, 'wb') as log_file:
+                log_file.write(b"old\n")
+            follower = LogFollower(log_path)
+            self.assertEqual(follower.read_lines(), [])
+
+            with open(log_path, 'ab') as log_file:
+                log_file.write(b"line 1\nline")
+            self.assertEqual(follower.read_lines(), [b"line 1"])
+
+            with open(log_path, 'ab') as log_file:
+                log_file.write(b" 2\nline 3\n")
+            os.rename(log_path, log_path + "-20170630")
+            with open(log_path, 'wb') as log_file:
+                log_file.write(b"new 1\n")
+            self.assertEqual(follower.read_lines(), [b"line 2", b"line 3", b"new 1"])
+
+            with open(log_path, 'wb') as log_file:
+                log_file.write(b"cut\n")
+            self.assertEqual(follower.read_lines(), [b"cut"])
+            follower.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_stats_server(self):
+        store = StatsStore()
+        server = StatsServer(store, "127.0.0.1", 0, logger)
+        server.start()
+        self.assertTrue(server.started.wait(5))
+        base_url = "http://127.0.0.1:{}".format(server.port)
+
+        def get(path):
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=5) as response:
+                    return response.status, json.loads(response.read())
+            except urllib.error.HTTPError as err:
+                return err.code, json.loads(err.read())
+
+        try:
+            self.assertEqual(get("/top")[0], 503)
+
+            log_lines = generate_log_lines(3000, urls=50, zipf=1.1)
+            expected = LogsAggregate()
+            LOG_PARSERS["fast"](log_lines, expected, logger)
+            for start in range(0, len(log_lines), 1000):
+                batch = LogsAggregate()
+                LOG_PARSERS["fast"](log_lines[start:start + 1000], batch, logger)
+                store.ingest(batch)
+            store.flush()
+
+            status, top = get("/top?n=5")
+            self.assertEqual(status, 200)
+            self.assertEqual(top["lines"], 3000)
+            self.assertEqual(top["table"], expected.finalize(5))
+            self.assertEqual(get("/top?n=3&sort=count")[1]["table"], expected.finalize(3, "count"))
+            self.assertIn(("top", 3, "count"), store.views)
+
+            url = top["table"][0]["url"]
+            self.assertEqual(get("/url?path=" + urllib.parse.quote(url)), (200, top["table"][0]))
+            self.assertEqual(get("/url?path=/nope")[0], 404)
+            self.assertEqual(get("/top?sort=median")[0], 400)
+
+            extra = LogsAggregate()
+            LOG_PARSERS["fast"](log_lines[:10], extra, logger)
+            store.ingest(extra)
+            self.assertEqual(store.views, {})
+            self.assertEqual(get("/top?n=1")[1]["lines"], 3010)
+
+            with store.lock:
+                self.assertFalse(store.ingest(extra))
+            self.assertEqual(get("/top?n=1")[1]["lines"], 3020)
+        finally:
+            server.stop()
+            server.join(5)
+
+    def test_pipeline_metrics(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630.gz")
+        with open(log_path, 'wb') as gz_file:
+            gz_file.write(gzip.compress(b"".join(log_lines_sample * 10)))
+
+        metrics = PipelineMetrics()
+        logs_statistic = get_logs_statistics(50, FileSubscribe(None, log_path, ".gz"), logger, report_size=2,
+                                             metrics=metrics)
+        self.assertEqual(metrics.counters, {"lines": 60, "bad_lines": 10, "bad_line_reasons": {"format": 10},
+                                            "urls": 3})
+        self.assertEqual(metrics.stages["parse"]["items"], 60)
+        self.assertEqual(metrics.stages["decompress"]["items"], len(b"".join(log_lines_sample * 10)))
+        self.assertEqual(metrics.stages["finalize"]["items"], len(logs_statistic))
+
+        @metrics.timed("render")
+        def render():
+            return "done"
+
+        self.assertEqual(render(), "done")
+        self.assertEqual(render.__name__, "render")
+        self.assertIn("render", metrics.stages)
+
+        metrics_path = get_metrics_path(os.path.join(tmp_dir, "report-2017.06.30.html"))
+        self.assertEqual(metrics_path.name, "report-2017.06.30.metrics.json")
+        self.assertTrue(metrics.write(metrics_path, logger))
+        with open(metrics_path, encoding='utf-8') as metrics_file:
+            self.assertEqual(json.load(metrics_file)["counters"]["lines"], 60)
+
+    def test_check_log_format(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        good_lines = generate_log_lines(5000, urls=100)
+        bad_lines = [line.replace(b'"GET ', b'"').replace(b'"POST ', b'"') for line in good_lines]
+
+        lower, upper = get_error_rate_bounds(5, 100)
+        self.assertLess(lower, 5)
+        self.assertGreater(upper, 5)
+        self.assertGreater(get_error_rate_bounds(100, 100)[0], 90)
+
+        for ext in ("", ".gz"):
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630" + ext)
+            for log_lines, expected in ((good_lines, True), (bad_lines, False)):
+                data = b"".join(log_lines)
+                with open(log_path, 'wb') as log_file:
+                    log_file.write(gzip.compress(data) if ext else data)
+                latest_log = FileSubscribe(None, log_path, ext)
+                sample = read_sample_lines(latest_log)
+                self.assertEqual(len(sample), 1024)
+                self.assertTrue(all(line.rstrip(b"\n") in data for line in sample))
+                self.assertEqual(check_log_format(latest_log, 5, logger), expected)
+
+    def test_error_limit_early_stop(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        good_lines = generate_log_lines(20000, urls=100)
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(good_lines[:10000])
+            log_file.writelines(line.replace(b" HTTP/", b" ") for line in good_lines[10000:])
+
+        latest_log = FileSubscribe(None, log_path, "")
+        self.assertIsNone(get_logs_statistics(5, latest_log, logger))
+
+        with unittest.mock.patch.multiple(log_analyzer, ERROR_CHECK_LINES=1000, ERROR_CHECK_BYTES=1 << 16):
+            aggregate = get_logs_aggregate(latest_log, logger, error_limits=5)
+            self.assertLess(aggregate.number_of_logs, 20000)
+            self.assertGreater(aggregate.bad_logs * 100, 5 * aggregate.number_of_logs)
+            self.assertEqual(get_logs_aggregate(latest_log, logger, error_limits=60).number_of_logs, 20000)
+
+            # Граница длины строки - по тому, что принимает сам парсер: короткие строки fast и regex не обрывают чтение
+            short_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170629")
+            with open(short_path, 'wb') as log_file:
+                log_file.writelines([b'"GET /a" 0.1\n'] * 3000 + [b'"GET /a HTTP/1.1" 0.1\n'] * 9000)
+            for parser in ("fast", "regex"):
+                aggregate = get_logs_aggregate(FileSubscribe(None, short_path, ""), logger, parser=parser,
+                                               error_limits=30)
+                self.assertEqual((aggregate.number_of_logs, aggregate.bad_logs), (12000, 3000))
+
+        format_parser = LOG_PARSERS["format"]
+        shortest_line = re.sub(r'\$\w+', '', LOG_FORMAT_UI_SHORT.replace("$request_time", "0").replace(
+            "$request", "GET  HTTP/")).encode("utf-8") + b"\n"
+        aggregate = LogsAggregate()
+        format_parser([shortest_line], aggregate, logger)
+        self.assertEqual((aggregate.bad_logs, len(shortest_line)), (0, format_parser.min_line_size))
+
+        # Пачка ошибок в начале дописанного хвоста: по одному хвосту лимит не выполнить, а по всему логу - да
+        latest_log = FileSubscribe(datetime(2017, 6, 30), log_path, "")
+        checkpoint_path = get_checkpoint_path(tmp_dir, latest_log)
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(good_lines)
+        self.assertIsNotNone(get_logs_statistics(10, latest_log, logger, checkpoint_path=checkpoint_path))
+        with open(log_path, 'ab') as log_file:
+            log_file.writelines(line.replace(b" HTTP/", b" ") for line in good_lines[:1000])
+            log_file.writelines(good_lines[:1000])
+
+        with unittest.mock.patch.multiple(log_analyzer, ERROR_CHECK_LINES=100, ERROR_CHECK_BYTES=1 << 14):
+            metrics = PipelineMetrics()
+            incremental_stat = get_logs_statistics(10, latest_log, logger, checkpoint_path=checkpoint_path,
+                                                   metrics=metrics)
+        self.assertEqual(metrics.counters["lines"], 22000)
+        self.assertEqual(incremental_stat, get_logs_statistics(10, latest_log, logger))
+
+    def test_compile_log_format(self):
+        log_lines = log_lines_sample + [log_str for log_str, _ in parsed_line_tests] + generate_log_lines(2000)
+        results = {}
+        for name in ("fast", "format"):
+            aggregate = LogsAggregate()
+            self.assertTrue(LOG_PARSERS[name](log_lines, aggregate, logger))
+            results[name] = (aggregate.number_of_logs, aggregate.bad_logs, aggregate.finalize())
+        self.assertEqual(results["format"], results["fast"])
+
+        parser = compile_log_format(LOG_FORMAT_UI_SHORT, ("status", "body_bytes_sent"))
+        self.assertIs(parser, compile_log_format(LOG_FORMAT_UI_SHORT, ("status", "body_bytes_sent")))
+        self.assertIs(pickle.loads(pickle.dumps(parser)), parser)
+        self.assertEqual(parser.extract(log_lines_sample[0]),
+                         {"method": b"GET", "url": b"/api/v2/banner/25019354", "status": b"200",
+                          "body_bytes_sent": b"927", "request_time": b"0.390"})
+        self.assertIsNone(parser.extract(log_lines_sample[5]))
+
+        custom = compile_log_format('$remote_addr [$time_local] "$request" $status $request_time '
+                                    '$upstream_response_time', ("upstream_response_time",))
+        line = b'10.0.0.1 [29/Jun/2017:03:50:22 +0300] "POST /api/1 HTTP/1.1" 200 0.250 0.240\n'
+        self.assertEqual(custom.extract(line)["upstream_response_time"], b"0.240")
+        aggregate = LogsAggregate()
+        custom([line, line.rstrip(b"\n")], aggregate, logger)
+        self.assertEqual((aggregate.number_of_logs, aggregate.bad_logs, aggregate.urls), (2, 0, ["/api/1"]))
+
+        self.assertIs(get_result_parser({"LOG_PARSER": "format", "LOG_FORMAT": LOG_FORMAT_UI_SHORT}),
+                      LOG_PARSERS["format"])
+        with self.assertRaises(ValueError):
+            compile_log_format('$remote_addr "$request"')
+
+    def test_aggregate_plain_log_mmap(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines_sample + generate_log_lines(3000, urls=50, bad_ratio=0.05))
+            log_file.write(b'\nno quotes 0.1\n1.1.1.1 "GET /open HTTP/1.1 200 0.5\nx "GET /last HTTP/1.1" 0.2')
+
+        for parser in ("fast", "format"):
+            results = []
+            for use_mmap in (False, True):
+                aggregate = LogsAggregate()
+                self.assertTrue(aggregate_plain_log(log_path, parser, aggregate, logger, use_mmap=use_mmap))
+                chunks = LogsAggregate()
+                for start, end in get_file_chunks(log_path, 3):
+                    aggregate_plain_log(log_path, parser, chunks, logger, start, end, use_mmap=use_mmap)
+                results.append((aggregate.number_of_logs, aggregate.bad_logs, aggregate.finalize(),
+                                chunks.finalize()))
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[1][3], results[1][2])
+
+    def test_group_by(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        line = '1.1.1.1 -  - [29/Jun/2017:{}:00 +0300] "{} {} HTTP/1.1" {} 10 "-" "-" "-" "-" "-" {}\n'
+        log_lines = [line.format(time, method, url, status, request_time).encode() for time, method, url, status,
+                     request_time in [("03:50", "GET", "/a", 200, "0.100"), ("03:51", "GET", "/a", 502, "0.300"),
+                                      ("04:10", "POST", "/b", 504, "1.000"), ("04:11", "GET", "/a", 201, "0.200")]]
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines * 50)
+
+        result_config = {"LOG_PARSER": "format", "LOG_FORMAT": LOG_FORMAT_UI_SHORT,
+                         "GROUP_BY": [["status", "url"], ["hour"], ["method"]], "GROUP_LIMIT": 2}
+        group_by = get_group_by(result_config)
+        self.assertEqual(group_by.names, ["status-url", "hour", "method"])
+        self.assertIs(pickle.loads(pickle.dumps(group_by)).keys_cache.get(("/a", b"GET", b"2")), None)
+        with self.assertRaises(ValueError):
+            get_group_by({"GROUP_BY": [["url", "referer"]]})
+
+        latest_log = FileSubscribe(None, log_path, "")
+        parser = get_result_parser(result_config)
+        results = []
+        for workers in (1, 3):
+            view_statistics = {}
+            results.append((get_logs_statistics(50, latest_log, logger, parser=parser, workers=workers,
+                                                group_by=group_by, view_statistics=view_statistics), view_statistics))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], get_logs_statistics(50, latest_log, logger, parser=parser))
+
+        view_statistics = results[0][1]
+        self.assertEqual({row["url"]: row["count"] for row in view_statistics["status-url"]},
+                         {"2xx /a": 100, "5xx /a": 50, "5xx /b": 50})
+        self.assertEqual({row["url"]: row["count"] for row in view_statistics["hour"]},
+                         {"29/Jun/2017:03": 100, "29/Jun/2017:04": 100})
+        self.assertEqual([(row["url"], row["count"], row["time_sum"]) for row in view_statistics["method"]],
+                         [("POST", 50, 50.0), ("GET", 150, 30.0)])
+        self.assertEqual(sum(row["count_perc"] for row in view_statistics["method"]), 100)
+
+    def test_log_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630.gz")
+        line = '1.1.1.1 -  - [29/Jun/2017:{}:00 +0300] "GET {} HTTP/1.1" {} 10 "-" "-" "-" "-" "-" {}\n'
+        log_lines = [line.format(time, url, status, request_time).encode() for time, url, status, request_time in
+                     [("03:50", "/api/1", 200, "0.100"), ("03:51", "/api/2", 502, "0.300"),
+                      ("04:10", "/export", 504, "1.000"), ("04:11", "/api/1", 404, "0.200")]]
+        with gzip.open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines * 25 + generate_log_lines(500, urls=20, bad_ratio=0.02))
+
+        latest_log = find_latest_log(tmp_dir, logger)
+        self.assertIsNone(latest_log.f_index)
+        expected = get_logs_statistics(50, latest_log, logger, parser="format")
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, index_format=LOG_FORMAT_UI_SHORT), expected)
+
+        latest_log = find_latest_log(tmp_dir, logger)
+        self.assertEqual(str(latest_log.f_index), log_path + ".idx")
+        self.assertEqual(get_logs_statistics(50, latest_log, logger), expected)
+        with LogIndex(latest_log.f_index) as log_index:
+            self.assertEqual(log_index.number_of_logs, 600)
+            self.assertEqual(len(log_index.request_times), 600 - log_index.bad_logs)
+            self.assertEqual(log_index.get_aggregate(url_prefix="/export").urls, ["/export"])
+
+        result_config = {"LOG_DIR": tmp_dir, "LATENCY_MODE": "exact", "URL_NORMALIZE": False}
+        rows = run_query(result_config, logger, top=5, sort="count", url_prefix="/api/", status="5xx")
+        self.assertEqual([(row["url"], row["count"], row["count_perc"]) for row in rows], [("/api/2", 25, 100.0)])
+        rows = run_query(result_config, logger, time_from=datetime(2017, 6, 29, 4), time_to=datetime(2017, 6, 29, 5))
+        self.assertEqual({row["url"]: row["count"] for row in rows}, {"/export": 25, "/api/1": 25})
+
+        url_normalizer = get_url_normalizer({"URL_NORMALIZE": True})
+        self.assertIsNone(find_log_index(latest_log, logger, get_log_index_key(LOG_FORMAT_UI_SHORT, url_normalizer)))
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, url_normalizer=url_normalizer),
+                         get_logs_statistics(50, latest_log, logger, parser="format", url_normalizer=url_normalizer))
+        rows = run_query(dict(result_config, URL_NORMALIZE=True), logger, url_prefix="/api/v2/banner/")
+        self.assertEqual({row["url"] for row in rows}, {"/api/v2/banner/{id}"})
+        with LogIndex(latest_log.f_index) as log_index:
+            self.assertEqual(log_index.index_key, get_log_index_key(LOG_FORMAT_UI_SHORT, url_normalizer))
+
+        with gzip.open(log_path, 'ab') as log_file:
+            log_file.write(log_lines[0])
+        self.assertIsNone(find_latest_log(tmp_dir, logger).f_index)
+        missing_log = FileSubscribe(None, os.path.join(tmp_dir, "nginx-access-ui.log-20170629"), "")
+        self.assertIsNone(build_log_index(missing_log, LOG_FORMAT_UI_SHORT, logger))
+
+    def test_startup_import_budget(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        with open(os.path.join(tmp_dir, "nginx-access-ui.log-20170630"), 'wb') as log_file:
+            log_file.writelines(log_lines_sample)
+        with open(os.path.join(tmp_dir, "report-2017.06.30.html"), 'w') as report_file:
+            report_file.write("done")
+        config_path = os.path.join(tmp_dir, "config.json")
+        with open(config_path, 'w') as config_file:
+            json.dump({"LOG_DIR": tmp_dir, "REPORT_DIR": tmp_dir, "SELF_LOG_PATH": ""}, config_file)
+
+        # Точка входа для cron импортирует log_analyzer модулем, то есть из байткода, а не компилирует его
+        entry_path = os.path.join(os.path.dirname(os.path.abspath(log_analyzer.__file__)), "run_log_analyzer.py")
+        result, errors, names = get_import_times(entry_path, "--config", config_path)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "")
+        self.assertEqual(errors, [])
+        self.assertIn("log_analyzer", names)
+        self.assertEqual([name for name in names if name in STARTUP_LAZY_MODULES], [])
+
+        # Меряется весь запуск (с загрузкой байткода), сам интерпретатор вычитается
+        budget_ms = float(os.environ.get(STARTUP_BUDGET_ENV) or STARTUP_BUDGET_MS)
+        startup_ms = get_run_time_ms(entry_path, "--config", config_path) - get_run_time_ms("-c", "pass")
+        self.assertLess(startup_ms, budget_ms)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ["config.json", "nginx-access-ui.log-20170630",
+                                                       "report-2017.06.30.html"])
+
+    def test_bad_lines(self):
+        decode_line = b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /caf\xe9 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.1\n'
+        time_line = b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /x HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 1.2.3\n'
+        log_lines = log_lines_sample * 20 + [decode_line] * 2 + [time_line] + [b"garbage " * 100 + b"\n"] * 50
+        results = {}
+        for name, parse in LOG_PARSERS.items():
+            aggregate = LogsAggregate()
+            self.assertTrue(parse(log_lines, aggregate, logger))
+            results[name] = (aggregate.number_of_logs, aggregate.bad_logs, aggregate.finalize())
+            self.assertEqual(sum(aggregate.bad_lines.reasons.values()), aggregate.bad_logs)
+            self.assertEqual(aggregate.bad_lines.reasons["decode"], 2)
+            self.assertTrue(all(len(sample) <= BadLines.SAMPLE_SIZE for sample in aggregate.bad_lines.samples.values()))
+            self.assertLessEqual(max(map(len, aggregate.bad_lines.samples["format"])), BadLines.EXAMPLE_SIZE)
+        self.assertEqual(results["format"], results["fast"])
+
+        bad_lines = BadLines(size=2)
+        other = BadLines(size=2)
+        for index in range(100):
+            bad_lines.add("format", b"a%d" % index)
+            other.add("format" if index % 2 else "decode", b"b%d" % index)
+        bad_lines.merge(other)
+        self.assertEqual(bad_lines.reasons, {"format": 150, "decode": 50})
+        self.assertEqual({reason: len(sample) for reason, sample in bad_lines.samples.items()}, {"format": 2, "decode": 2})
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines_sample * 50 + [decode_line] * 3)
+        with self.assertLogs(logger, "WARNING") as captured:
+            self.assertIsNotNone(get_logs_statistics(50, FileSubscribe(None, log_path, ""), logger, workers=2))
+        self.assertEqual(len(captured.records), 1)
+        self.assertIn("decode: 3", captured.output[0])
+
+    def test_result_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        generate_log_file(log_path, 2000, urls=50, bad_ratio=0.01)
+        latest_log = FileSubscribe(None, log_path, "")
+        result_config = {"LOG_PARSER": "format", "GROUP_BY": [["status", "url"]], "TEMPLATE_PATH": log_path,
+                         "REPORT_SIZE": 5}
+        result_cache = ResultCache(os.path.join(tmp_dir, "cache"), 1 << 20)
+        cache_key = get_cache_key(log_path, result_config)
+        self.assertNotEqual(cache_key, get_cache_key(log_path, dict(result_config, URL_NORMALIZE=True)))
+        self.assertEqual(cache_key, get_cache_key(log_path, dict(result_config, REPORT_SIZE=10)))
+
+        group_by = get_group_by(result_config)
+        for report_size in (10, 5, None):
+            expected_views, views = {}, {}
+            expected = get_logs_statistics(50, latest_log, logger, parser="format", report_size=report_size,
+                                           group_by=group_by, view_statistics=expected_views)
+            metrics = PipelineMetrics()
+            self.assertEqual(get_logs_statistics(50, latest_log, logger, parser="format", report_size=report_size,
+                                                 metrics=metrics, group_by=group_by, view_statistics=views,
+                                                 result_cache=result_cache, cache_key=cache_key), expected)
+            self.assertEqual(views, expected_views)
+            self.assertEqual("parse" in metrics.stages, report_size != 5)
+            self.assertEqual(metrics.counters["lines"], 2000)
+        self.assertIsNone(get_logs_statistics(0, latest_log, logger, result_cache=result_cache, cache_key=cache_key))
+
+        empty_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170629")
+        open(empty_path, 'wb').close()
+        empty_key = get_cache_key(empty_path, result_config)
+        for _ in range(2):
+            self.assertEqual(get_logs_statistics(0, FileSubscribe(None, empty_path, ""), logger,
+                                                 result_cache=result_cache, cache_key=empty_key, report_size=5), [])
+
+        report_path = get_report_path(tmp_dir, FileSubscribe(datetime(2017, 6, 30), log_path, ""), logger)
+        with open(report_path, 'w') as report_file:
+            report_file.write("done")
+        render_key = get_render_key(cache_key, result_config)
+        self.assertIsNone(get_report_path(tmp_dir, FileSubscribe(datetime(2017, 6, 30), log_path, ""), logger,
+                                          render_key=render_key))
+        log_analyzer.save_render_key(report_path, render_key, logger)
+        self.assertIsNone(get_report_path(tmp_dir, FileSubscribe(datetime(2017, 6, 30), log_path, ""), logger,
+                                          render_key=render_key))
+        self.assertEqual(get_report_path(tmp_dir, FileSubscribe(datetime(2017, 6, 30), log_path, ""), logger,
+                                         render_key=get_render_key(cache_key, dict(result_config, REPORT_SIZE=10))),
+                         report_path)
+        cache_config = dict(result_config, CACHE_DIR=os.path.join(tmp_dir, "cache"))
+        self.assertEqual(plan_batch_jobs(tmp_dir, tmp_dir, logger, datetime(2017, 6, 30), result_config=cache_config),
+                         [])
+        jobs = plan_batch_jobs(tmp_dir, tmp_dir, logger, datetime(2017, 6, 30),
+                               result_config=dict(cache_config, REPORT_SIZE=10))
+        self.assertEqual([report_path for _, report_path in jobs], [report_path])
+
+        result_cache = ResultCache(os.path.join(tmp_dir, "lru"), 1 << 20)
+        for index, key in enumerate("abc"):
+            result_cache.put(key, {"rows": [index] * 1000}, logger)
+            os.utime(result_cache.get_path(key), ns=(index, index))
+        result_cache.get("a", logger)
+        result_cache.max_bytes = sum(os.path.getsize(result_cache.get_path(key)) for key in "ac")
+        self.assertEqual(result_cache.evict(logger), 1)
+        self.assertEqual(sorted(os.listdir(result_cache.cache_dir)), ["a.cache", "c.cache"])
+
+    def test_vector_backend(self):
+        with unittest.mock.patch.object(log_analyzer, "VECTOR_BACKEND", False):
+            self.assertIs(type(create_aggregate()), LogsAggregate)
+        self.assertIs(type(create_aggregate(get_latency_factory({"LATENCY_MODE": "sketch"}))), LogsAggregate)
+        if get_numpy() is None:
+            self.skipTest("NumPy не установлен")
+        self.assertIs(type(create_aggregate()), VectorLogsAggregate)
+
+        log_lines = log_lines_sample + generate_log_lines(5000, urls=300, zipf=1.1, bad_ratio=0.01)
+        for max_urls in (None, 50):
+            expected, vector = LogsAggregate(max_urls=max_urls), VectorLogsAggregate(max_urls=max_urls)
+            LOG_PARSERS["fast"](log_lines, expected, logger)
+            LOG_PARSERS["fast"](log_lines, vector, logger)
+            self.assertEqual(vector.finalize(), expected.finalize())
+            self.assertEqual(vector.finalize(20, "count"), expected.finalize(20, "count"))
+            self.assertEqual(vector.get_flat_samples(), expected.get_flat_samples())
+
+            parts = [LogsAggregate(max_urls=max_urls), VectorLogsAggregate(max_urls=max_urls)]
+            for part in parts:
+                LOG_PARSERS["fast"](log_lines_sample, part, logger)
+            for part in parts:
+                expected.merge(pickle.loads(pickle.dumps(part)))
+                vector = pickle.loads(pickle.dumps(vector)).merge(part)
+            LOG_PARSERS["fast"](log_lines, expected, logger)
+            LOG_PARSERS["fast"](log_lines, vector, logger)
+            self.assertEqual(vector.finalize(), expected.finalize())
+            self.assertEqual((vector.number_of_logs, vector.bad_logs, vector.pruned_urls),
+                             (expected.number_of_logs, expected.bad_logs, expected.pruned_urls))
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630")
+        with open(log_path, 'wb') as log_file:
+            log_file.writelines(log_lines)
+        latest_log = FileSubscribe(None, log_path, "")
+        with unittest.mock.patch.object(log_analyzer, "VECTOR_BACKEND", False):
+            expected = get_logs_statistics(50, latest_log, logger)
+        self.assertEqual(get_logs_statistics(50, latest_log, logger), expected)
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, workers=2), expected)
+        self.assertEqual(get_logs_statistics(50, latest_log, logger, index_format=LOG_FORMAT_UI_SHORT), expected)
+
 
 if __name__ == "__main__":
     unittest.main()